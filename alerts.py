@@ -0,0 +1,283 @@
+
+"""
+Threshold alerts evaluated incrementally as sensor readings arrive.
+
+Rules are read from a JSON file (ALERT_RULES_FILE), e.g.
+
+    [{"id": "pm25-unhealthy", "metric": "pm_2_5_aqi", "above": 150, "for_minutes": 30},
+     {"id": "porch-freezing", "metric": "temp_f_corrected", "below": 32, "sensor_id": "84:f3:eb:7b:c8:a9"}]
+
+Rules are indexed by sensor, metric and threshold, so a reading is only checked against rules whose threshold lies between the previous and current values of a metric. Alerts that must hold for a while wait in a per-sensor heap ordered by due time. Breaches are stored in alert_state along with the reading, so other processes pick them up. Firing and resolved alerts are appended to ALERT_LOG_FILE and posted to ALERT_WEBHOOK_URL from a background thread.
+"""
+
+
+import heapq
+import json
+import queue
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+import pandas as pd
+from requests import post
+
+import metrics  # Evaluation timings.
+import structured_logging as slog
+import user_settings as us
+
+
+log = slog.getLogger(__name__)
+
+
+class Rule(object):
+    __slots__ = ('id', 'metric', 'above', 'threshold', 'duration', 'sensorId')
+
+    def __init__(self, spec):
+        """
+        Args:
+            spec: dict with id, metric, either above or below, and optionally for_minutes and sensor_id
+        """
+        self.id = str(spec['id'])
+        self.metric = spec['metric']
+        self.above = 'above' in spec
+        self.threshold = float(spec['above'] if self.above else spec['below'])
+        self.duration = pd.Timedelta(minutes=float(spec.get('for_minutes', 0)))
+        self.sensorId = spec.get('sensor_id')
+
+    def breached(self, value):
+        return value > self.threshold if self.above else value < self.threshold
+
+
+class ThresholdIndex(object):
+    """
+    Rules on one metric, sorted by threshold.
+    """
+
+    def __init__(self, rules):
+        above = sorted((rule for rule in rules if rule.above), key=lambda rule: rule.threshold)
+        below = sorted((rule for rule in rules if not rule.above), key=lambda rule: rule.threshold)
+
+        self.aboveRules = above
+        self.aboveThresholds = [rule.threshold for rule in above]
+        self.belowRules = below
+        self.belowThresholds = [rule.threshold for rule in below]
+
+    def all(self):
+        return self.aboveRules + self.belowRules
+
+    def changed(self, previous, value):
+        """
+        Rules that are breached by exactly one of two values.
+        """
+        low, high = min(previous, value), max(previous, value)
+
+        # Above rules are breached by values over the threshold, below rules by values under it.
+        return (self.aboveRules[bisect_left(self.aboveThresholds, low):
+                                bisect_left(self.aboveThresholds, high)] +
+                self.belowRules[bisect_right(self.belowThresholds, low):
+                                bisect_right(self.belowThresholds, high)])
+
+
+class AlertEngine(object):
+    """
+    Per-sensor alert state for incoming readings.
+    """
+
+    # Time between readings beyond which a sensor's state is reloaded, e.g. because another process ingested readings in between. Just over one 2-minute reading interval.
+    reloadGap = pd.Timedelta(minutes=3)
+
+    def __init__(self, rules=()):
+        self.lock = threading.Lock()
+        self.sensors = dict()
+        self.setRules(rules)
+
+    def setRules(self, rules):
+        self.rules = {rule.id: rule for rule in rules}
+
+        # Sensor ID (None for rules on every sensor) -> metric -> rules.
+        grouped = dict()
+        for rule in self.rules.values():
+            grouped.setdefault(rule.sensorId, dict()).setdefault(
+                rule.metric, []).append(rule)
+
+        # Sensor ID (None for sensors without rules of their own) -> metric -> ThresholdIndex of the rules on every sensor and the sensor's own. One index per metric, so each reading's value is compared with the previous one once.
+        common = grouped.get(None, {})
+        self.indexes = dict()
+        for sensorId, byMetric in grouped.items():
+            merged = {metric: list(rules) for metric, rules in common.items()}
+            if sensorId is not None:
+                for metric, rules in byMetric.items():
+                    merged.setdefault(metric, []).extend(rules)
+
+            self.indexes[sensorId] = {metric: ThresholdIndex(rules) for metric, rules in merged.items()}
+
+    def indexesFor(self, sensorId):
+        return self.indexes.get(sensorId, self.indexes.get(None, {})).items()
+
+    def load(self, cur, sensorId):
+        state = {'lastTs': None, 'values': dict(), 'breaches': dict(), 'due': []}
+
+        cur.execute("SELECT rule_id, breach_start, fired_at FROM alert_state WHERE sensor_id = %s ",
+                    (sensorId or '',))
+        for ruleId, breachStart, firedAt in cur.fetchall():
+            rule = self.rules.get(ruleId)
+            if rule is None:
+                continue
+
+            breachStart = pd.Timestamp(breachStart).tz_convert('UTC')
+            state['breaches'][ruleId] = [breachStart, firedAt is not None]
+            if firedAt is None:
+                heapq.heappush(state['due'], (breachStart + rule.duration, ruleId, breachStart))
+
+        self.sensors[sensorId] = state
+        return state
+
+    def forget(self, sensorId):
+        """
+        Drop a sensor's in-memory state, e.g. after its reading was rolled back.
+        """
+        with self.lock:
+            self.sensors.pop(sensorId, None)
+
+    def update(self, row, cur):
+        """
+        Evaluate rules against a reading. State changes are written with the cursor, so they commit with the reading.
+
+        Args:
+            row: dict of sensor_data column -> value
+            cur: psycopg2 cursor
+
+        Returns:
+            list of alert event dicts, to be dispatched once the reading is committed
+        """
+        if not self.rules:
+            return []
+
+        start = time.perf_counter()
+        events = self.evaluate(row, cur)
+        metrics.observe('alert_evaluation_ms', (time.perf_counter() - start) * 1000)
+
+        return events
+
+    def evaluate(self, row, cur):
+        sensorId = row.get('sensor_id')
+        ts = pd.Timestamp(row['measurement_ts']).tz_convert('UTC')
+        events = []
+
+        with self.lock:
+            state = self.sensors.get(sensorId)
+            if state is None or (state['lastTs'] is not None and ts - state['lastTs'] > self.reloadGap):
+                state = self.load(cur, sensorId)
+
+            if state['lastTs'] is not None and ts <= state['lastTs']:
+                # Late reading. State only moves forward.
+                return events
+            state['lastTs'] = ts
+
+            breaches = state['breaches']
+
+            for metric, index in self.indexesFor(sensorId):
+                value = row.get(metric)
+                if value is None or value != value:  # Missing or NaN
+                    continue
+                value = float(value)
+
+                previous = state['values'].get(metric)
+                state['values'][metric] = value
+                candidates = index.all() if previous is None else index.changed(previous, value)
+
+                for rule in candidates:
+                    breached = rule.breached(value)
+
+                    if breached and rule.id not in breaches:
+                        breaches[rule.id] = [ts, False]
+                        self.saveBreach(cur, sensorId, rule.id, ts)
+                        heapq.heappush(state['due'], (ts + rule.duration, rule.id, ts))
+
+                    elif not breached and rule.id in breaches:
+                        breachStart, fired = breaches.pop(rule.id)
+                        cur.execute("DELETE FROM alert_state WHERE sensor_id = %s AND rule_id = %s ",
+                                    (sensorId or '', rule.id))
+                        if fired:
+                            events.append(self.event(rule, sensorId, value, breachStart, ts, 'resolved'))
+
+            # Fire breaches that have now lasted long enough. Entries for breaches that ended are skipped.
+            due = state['due']
+            while due and due[0][0] <= ts:
+                dueTs, ruleId, breachStart = heapq.heappop(due)
+                breach = breaches.get(ruleId)
+
+                if breach is not None and breach[0] == breachStart and not breach[1]:
+                    breach[1] = True
+                    cur.execute("UPDATE alert_state SET fired_at = %s WHERE sensor_id = %s AND rule_id = %s ",
+                                (ts.to_pydatetime(), sensorId or '', ruleId))
+                    rule = self.rules[ruleId]
+                    events.append(self.event(rule, sensorId, state['values'].get(rule.metric),
+                                             breachStart, ts, 'firing'))
+
+        return events
+
+    def saveBreach(self, cur, sensorId, ruleId, ts):
+        cur.execute("INSERT INTO alert_state (sensor_id, rule_id, breach_start, fired_at) "
+                    "VALUES (%s, %s, %s, NULL) "
+                    "ON CONFLICT (sensor_id, rule_id) DO UPDATE SET breach_start = EXCLUDED.breach_start "
+                    ", fired_at = NULL ",
+                    (sensorId or '', ruleId, ts.to_pydatetime()))
+
+    def event(self, rule, sensorId, value, breachStart, ts, status):
+        return {'rule': rule.id, 'status': status, 'sensor_id': sensorId,
+                'metric': rule.metric, 'value': value,
+                'condition': '{} {}'.format('above' if rule.above else 'below', rule.threshold),
+                'breach_start': breachStart.isoformat(), 'ts': ts.isoformat()}
+
+
+class AlertDispatcher(object):
+    """
+    Sends alert events to the file and webhook sinks from a background thread, so ingest never waits on them.
+    """
+
+    def __init__(self, logFile=us.alertLogFile, webhookUrl=us.alertWebhookUrl):
+        self.logFile = logFile
+        self.webhookUrl = webhookUrl
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def dispatch(self, events):
+        if not events or not (self.logFile or self.webhookUrl):
+            return
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+        for event in events:
+            self.queue.put(event)
+
+    def run(self):
+        while True:
+            event = self.queue.get()
+            log.info('alert %s', event['status'], extra={'fields': event})
+
+            if self.logFile:
+                try:
+                    with open(self.logFile, 'a') as f:
+                        f.write(json.dumps(event) + '\n')
+                except OSError as e:
+                    log.error('writing alert failed: %s', e)
+
+            if self.webhookUrl:
+                try:
+                    post(self.webhookUrl, json=event, timeout=5)
+                except Exception as e:
+                    log.error('posting alert failed: %s', e)
+
+
+def loadRules(path=us.alertRulesFile):
+    if not path:
+        return []
+
+    with open(path) as f:
+        return [Rule(spec) for spec in json.load(f)]
+
+
+dispatcher = AlertDispatcher()
@@ -4,7 +4,6 @@
 """
 TODO:
     - Feature to add past data from https://www.purpleair.com/sensorlist or ThingSpeak API
-    - Display hourly forecast
     - Temperature unit setting in user_settings
 """
 
@@ -12,72 +11,269 @@ TODO:
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+from dash.exceptions import PreventUpdate
 from flask import Flask
 from flask import request
+from flask import jsonify
+from flask import Response
+from flask import stream_with_context
+from flask import g
 
 # Making plots and handling data.
 import plotly.graph_objects as go  # More complex plotly graphs
 import pandas as pd
-from requests import get  # Make get requests
-import json  # Decode jsons
+import threading
 import page_helper as ph  # Functions to fetch data and build plots
+import metrics  # Process-wide counters and timings
+import hot_tier as ht  # Recent data held in memory
+import forecast_cache as fc  # Forecast shared by all sessions
+import change_events as ce  # Pushing new data notifications to browsers
+import shared_cache as sc  # Results shared across worker processes
+import export  # Streaming data exports
+import weather_fetch as wf  # Weather per sensor location
+import spool  # Write-ahead spool for incoming readings
+import static_assets as sa  # Fingerprinted, precompressed static files
+import payload_schema as ps  # Validating sensor payloads
 
 # Managing database.
 import psycopg2
 from psycopg2 import extras
-from psycopg2 import pool
 import database_management as dm
+import migrations  # Schema version
 
 import user_settings as us  # JSON header verification, API key, etc.
+import structured_logging as slog  # Queued JSON logs with request ids
+import time
+import uuid
+from contextlib import contextmanager
 
 
-# Initializing the app and webpage.
-external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
+# Initializing the app and webpage. The stylesheet is served from vendor/, so the page loads without outside network access.
+external_stylesheets = [sa.vendor.url('skeleton.css')]
 
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# Responses are compressed by static_assets rather than Flask-Compress.
+app = dash.Dash(__name__, external_stylesheets=external_stylesheets, compress=False)
 app.title = 'PurpleAir Monitoring'
 
 server = app.server
+server.after_request(sa.compressResponse)
 
+log = slog.getLogger(__name__)
 
-# Get DB connection pool for fetching data.
-connPool = pool.ThreadedConnectionPool(
-    1, 10, us.databaseUrl, cursor_factory=extras.DictCursor)
 
+# Tag everything logged while handling a request with its id, and log the request with its timing.
+@server.before_request
+def start_request():
+    g.requestStart = time.perf_counter()
+    g.requestId = slog.newRequestId(request.headers.get('X-Request-Id'))
 
-# Get read and write DB connection for managing database. Initialize DB object.
-writeConn = psycopg2.connect(us.databaseUrl)
-db = dm.AirDatabase(writeConn)
 
+@server.after_request
+def finish_request(response):
+    log.info('handled request', extra={'fields': {
+        'method': request.method, 'path': request.path, 'status': response.status_code,
+        'duration_ms': round((time.perf_counter() - g.requestStart) * 1000, 1)}})
+    response.headers['X-Request-Id'] = g.requestId
+    return response
 
-# Add incoming data to DB.
+
+# Queries of dashboard callbacks are tagged with the session and output they're for, so newer requests cancel superseded ones.
+queryScopes = dm.QueryScopes()
+
+# Get DB connection pool for fetching data. Connects on first use, so workers boot without touching the database. Reads go to the replica at READ_DATABASE_URL, if set, while it keeps up. Checkouts wait for a free connection during bursts.
+connPool = dm.ReplicaRoutingPool(
+    dm.BlockingConnectionPool(10, us.databaseUrl, name='primary', session={'readonly': True},
+                              cursor_factory=extras.DictCursor),
+    dm.BlockingConnectionPool(10, us.readDatabaseUrl, name='replica', session={'readonly': True},
+                              cursor_factory=extras.DictCursor)
+    if us.readDatabaseUrl else None,
+    us.readMaxLagSeconds, scopes=queryScopes)
+
+
+# Write connection and DB object for managing database, created on first insert.
+db = None
+dbLock = threading.Lock()
+
+
+def getDb():
+    global db
+
+    with dbLock:
+        if db is None:
+            db = dm.AirDatabase(psycopg2.connect(us.databaseUrl))
+
+            # Keep recent data in memory, fed by newly inserted rows.
+            if ht.tiers:
+                db.sensorListeners.append(ht.sensorTier.add)
+                db.weatherListeners.append(ht.weatherTier.add)
+
+            # Invalidate cached results in all processes after each update.
+            db.sensorListeners.append(sc.invalidator('sensor'))
+            db.weatherListeners.append(sc.invalidator('weather'))
+
+    return db
+
+
+# Check the schema and load recent data in memory without holding up worker boot. Queries are answered from the database until warming finishes.
+def warmUp():
+    try:
+        conn = psycopg2.connect(us.databaseUrl)
+        version = migrations.currentVersion(conn)
+        conn.close()
+
+        if version < migrations.latestVersion():
+            log.warning('database schema at version %s of %s. Run `python migrations.py`',
+                        version, migrations.latestVersion())
+
+        ht.warmAll(connPool)
+    except psycopg2.Error as e:
+        log.error('warming failed: %s', e)
+
+
+# Refresh in-memory data when any process reports new rows.
+def onDataChanged(kind, payload):
+    # Latest-reading lookups wait for the replica to catch up with this write.
+    connPool.noteWrite(payload.get('lsn'))
+
+    if kind in sc.namespaces:
+        sc.cache.remoteChange(kind)
+
+    if kind == 'sensor' and ht.tiers:
+        if 'backfilled' in payload or 'recomputed' in payload:
+            # Backfilled and recomputed rows are older than the newest held, so catching up wouldn't load them.
+            threading.Thread(target=reloadTier, args=(ht.sensorTier,), daemon=True).start()
+        else:
+            ht.sensorTier.expire()
+    elif kind == 'weather' and ht.tiers:
+        ht.weatherTier.expire()
+
+
+def reloadTier(tier):
+    try:
+        tier.reload(connPool)
+    except psycopg2.Error as e:
+        log.error('reloading hot tier failed: %s', e, extra={'fields': {'table': tier.tableName}})
+        tier.expire()
+
+
+ce.listener.callbacks.append(onDataChanged)
+
+
+# Fetch weather for each reporting sensor's location unless a recent fetch covers it.
+def fetchWeather(payloads):
+    if not us.openWeatherApiKey:
+        return
+
+    latest = {data.get('SensorId'): data for data in payloads}
+    for data in latest.values():
+        wf.fetcher.fetchForSensor(getDb(), data)
+
+
+if spool.replayer is not None:
+    spool.replayer.callbacks.append(fetchWeather)
+
+
+# Start each process's background work when it serves its first request, so importing the app (e.g. in tools and tests) doesn't connect to the database or contend for the spool.
+@server.before_first_request
+def startBackgroundWork():
+    sa.bundles.start()
+    threading.Thread(target=warmUp, daemon=True).start()
+    ce.listener.start(us.databaseUrl)
+
+    # Replay spooled readings into the DB in whichever process wins the replay lock.
+    if spool.replayer is not None:
+        spool.replayer.start(getDb, spool.writer.appended)
+
+
+# Add incoming data to DB. Readings are spooled to disk and acknowledged without waiting on the DB, unless spooling is turned off.
 @server.route('/sensordata', methods=['POST'])
 def insert_data():
-    if not db:
-        raise Exception('db object not defined')
+    verified = not us.header_key or request.headers.get('X-Purpleair') == us.header_key
 
-    if us.header_key and request.headers.get('X-Purpleair') == us.header_key:
-        db.insert_sensor_row(request.json)
-    elif not us.header_key:
-        db.insert_sensor_row(request.json)
+    if verified:
+        # Reject malformed readings before they're spooled or stored, so the sender sees the problem.
+        try:
+            values = ps.transformer(request.get_json(silent=True))
+        except ps.PayloadError as e:
+            log.warning('rejected sensor reading: %s', e)
+            metrics.increment('sensor_rows_rejected')
+            return jsonify({'errors': e.problems}), 400
+
+    if spool.writer is not None:
+        if verified:
+            spool.writer.append(request.json)
+        return 'done'
+
+    db = getDb()
+
+    if verified:
+        db.insert_sensor_values(values)
 
     if us.loadHistoricalData:
         # Add all historical data to DB.
         db.load_historal_data()
 
-    if us.openWeatherApiKey:
-        print('querying weather API')
-        # Make get request to OpenWeather API.
-        weatherResponse = get("https://api.openweathermap.org/data/2.5/onecall?lat={}&lon={}&appid={}&units=imperial&lang={}".format(
-            us.latitude, us.longitude, us.openWeatherApiKey, us.lang))
-        print('got weather API response')
-
-        weatherData = json.loads(weatherResponse.content.decode('utf-8'))
-        db.insert_weather_row_and_forecasts(weatherData)
+    fetchWeather([request.json])
 
     return 'done'
 
 
+# Vendored static files, at fingerprinted URLs from sa.vendor.url.
+@server.route('/vendor/<fileName>', methods=['GET'])
+def vendor_file(fileName):
+    return sa.vendor.response(fileName)
+
+
+# Forecast icons, fetched from OpenWeather once.
+@server.route('/weather-icons/<icon>.png', methods=['GET'])
+def weather_icon(icon):
+    return sa.weatherIcons.response(icon)
+
+
+# Report ingest and query metrics for this worker process.
+@server.route('/metrics', methods=['GET'])
+def report_metrics():
+    return jsonify(metrics.snapshot())
+
+
+# Stream new data notifications to the browser. assets/change_events.js turns them into callback triggers.
+@server.route('/events', methods=['GET'])
+def stream_events():
+    return Response(ce.listener.stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+# Stream a range of sensor or weather data as CSV, NDJSON or Parquet.
+@server.route('/export', methods=['GET'])
+def export_data():
+    tableName = request.args.get('table', 'sensor_data')
+    exportFormat = request.args.get('format', 'csv')
+    compression = request.args.get('compression') or None
+    columns = request.args.get('columns')
+
+    try:
+        columns = export.validateRequest(tableName, columns.split(',') if columns else None,
+                                         exportFormat, compression)
+        start = export.parseBound(request.args.get('start'))
+        end = export.parseBound(request.args.get('end'))
+    except export.ExportError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def generate():
+        with connPool.connection() as conn:
+            yield from export.exportStream(conn, tableName, columns, start, end,
+                                           request.args.get('sensor'), exportFormat, compression)
+
+    mimetype = export.formats[exportFormat][0]
+    if compression == 'gzip' and exportFormat != 'parquet':
+        # Downloaded as a .gz file rather than decompressed by the browser.
+        mimetype = 'application/gzip'
+
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename="{}"'.format(
+                        export.fileName(tableName, exportFormat, compression))})
+
 
 # Laying out the webpage.
 forecastDisplaySettings = []
@@ -88,7 +284,7 @@ if us.showHourlyForecast:
     forecastDisplaySettings.append('hourly')
 
 
-app.layout = html.Div(children=[
+pageLayout = html.Div(children=[
 
     html.Div([
         html.Div([
@@ -116,11 +312,18 @@ app.layout = html.Div(children=[
                 end_date_placeholder_text='Select a date',
                 disabled=True
             ),
-            dcc.Interval(
-                id='fetch-interval',
-                interval=(2 * 60) * 1000,  # 2 minutes in milliseconds
-                n_intervals=0
-            )
+            # Clicked by assets/change_events.js when new data arrives.
+            html.Button(id='sensor-data-changed',
+                        n_clicks=0, style={'display': 'none'}),
+            html.Button(id='weather-data-changed',
+                        n_clicks=0, style={'display': 'none'}),
+            # Panel data for the date range, redrawn for the selected unit and species by assets/toggles.js.
+            dcc.Store(id='temp-data'),
+            dcc.Store(id='aqi-data'),
+            # Zoomed x-axis range and width of each time-series plot, set by assets/toggles.js.
+            dcc.Store(id='temp-view'),
+            dcc.Store(id='humid-view'),
+            dcc.Store(id='aqi-view')
         ], className="six columns")
 
     ], className="row"),
@@ -177,6 +380,9 @@ app.layout = html.Div(children=[
                 className="row"),
             html.Blockquote(
                 id='curr-outside-temp',
+                className="row"),
+            html.Blockquote(
+                id='sensor-temp-extremes',
                 className="row")
         ], className="three columns", style={'position': 'relative'}),
     ], className="row"),
@@ -210,16 +416,85 @@ app.layout = html.Div(children=[
                     id='aqi-picker',
                     options=[
                         {'label': 'PM 2.5', 'value': 'pm_2_5_aqi'},
-                        {'label': 'PM 10.0', 'value': 'pm_10_0_aqi'}
+                        {'label': 'PM 10.0', 'value': 'pm_10_0_aqi'},
+                        {'label': 'PM 2.5 (EPA corrected)',
+                         'value': 'pm_2_5_epa_aqi'}
                     ], value=['pm_2_5_aqi', 'pm_10_0_aqi'], multi=True
                 )], className="row"),
-            html.Blockquote(id='aqi-warning', className="row")
+            html.Blockquote(id='aqi-warning', className="row"),
+            html.Blockquote(id='aqi-hours-above', className="row")
+        ], className="three columns")
+    ], className="row"),
+
+    html.Div([
+        html.H3('Long-term trends')
+    ], className="row"),
+
+    # Heatmap of daily or hourly summaries over the selected date range. Dropdowns to pick the metric, view and statistic.
+    html.Div([
+        html.Div([
+            dcc.Graph(
+                id='trend-heatmap',
+            )], className="eight columns"),
+        html.Div([
+            html.Div(
+                dcc.Dropdown(
+                    id='trend-metric-picker',
+                    options=[{'label': label, 'value': metric}
+                             for metric, label in [('pm_2_5_aqi', 'PM 2.5 AQI'),
+                                                   ('pm_2_5_epa_aqi', 'PM 2.5 AQI (EPA corrected)'),
+                                                   ('temp_f_corrected', 'Temperature')]],
+                    value='pm_2_5_aqi', clearable=False
+                ), className="row"),
+            html.Div(
+                dcc.Dropdown(
+                    id='trend-view-picker',
+                    options=[
+                        {'label': 'Calendar of daily values', 'value': 'daily'},
+                        {'label': 'Hour of day by day', 'value': 'hourly'}
+                    ], value='daily', clearable=False
+                ), className="row"),
+            html.Div(
+                dcc.RadioItems(
+                    id='trend-statistic-picker',
+                    options=[
+                        {'label': 'Average', 'value': 'mean'},
+                        {'label': 'Maximum', 'value': 'max'}
+                    ], value='mean', labelStyle={'display': 'inline-block'}
+                ), className="row"),
+            # Heatmap for the selection, redrawn for the selected temperature unit by assets/toggles.js.
+            dcc.Store(id='trend-data')
         ], className="three columns")
     ], className="row"),
 
 ])
 
 
+def serveLayout():
+    # Each page load gets its own session ID, so its newer requests supersede its older ones.
+    return html.Div([dcc.Store(id='session-id', data=uuid.uuid4().hex), pageLayout])
+
+
+app.layout = serveLayout
+
+
+@contextmanager
+def superseding(sessionId, output, standardDate, customDate):
+    """
+    Run a callback's queries in a scope for its session and output, with a statement timeout for its date range. A newer request for the same output cancels them. Cancelled and timed-out callbacks leave their output as it is.
+    """
+    with queryScopes.scope((sessionId, output), ph.queryTimeoutSeconds(standardDate, customDate)) as scope:
+        try:
+            yield
+        except psycopg2.extensions.QueryCanceledError as e:
+            if scope.superseded:
+                metrics.increment('callbacks_superseded')
+            else:
+                log.warning('query timed out: %s', e, extra={'fields': {'output': output, 'range': standardDate}})
+                metrics.increment('queries_timed_out')
+            raise PreventUpdate
+
+
 # Webpage callbacks
 # Toggle custom date range picker display setting only when date dropdown menu is set to custom.
 @ app.callback(
@@ -232,47 +507,80 @@ def displayCustomDateRangePicker(standardDate):
     return True
 
 
-# Regenerate temp vs time graph when inputs are changed.
+def zoomTo(fig, x0, x1):
+    # Keep a zoomed plot's x-axis where the user put it. Its data extends a little past either side.
+    if x0 is not None:
+        fig.update_layout(xaxis_range=[x0, x1])
+
+
+# Record each time-series plot's zoomed range and width, so its data is refetched for what it shows.
+for graphId, viewId, function in [('temp-vs-time', 'temp-view', 'tempView'),
+                                  ('humid-vs-time', 'humid-view', 'humidView'),
+                                  ('aqi-vs-time', 'aqi-view', 'aqiView')]:
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(
+            namespace='airdash', function_name=function),
+        dash.dependencies.Output(viewId, 'data'),
+        [dash.dependencies.Input(graphId, 'relayoutData')],
+        [dash.dependencies.State('standard-date-picker', 'value'),
+         dash.dependencies.State('custom-date-range-picker', 'start_date'),
+         dash.dependencies.State('custom-date-range-picker', 'end_date')])
+
+
+# Refetch temperature data when the date range, zoom or data change. Unit changes are applied in the browser by assets/toggles.js.
 @ app.callback(
-    [dash.dependencies.Output('temp-vs-time', 'figure'),
-     dash.dependencies.Output('curr-sensor-temp', 'children'),
-     dash.dependencies.Output('curr-outside-temp', 'children')],
+    dash.dependencies.Output('temp-data', 'data'),
     [dash.dependencies.Input('standard-date-picker', 'value'),
      dash.dependencies.Input('custom-date-range-picker', 'start_date'),
      dash.dependencies.Input('custom-date-range-picker', 'end_date'),
-     dash.dependencies.Input('temp-unit-picker', 'value'),
-     dash.dependencies.Input('fetch-interval', 'n_intervals')])
-def updateTempPlot(standardDate, customStart, customEnd, tempUnit, n):
-    records = ph.fetchSensorData(connPool, tempUnit, standardDate, [
-        customStart, customEnd])
-    weather = ph.fetchWeatherDataNewTimeRange(connPool, tempUnit, standardDate, [
-        customStart, customEnd])
-
-    records = ph.correctTemp(records, tempUnit)
-
-    fig = ph.temp_vs_time(records, tempUnit)
-    fig.add_trace(go.Scattergl(x=weather.ts, y=weather[tempUnit],
+     dash.dependencies.Input('sensor-data-changed', 'n_clicks'),
+     dash.dependencies.Input('weather-data-changed', 'n_clicks'),
+     dash.dependencies.Input('temp-view', 'data')],
+    [dash.dependencies.State('session-id', 'data')])
+def updateTempData(standardDate, customStart, customEnd, sensorChanges, weatherChanges, view, sessionId):
+    with superseding(sessionId, 'temp-data', standardDate, [customStart, customEnd]):
+        return buildTempData(standardDate, customStart, customEnd,
+                             *ph.plotView(view, standardDate, [customStart, customEnd]))
+
+
+# Build temp vs time graph in °F and the current and extreme temperatures once per data update and zoom for all sessions.
+@ sc.cached('sensor', 'weather')
+def buildTempData(standardDate, customStart, customEnd, x0, x1, width):
+    records = ph.fetchCorrectedSensorData(connPool, 'temp_f', standardDate, [
+        customStart, customEnd], zoom=(x0, x1), width=width, bySensor=True)
+    records = ph.breakAtGaps(ph.decimate(records, width), ph.fetchGaps(
+        connPool, standardDate, [customStart, customEnd], zoom=(x0, x1)))
+    weather = ph.fetchWeatherDataNewTimeRange(connPool, 'temp_f', standardDate, [
+        customStart, customEnd], zoom=(x0, x1))
+
+    fig = ph.temp_vs_time(records, 'temp_f')
+    fig.add_trace(go.Scattergl(x=weather.ts, y=weather.temp_f,
                                mode='markers+lines', line={"color": "rgb(175,175,175)"},
                                hovertemplate='%{y:.1f}',
                                name='Official outside'))
+    zoomTo(fig, x0, x1)
 
-    currentRecords = ph.fetchSensorData(connPool, tempUnit, '1 day')
+    currentRecords = ph.fetchCorrectedSensorData(connPool.latest, 'temp_f', '1 day')
     currentWeather = ph.fetchWeatherDataNewTimeRange(
-        connPool, tempUnit, '1 day')
+        connPool.latest, 'temp_f', '1 day')
 
-    currentRecords = ph.correctTemp(currentRecords, tempUnit)
+    def latest(frame):
+        if frame.empty or pd.isna(frame.iloc[0]['temp_f']):
+            return None
+        return float(frame.iloc[0]['temp_f'])
 
-    try:
-        currSensorStatement = 'Current sensor temperature: {:.0f}°'.format(
-            currentRecords.iloc[0][tempUnit])
-        currWeatherStatement = 'Current outside temperature: {:.1f}°'.format(
-            currentWeather.iloc[0][tempUnit])
-    except IndexError as e:
-        print(e)
-        currSensorStatement = 'Current sensor temperature: Unknown'
-        currWeatherStatement = 'Current outside temperature: Unknown'
+    summary = ph.fetchWindowSummary(connPool.latest)
 
-    return fig, currSensorStatement, currWeatherStatement
+    if summary is None or pd.isna(summary['temp_f_day_high']):
+        extremes = None
+    else:
+        extremes = [float(summary['temp_f_day_high']),
+                    float(summary['temp_f_day_low'])]
+
+    return {'figure': fig.to_dict(),
+            'sensor': latest(currentRecords),
+            'outside': latest(currentWeather),
+            'extremes': extremes}
 
 
 # Regenerate humidity vs time graph when inputs are changed.
@@ -281,69 +589,149 @@ def updateTempPlot(standardDate, customStart, customEnd, tempUnit, n):
     [dash.dependencies.Input('standard-date-picker', 'value'),
      dash.dependencies.Input('custom-date-range-picker', 'start_date'),
      dash.dependencies.Input('custom-date-range-picker', 'end_date'),
-     dash.dependencies.Input('fetch-interval', 'n_intervals')])
-def updateHumidPlot(standardDate, customStart, customEnd, n):
-    records = ph.fetchSensorData(connPool, "humidity", standardDate, [
-        customStart, customEnd])
+     dash.dependencies.Input('sensor-data-changed', 'n_clicks'),
+     dash.dependencies.Input('weather-data-changed', 'n_clicks'),
+     dash.dependencies.Input('humid-view', 'data')],
+    [dash.dependencies.State('session-id', 'data')])
+def updateHumidPlot(standardDate, customStart, customEnd, sensorChanges, weatherChanges, view, sessionId):
+    with superseding(sessionId, 'humid-vs-time', standardDate, [customStart, customEnd]):
+        return buildHumidPlot(standardDate, customStart, customEnd,
+                              *ph.plotView(view, standardDate, [customStart, customEnd]))
+
+
+@ sc.cached('sensor', 'weather')
+def buildHumidPlot(standardDate, customStart, customEnd, x0, x1, width):
+    records = ph.fetchCorrectedSensorData(connPool, "humidity", standardDate, [
+        customStart, customEnd], zoom=(x0, x1), width=width, bySensor=True)
+    records = ph.breakAtGaps(ph.decimate(records, width), ph.fetchGaps(
+        connPool, standardDate, [customStart, customEnd], zoom=(x0, x1)))
     weather = ph.fetchWeatherDataNewTimeRange(connPool, "humidity", standardDate, [
-        customStart, customEnd])
-
-    records = ph.correctHumid(records)
+        customStart, customEnd], zoom=(x0, x1))
 
     fig = ph.humid_vs_time(records)
     fig.add_trace(go.Scattergl(x=weather.ts, y=weather.humidity,
                                mode='markers+lines', line={"color": "rgb(175,175,175)"},
                                hovertemplate='%{y}',
                                name='Official outside'))
+    zoomTo(fig, x0, x1)
 
-    return fig
+    return fig.to_dict()
 
 
-# Regenerate AQI vs time graph when inputs are changed.
+# Refetch AQI data of every species when the date range, zoom or data change. Species selection is applied in the browser by assets/toggles.js.
 @ app.callback(
-    [dash.dependencies.Output('aqi-vs-time', 'figure'), dash.dependencies.Output(
-        'aqi-warning', 'children'), dash.dependencies.Output('aqi-warning', 'style')],
+    dash.dependencies.Output('aqi-data', 'data'),
     [dash.dependencies.Input('standard-date-picker', 'value'),
      dash.dependencies.Input('custom-date-range-picker', 'start_date'),
      dash.dependencies.Input('custom-date-range-picker', 'end_date'),
-     dash.dependencies.Input('aqi-picker', 'value'),
-     dash.dependencies.Input('fetch-interval', 'n_intervals')])
-def updateAqiPlot(standardDate, customStart, customEnd, aqiSpecies, n):
-    if len(aqiSpecies) == 0:
-        # Default to showing PM 2.5.
-        aqiSpecies = ["pm_2_5_aqi"]
-
-    records = ph.fetchSensorData(connPool, aqiSpecies, standardDate, [
-        customStart, customEnd])
-
-    warningMessage, style = ph.fetchAqiWarningInfo(
-        connPool,
+     dash.dependencies.Input('sensor-data-changed', 'n_clicks'),
+     dash.dependencies.Input('aqi-view', 'data')],
+    [dash.dependencies.State('session-id', 'data')])
+def updateAqiData(standardDate, customStart, customEnd, n, view, sessionId):
+    with superseding(sessionId, 'aqi-data', standardDate, [customStart, customEnd]):
+        return buildAqiData(standardDate, customStart, customEnd,
+                            *ph.plotView(view, standardDate, [customStart, customEnd]))
+
+
+@ sc.cached('sensor')
+def buildAqiData(standardDate, customStart, customEnd, x0, x1, width):
+    aqiSpecies = list(ph.aqiLabels)
+
+    # NowCast and 24-hour average series of every species.
+    overlays = [columns[aqiType] for columns in (ph.nowCastColumns, ph.dailyAverageColumns)
+                for aqiType in aqiSpecies if aqiType in columns]
+
+    records = ph.fetchSensorData(connPool, aqiSpecies + overlays, standardDate, [
+        customStart, customEnd], zoom=(x0, x1), width=width, bySensor=True)
+    records = ph.breakAtGaps(ph.decimate(records, width), ph.fetchGaps(
+        connPool, standardDate, [customStart, customEnd], zoom=(x0, x1)))
+
+    latest = ph.fetchLatestAqiInfo(
+        connPool.latest,
         aqiSpecies,
         standardDate,
         [customStart, customEnd])
 
-    return ph.aqi_vs_time(records, aqiSpecies), warningMessage, style
+    summary = ph.fetchWindowSummary(connPool.latest)
 
+    if summary is None or pd.isna(summary['hours_above_aqi_threshold_24h']):
+        hoursAboveStatement = ''
+    else:
+        hoursAboveStatement = 'Hours above AQI {:.0f} in the last 24 hours: {:.1f}'.format(
+            us.aqiThreshold, summary['hours_above_aqi_threshold_24h'])
+
+    fig = ph.aqi_vs_time(records, aqiSpecies)
+    zoomTo(fig, x0, x1)
+
+    return {'figure': fig.to_dict(),
+            'latest': latest,
+            'hoursAbove': hoursAboveStatement}
 
-# Generate daily forecast display with most recent data.
-@ app.callback(
-    [dash.dependencies.Output('forecast-heading', 'children'),
-     dash.dependencies.Output('daily-forecast-boxes', 'children')],
-    [dash.dependencies.Input('forecast-picker', 'value'),
-     dash.dependencies.Input('temp-unit-picker', 'value'),
-     dash.dependencies.Input('fetch-interval', 'n_intervals')])
-def updateDailyForecast(forecastsToDisplay, tempUnit, n):
-    if 'daily' not in forecastsToDisplay:
-        if 'hourly' not in forecastsToDisplay:
-            return [], []
-        return 'Forecast', None
 
+# Show the selected temperature unit and AQI species from the stored data without a server round trip.
+app.clientside_callback(
+    dash.dependencies.ClientsideFunction(
+        namespace='airdash', function_name='temperaturePanel'),
+    [dash.dependencies.Output('temp-vs-time', 'figure'),
+     dash.dependencies.Output('curr-sensor-temp', 'children'),
+     dash.dependencies.Output('curr-outside-temp', 'children'),
+     dash.dependencies.Output('sensor-temp-extremes', 'children')],
+    [dash.dependencies.Input('temp-data', 'data'),
+     dash.dependencies.Input('temp-unit-picker', 'value')])
+
+app.clientside_callback(
+    dash.dependencies.ClientsideFunction(
+        namespace='airdash', function_name='aqiPanel'),
+    [dash.dependencies.Output('aqi-vs-time', 'figure'),
+     dash.dependencies.Output('aqi-warning', 'children'),
+     dash.dependencies.Output('aqi-warning', 'style'),
+     dash.dependencies.Output('aqi-hours-above', 'children')],
+    [dash.dependencies.Input('aqi-data', 'data'),
+     dash.dependencies.Input('aqi-picker', 'value')])
+
+
+# Rebuild the trend heatmap from the summary tables when the selection or data change.
+@ app.callback(
+    dash.dependencies.Output('trend-data', 'data'),
+    [dash.dependencies.Input('standard-date-picker', 'value'),
+     dash.dependencies.Input('custom-date-range-picker', 'start_date'),
+     dash.dependencies.Input('custom-date-range-picker', 'end_date'),
+     dash.dependencies.Input('trend-metric-picker', 'value'),
+     dash.dependencies.Input('trend-view-picker', 'value'),
+     dash.dependencies.Input('trend-statistic-picker', 'value'),
+     dash.dependencies.Input('sensor-data-changed', 'n_clicks')],
+    [dash.dependencies.State('session-id', 'data')])
+def updateTrendData(standardDate, customStart, customEnd, metric, view, statistic, n, sessionId):
+    with superseding(sessionId, 'trend-data', standardDate, [customStart, customEnd]):
+        return buildTrendData(standardDate, customStart, customEnd, metric, view, statistic)
+
+
+@ sc.cached('sensor')
+def buildTrendData(standardDate, customStart, customEnd, metric, view, statistic):
+    if view == 'hourly':
+        records = ph.fetchSummary(connPool, 'hourly_summary', metric, standardDate, [
+            customStart, customEnd])
+        fig = ph.hour_of_day_heatmap(records, metric, statistic)
+    else:
+        records = ph.fetchSummary(connPool, 'daily_summary', metric, standardDate, [
+            customStart, customEnd])
+        fig = ph.calendar_heatmap(records, metric, statistic)
+
+    return {'figure': fig.to_dict(), 'temperature': metric == 'temp_f_corrected'}
+
+
+app.clientside_callback(
+    dash.dependencies.ClientsideFunction(
+        namespace='airdash', function_name='trendPanel'),
+    dash.dependencies.Output('trend-heatmap', 'figure'),
+    [dash.dependencies.Input('trend-data', 'data'),
+     dash.dependencies.Input('temp-unit-picker', 'value')])
+
+
+# Render daily forecast boxes from forecast snapshot data.
+def renderDailyForecast(records, tempUnit):
     tempSelector = {'temp_f': ['min_f', 'max_f'], 'temp_c': ['min_c', 'max_c']}
     degreeUnit = {'temp_f': '°F', 'temp_c': '°C'}
-    columns = ['weather_type_id', 'short_weather_descrip', 'detail_weather_descrip',
-               'weather_icon', 'precip_chance', 'uvi'] + tempSelector[tempUnit]
-
-    records = ph.fetchDailyForecastData(connPool, columns)
 
     blockStyle = {
         'backgroundColor': 'rgba(223,231,244,1.0)',
@@ -356,83 +744,72 @@ def updateDailyForecast(forecastsToDisplay, tempUnit, n):
         "margin-top": 0,
         "margin-bottom": 0}
 
-    forecastBoxes = []
-
-    # TODO: Not recommended to use iterrows(), though this dataframe is quite small.
-    for index, row in records.iterrows():
-        if index < 6:
-
-            # Customize weather description by weather type. Weather type codes here: https://openweathermap.org/weather-conditions#Weather-Condition-Codes-2
-            if round(row["weather_type_id"], -2) in (300, 700) or row["weather_type_id"] == 800:
-                weatherDescription = row["short_weather_descrip"]
-            elif round(row["weather_type_id"], -2) == 200 or (round(row["weather_type_id"], -2) == 800 and row["weather_type_id"] != 800):
-                weatherDescription = row["detail_weather_descrip"]
-            if round(row["weather_type_id"], -2) in (500, 600):
-                weatherDescription = row["detail_weather_descrip"]
-
-                # Swap "shower" and following word.
-                weatherDescription = weatherDescription.split(' ')
-
-                if 'shower' in weatherDescription:
-                    swapIndex = weatherDescription.index('shower')
-                    weatherDescription[swapIndex], weatherDescription[swapIndex +
-                                                                      1] = weatherDescription[swapIndex + 1], weatherDescription[swapIndex]
-
-                if round(row["weather_type_id"], -2) == 500:
-                    # Drop any instances of "intensity"
-                    weatherDescription = [
-                        item for item in weatherDescription if item != "intensity"]
-
-                weatherDescription = ' '.join(weatherDescription)
-
-            weatherDescription = weatherDescription.capitalize()
-
-            forecastBoxes.append(
-                html.Div([
-                    html.B([row['ts'].strftime('%B '), row['ts'].day,
-                            html.Img(
-                                src='http://openweathermap.org/img/wn/{}@2x.png'.format(
-                                    row['weather_icon']),
-                                style={'height': '25%',
-                                       'width': '25%',
-                                       'verticalAlign': 'middle'})],
-                           style={"margin-left": 5}),
-                    html.P([weatherDescription],
-                           style=lineStyle),
-                    html.P(["Min: ",
-                            round(row[tempSelector[tempUnit][0]]),
-                            degreeUnit[tempUnit]],
-                           style=lineStyle),
-                    html.P(["Max: ",
-                            round(row[tempSelector[tempUnit][1]]),
-                            degreeUnit[tempUnit]],
-                           style=lineStyle),
-                    html.P(["Chance of rain: ",
-                            round(row['precip_chance'] * 100), '%'],
-                           style=lineStyle),
-                    html.P(["UV Index: ",
-                            round(row['uvi'], 0)],
-                           style=lineStyle)
-                ], style=blockStyle,
-                    className="two columns"))
-
-    return 'Forecast', forecastBoxes
-
-
-# TODO: Generate hourly forecast display.
+    # Format all box contents at once, then lay out one box per day.
+    days = records.head(6)
+    dates = days['ts'].dt.strftime('%B ') + days['ts'].dt.day.astype(str)
+    icons = days['weather_icon'].map(sa.weatherIcons.url)
+    minTemps = pd.to_numeric(days[tempSelector[tempUnit][0]]).round().astype(int)
+    maxTemps = pd.to_numeric(days[tempSelector[tempUnit][1]]).round().astype(int)
+    rainChances = (pd.to_numeric(days['precip_chance']).fillna(0) * 100).round().astype(int)
+    uvIndices = pd.to_numeric(days['uvi']).round()
+
+    return [
+        html.Div([
+            html.B([date,
+                    html.Img(
+                        src=icon,
+                        style={'height': '25%',
+                               'width': '25%',
+                               'verticalAlign': 'middle'})],
+                   style={"margin-left": 5}),
+            html.P([description],
+                   style=lineStyle),
+            html.P(["Min: ", minTemp, degreeUnit[tempUnit]],
+                   style=lineStyle),
+            html.P(["Max: ", maxTemp, degreeUnit[tempUnit]],
+                   style=lineStyle),
+            html.P(["Chance of rain: ", rainChance, '%'],
+                   style=lineStyle),
+            html.P(["UV Index: ", uvIndex],
+                   style=lineStyle)
+        ], style=blockStyle,
+            className="two columns")
+        for date, icon, description, minTemp, maxTemp, rainChance, uvIndex in zip(
+            dates, icons, days['description'], minTemps, maxTemps, rainChances, uvIndices)]
+
+
+# Render hourly forecast plot from forecast snapshot data.
+def renderHourlyForecast(records, tempUnit):
+    return dcc.Graph(figure=ph.hourly_forecast(records, tempUnit).to_dict())
+
+
+# Generate daily forecast display with most recent data.
+@ app.callback(
+    [dash.dependencies.Output('forecast-heading', 'children'),
+     dash.dependencies.Output('daily-forecast-boxes', 'children')],
+    [dash.dependencies.Input('forecast-picker', 'value'),
+     dash.dependencies.Input('temp-unit-picker', 'value'),
+     dash.dependencies.Input('weather-data-changed', 'n_clicks')])
+def updateDailyForecast(forecastsToDisplay, tempUnit, n):
+    if 'daily' not in forecastsToDisplay:
+        if 'hourly' not in forecastsToDisplay:
+            return [], []
+        return 'Forecast', None
+
+    return 'Forecast', fc.snapshot.panel(connPool, 'daily', tempUnit, renderDailyForecast)
+
+
+# Generate hourly forecast display with most recent data.
 @ app.callback(
     dash.dependencies.Output('hourly-forecast-display', 'children'),
     [dash.dependencies.Input('forecast-picker', 'value'),
      dash.dependencies.Input('temp-unit-picker', 'value'),
-     dash.dependencies.Input('fetch-interval', 'n_intervals')])
+     dash.dependencies.Input('weather-data-changed', 'n_clicks')])
 def updateHourlyForecast(forecastsToDisplay, tempUnit, n):
     if 'hourly' not in forecastsToDisplay:
         return []
 
-    return 'Hourly forecast display not yet implemented'
-
-    tempSelector = {'temp_f': ['min_f', 'max_f'], 'temp_c': ['min_c', 'max_c']}
-    degreeUnit = {'temp_f': '°F', 'temp_c': '°C'}
+    return fc.snapshot.panel(connPool, 'hourly', tempUnit, renderHourlyForecast)
 
 
 if __name__ == '__main__':
@@ -8,9 +8,15 @@
     Data provided by the US EPA used under public domain (https://edg.epa.gov/EPA_Data_License.html). 
 """
 
+import numpy as np
 import pandas as pd
 from numbers import Number
 
+import structured_logging as slog
+
+
+log = slog.getLogger(__name__)
+
 
 def loadAqiBreakpoints(file_name='aqi_breakpoints.csv', pollutant='PM10 Total 0-10um STP', duration_code='7'):
     """
@@ -84,13 +90,13 @@ def getAqi(pollutantConcentration, breakpoints):
         Rounded AQI (None if pollutantConcentration value is invalid)
     """
     if not pollutantConcentration:
-        print("pollutantConcentration doesn't exist")
+        log.debug("pollutantConcentration doesn't exist")
         return None
     if not isinstance(pollutantConcentration, Number):
-        print("pollutantConcentration not a number")
+        log.debug("pollutantConcentration not a number")
         return None
     if pollutantConcentration < 0:
-        print("pollutantConcentration < 0")
+        log.debug("pollutantConcentration < 0")
         return None
 
     # Round to nearest integer to make compatible with EPA breakpoints.
@@ -122,3 +128,208 @@ def calculateAqiFromConcentration(pollutantConcentration, breakpointHi, breakpoi
         Rounded AQI
     """
     return round(((aqiHi - aqiLo) * (pollutantConcentration - breakpointLo) / (breakpointHi - breakpointLo)) + aqiLo)
+
+
+def getAqiArray(pollutantConcentrations, breakpoints, decimals=0):
+    """
+    Calculate AQI for an array of concentrations at once.
+
+    Args:
+        pollutantConcentrations: array-like of concentrations [µg/m3] of pollutant of interest
+        breakpoints: pandas dataframe, as returned by loadAqiBreakpoints
+        decimals: int; precision concentrations are rounded to before looking up breakpoints (0 for PM 10.0, 1 for PM 2.5)
+
+    Returns:
+        numpy array of rounded AQI (NaN where concentration is missing, negative or off the breakpoint table)
+    """
+    concentrations = np.round(np.asarray(
+        pollutantConcentrations, dtype='float64'), decimals)
+
+    breakpoints = breakpoints.sort_values('Low Breakpoint')
+    breakpointLo = breakpoints['Low Breakpoint'].to_numpy(dtype='float64')
+    breakpointHi = breakpoints['High Breakpoint'].to_numpy(dtype='float64')
+    aqiLo = breakpoints['Low AQI'].to_numpy(dtype='float64')
+    aqiHi = breakpoints['High AQI'].to_numpy(dtype='float64')
+
+    # Index of the breakpoint row whose low end is at or below each concentration.
+    rowIndex = np.searchsorted(breakpointLo, concentrations, side='right') - 1
+    valid = (rowIndex >= 0) & (concentrations >= 0)
+    rowIndex = np.clip(rowIndex, 0, len(breakpointLo) - 1)
+    valid &= concentrations <= breakpointHi[rowIndex]
+
+    aqi = np.round(((aqiHi[rowIndex] - aqiLo[rowIndex]) * (concentrations - breakpointLo[rowIndex]) /
+                    (breakpointHi[rowIndex] - breakpointLo[rowIndex])) + aqiLo[rowIndex])
+
+    return np.where(valid, aqi, np.nan)
+
+
+def getAqiDescriptiveFeatureArray(descriptions, feature, aqi):
+    """
+    Gets specified feature from AQI level descriptive info for an array of AQI values at once.
+
+    Args:
+        descriptions: pandas dataframe, as read in from aqi_colors_messages.csv
+        feature: str; column name of interest in descriptions
+        aqi: array-like of AQI values
+
+    Returns:
+        numpy object array (None where AQI is missing or out of range)
+    """
+    aqi = np.asarray(aqi, dtype='float64')
+
+    descriptions = descriptions.sort_values('aqi_lo')
+    aqiLo = descriptions['aqi_lo'].to_numpy(dtype='float64')
+    aqiHi = descriptions['aqi_hi'].to_numpy(dtype='float64')
+    features = descriptions[feature].to_numpy(dtype=object)
+
+    levelIndex = np.searchsorted(aqiLo, aqi, side='right') - 1
+    valid = levelIndex >= 0
+    levelIndex = np.clip(levelIndex, 0, len(aqiLo) - 1)
+    valid &= aqi < aqiHi[levelIndex]
+
+    return np.where(valid, features[levelIndex], None)
+
+
+# NowCast: https://usepa.servicenowservices.com/airnow?id=kb_article_view&sysparm_article=KB0011856
+hoursInNowCast = 12
+nsPerHour = 3600 * 10**9
+
+
+def nowCastMatrix(hourlyAverages, minWeight=0.5):
+    """
+    Calculate NowCast concentrations from hourly averages using the EPA weighting.
+
+    Args:
+        hourlyAverages: 2D numpy array; one row per point in time, one column per hour back (column 0 is the most recent hour). NaN for hours without data.
+        minWeight: lower limit of the weight factor; 0.5 for particulate matter
+
+    Returns:
+        numpy array of NowCast concentrations (NaN where fewer than 2 of the 3 most recent hours have data)
+    """
+    valid = ~np.isnan(hourlyAverages)
+    enoughData = valid[:, :3].sum(axis=1) >= 2
+
+    hourlyMax = np.where(valid, hourlyAverages, -np.inf).max(axis=1)
+    hourlyMin = np.where(valid, hourlyAverages, np.inf).min(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(hourlyMax > 0, hourlyMin / hourlyMax, 1.0)
+        weight = np.clip(weight, minWeight, 1.0)
+
+        powers = np.where(
+            valid, weight[:, None] ** np.arange(hourlyAverages.shape[1]), 0)
+        nowCast = (powers * np.where(valid, hourlyAverages, 0)
+                   ).sum(axis=1) / powers.sum(axis=1)
+
+    return np.where(enoughData, nowCast, np.nan)
+
+
+def nowCastArray(ts, pollutantConcentrations, minWeight=0.5):
+    """
+    Calculate NowCast at each reading of one sensor's history at once. The current hour's average only includes readings up to and including each reading, as when streaming.
+
+    Args:
+        ts: numpy int64 array of reading times in ns since epoch, sorted ascending
+        pollutantConcentrations: array-like of concentrations [µg/m3]; NaN for missing readings
+
+    Returns:
+        numpy array of NowCast concentrations
+    """
+    hours = np.asarray(ts) // nsPerHour
+    concentrations = np.asarray(pollutantConcentrations, dtype='float64')
+    valid = ~np.isnan(concentrations)
+
+    readings = pd.DataFrame({'hour': hours,
+                             'sum': np.where(valid, concentrations, 0),
+                             'count': valid.astype('int64')})
+
+    hourly = readings.groupby('hour')[['sum', 'count']].sum()
+    hourlyAverage = (hourly['sum'] / hourly['count'].where(hourly['count'] > 0))
+
+    # Average of the current hour so far at each reading.
+    running = readings.groupby('hour')[['sum', 'count']].cumsum()
+
+    matrix = np.empty((len(hours), hoursInNowCast))
+    matrix[:, 0] = (running['sum'] /
+                    running['count'].where(running['count'] > 0)).to_numpy()
+    for hoursBack in range(1, hoursInNowCast):
+        matrix[:, hoursBack] = hourlyAverage.reindex(
+            hours - hoursBack).to_numpy()
+
+    return nowCastMatrix(matrix, minWeight)
+
+
+class NowCastCalculator(object):
+    """
+    Streaming NowCast for one pollutant. Each reading is added to its sensor's accumulator for its clock hour, so updates don't re-scan 12 hours of readings.
+
+    A late reading, older than the sensor's newest, gets the NowCast of its own hour, from the hours before it that are still held. Its hour's average includes the readings of that hour received so far, and readings more than 12 hours older than the newest get NaN.
+    """
+
+    def __init__(self, minWeight=0.5):
+        self.minWeight = minWeight
+        # Sensor id -> most recent hour seen and running sums and counts for the last 12 hours, indexed by hour % 12.
+        self.sensors = dict()
+
+    def reset(self, sensorId):
+        self.sensors.pop(sensorId, None)
+
+    def update(self, sensorId, ts, pollutantConcentration):
+        """
+        Add a reading and get the sensor's NowCast.
+
+        Args:
+            sensorId: str
+            ts: tz-aware datetime of the reading
+            pollutantConcentration: concentration [µg/m3]; numeric or None
+
+        Returns:
+            NowCast concentration as of the reading's hour (NaN if there isn't enough recent data)
+        """
+        hour = int(ts.timestamp()) // 3600
+
+        state = self.sensors.get(sensorId)
+        if state is None:
+            state = {'hour': hour,
+                     'sums': [0.0] * hoursInNowCast,
+                     'counts': [0] * hoursInNowCast}
+            self.sensors[sensorId] = state
+
+        if hour > state['hour']:
+            # Clear accumulators of hours that have dropped out of the window.
+            for staleHour in range(state['hour'] + 1, min(hour, state['hour'] + hoursInNowCast) + 1):
+                state['sums'][staleHour % hoursInNowCast] = 0.0
+                state['counts'][staleHour % hoursInNowCast] = 0
+            state['hour'] = hour
+
+        if pollutantConcentration is not None:
+            pollutantConcentration = float(pollutantConcentration)
+
+        validReading = pollutantConcentration is not None and not np.isnan(
+            pollutantConcentration)
+
+        if validReading and hour > state['hour'] - hoursInNowCast:
+            state['sums'][hour % hoursInNowCast] += pollutantConcentration
+            state['counts'][hour % hoursInNowCast] += 1
+
+        return self.current(sensorId, hour)
+
+    def current(self, sensorId, hour=None):
+        """
+        NowCast of a sensor as of an hour since epoch, by default its most recent.
+        """
+        state = self.sensors.get(sensorId)
+        if state is None:
+            return np.nan
+        if hour is None:
+            hour = state['hour']
+
+        hourlyAverages = []
+        for hoursBack in range(hoursInNowCast):
+            # Slots hold only the 12 hours up to the most recent one.
+            held = hour - hoursBack > state['hour'] - hoursInNowCast
+            slot = (hour - hoursBack) % hoursInNowCast
+            hourlyAverages.append(state['sums'][slot] / state['counts'][slot]
+                                  if held and state['counts'][slot] else np.nan)
+
+        return nowCastMatrix(np.array([hourlyAverages]), self.minWeight)[0]
@@ -0,0 +1,299 @@
+
+"""
+Recompute stored AQI values after the EPA revises its breakpoints.
+
+Every AQI column computed from a concentration is recomputed from aqi_breakpoints.csv: AQI of PM 2.5 (including the value reported by the sensor), PM 10.0 and EPA-corrected PM 2.5 with their colors, descriptions and messages, NowCast AQI, 24-hour average AQI and hours above the AQI threshold. History is split into time chunks that a pool of processes recomputes in parallel. Each chunk is loaded into a staging table and applied with one UPDATE, committed together with a row in aqi_recompute_progress, so an interrupted run picks up where it left off:
+
+    python aqi_recompute.py --processes 4 --chunk-days 7
+
+Runs are identified by the contents of the breakpoint and description files, so a run after another revision starts over. Use --restart to recompute everything again anyway.
+"""
+
+
+import argparse
+import csv
+import hashlib
+import io
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import aqi  # Calculating AQI.
+import change_events as ce
+import derivations as dv
+import shared_cache as sc
+import structured_logging as slog
+import summaries  # Hourly and daily summaries.
+import user_settings as us
+import window_stats as ws
+
+
+log = slog.getLogger(__name__)
+
+# AQI columns computed directly from a concentration: AQI column -> (concentration column, pollutant, rounding).
+directSpecies = {
+    'pm_2_5_aqi': ('pm_2_5_um_m3', 'PM2.5 - Local Conditions', 1),
+    'pm_10_0_aqi': ('pm_10_0_um_m3', 'PM10 Total 0-10um STP', 0),
+    'pm_2_5_epa_aqi': ('pm_2_5_epa_um_m3', 'PM2.5 - Local Conditions', 1)}
+
+# NowCast AQI columns: AQI column -> (concentration column, pollutant, rounding).
+nowCastSpecies = {
+    'pm_2_5_nowcast_aqi': ('pm_2_5_um_m3', 'PM2.5 - Local Conditions', 1),
+    'pm_10_0_nowcast_aqi': ('pm_10_0_um_m3', 'PM10 Total 0-10um STP', 0)}
+
+# Window statistics that depend on breakpoints.
+windowColumns = ['pm_2_5_24h_aqi', 'hours_above_aqi_threshold_24h']
+
+inputColumns = ['sensor_id', 'pm_2_5_um_m3', 'pm_10_0_um_m3', 'pm_2_5_epa_um_m3', 'temp_f_corrected']
+
+# Recomputed columns and their PostgreSQL types.
+outputTypes = dict(
+    [(column, 'numeric') for column in directSpecies] +
+    [('{}_{}'.format(species, feature), 'text') for species in directSpecies for feature in dv.aqiFeatures] +
+    [(column, 'numeric') for column in nowCastSpecies] +
+    [(column, 'numeric') for column in windowColumns])
+
+# Readings before a chunk needed to compute its first values. Window statistics look back furthest.
+lookback = max(ws.window, pd.Timedelta(hours=aqi.hoursInNowCast))
+
+# Per-process state set up by initWorker.
+worker = dict()
+
+
+def jobId(breakpointsFile, descriptionsFile):
+    """
+    Identify a recompute run by the breakpoints and descriptions it uses.
+    """
+    digest = hashlib.sha1()
+    for path in (breakpointsFile, descriptionsFile):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()[:16]
+
+
+def loadTables(breakpointsFile, descriptionsFile):
+    breakpoints = {pollutant: aqi.loadAqiBreakpoints(breakpointsFile, pollutant=pollutant)
+                   for pollutant in {spec[1] for spec in list(directSpecies.values()) + list(nowCastSpecies.values())}}
+
+    return breakpoints, aqi.loadAqiDescriptiveInfo(descriptionsFile)
+
+
+def recomputeRecords(records, breakpoints, descriptions):
+    """
+    Recompute AQI columns for a dataframe of stored readings.
+
+    Args:
+        records: pandas dataframe with measurement_ts and inputColumns, sorted by time, starting at least `lookback` before the first reading to keep
+        breakpoints: dict of pollutant -> breakpoints dataframe
+        descriptions: pandas dataframe, as read in from aqi_colors_messages.csv
+
+    Returns:
+        the same dataframe with outputTypes columns added
+    """
+    for column in inputColumns[1:]:
+        records[column] = pd.to_numeric(records[column], errors='coerce')
+
+    for column, (source, pollutant, decimals) in directSpecies.items():
+        records[column] = aqi.getAqiArray(records[source], breakpoints[pollutant], decimals)
+
+        for feature, descriptionColumn in dv.aqiFeatures.items():
+            records['{}_{}'.format(column, feature)] = aqi.getAqiDescriptiveFeatureArray(
+                descriptions, descriptionColumn, records[column])
+
+    dv.nowCastHistory(records, {column: (source, breakpoints[pollutant], decimals)
+                                for column, (source, pollutant, decimals) in nowCastSpecies.items()})
+
+    return ws.windowHistory(records, breakpoints=breakpoints['PM2.5 - Local Conditions'])
+
+
+def stageCsv(records):
+    """
+    Write recomputed values as CSV for COPY. Empty unquoted fields are read as NULL.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for row in records[['sensor_id', 'measurement_ts'] + list(outputTypes)].itertuples(index=False):
+        writer.writerow(['' if value is None or (isinstance(value, float) and np.isnan(value)) else
+                         value.isoformat() if hasattr(value, 'isoformat') else value
+                         for value in row])
+
+    buffer.seek(0)
+    return buffer
+
+
+def initWorker(databaseUrl, breakpointsFile, descriptionsFile):
+    worker['conn'] = psycopg2.connect(databaseUrl)
+    worker['breakpoints'], worker['descriptions'] = loadTables(breakpointsFile, descriptionsFile)
+
+
+def recomputeChunk(job, chunkStart, chunkEnd):
+    """
+    Recompute and store one chunk of history in a worker process.
+
+    Returns:
+        (chunk start, number of rows updated)
+    """
+    conn = worker['conn']
+    cur = conn.cursor()
+
+    try:
+        cur.execute("SELECT measurement_ts, {} FROM sensor_data WHERE measurement_ts >= %s AND measurement_ts < %s "
+                    "ORDER BY measurement_ts ASC ".format(', '.join(inputColumns)),
+                    ((chunkStart - lookback).to_pydatetime(), chunkEnd.to_pydatetime()))
+        records = pd.DataFrame([tuple(row) for row in cur.fetchall()],
+                               columns=['measurement_ts'] + inputColumns)
+
+        records = recomputeRecords(records, worker['breakpoints'], worker['descriptions'])
+        records = records[pd.to_datetime(records['measurement_ts'], utc=True) >= chunkStart]
+
+        cur.execute("CREATE TEMP TABLE aqi_recompute_stage (sensor_id text, measurement_ts timestamptz, {}, "
+                    "PRIMARY KEY (sensor_id, measurement_ts)) ON COMMIT DROP ".format(', '.join('{} {}'.format(column, columnType)
+                                                       for column, columnType in outputTypes.items())))
+        # Readings without a sensor ID are keyed by '', which CSV would otherwise read as NULL.
+        cur.copy_expert("COPY aqi_recompute_stage FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (sensor_id)) ",
+                        stageCsv(records))
+
+        cur.execute("UPDATE sensor_data SET {} FROM aqi_recompute_stage AS stage "
+                    "WHERE sensor_data.sensor_id = stage.sensor_id "
+                    "AND sensor_data.measurement_ts = stage.measurement_ts ".format(
+                        ', '.join('{0} = stage.{0}'.format(column) for column in outputTypes)))
+        rows = cur.rowcount
+
+        cur.execute("INSERT INTO aqi_recompute_progress (job_id, chunk_start, chunk_end, rows_updated) "
+                    "VALUES (%s, %s, %s, %s) ",
+                    (job, chunkStart.to_pydatetime(), chunkEnd.to_pydatetime(), rows))
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    return chunkStart, rows
+
+
+def recomputeChunkTask(task):
+    return recomputeChunk(*task)
+
+
+def covered(chunkStart, chunkEnd, finished):
+    """
+    Whether finished chunks cover all of a chunk, e.g. ones of a run with a different chunk size.
+
+    Args:
+        finished: list of (start, end) tuples of finished chunks, sorted by start
+    """
+    reached = chunkStart
+    for start, end in finished:
+        if start > reached:
+            return False
+
+        reached = max(reached, end)
+        if reached >= chunkEnd:
+            return True
+
+    return False
+
+
+def chunkBounds(first, last, chunk):
+    chunkStart = pd.Timestamp(first).tz_convert('UTC').normalize()
+    last = pd.Timestamp(last)
+
+    while chunkStart <= last:
+        yield chunkStart, chunkStart + chunk
+        chunkStart = chunkStart + chunk
+
+
+def recompute(conn, processes=None, chunk=pd.Timedelta(days=7), breakpointsFile='aqi_breakpoints.csv',
+              descriptionsFile='aqi_colors_messages.csv', restart=False, databaseUrl=us.databaseUrl):
+    """
+    Recompute AQI columns for all stored readings, skipping chunks that previous runs of the same job finished, whatever their chunk size.
+
+    Args:
+        conn: psycopg2 connection
+        processes: int or None; worker processes. Defaults to the number of CPUs.
+        chunk: pandas Timedelta; time span recomputed per task and transaction
+        restart: bool; forget finished chunks and recompute everything
+
+    Returns:
+        number of rows updated
+    """
+    job = jobId(breakpointsFile, descriptionsFile)
+    cur = conn.cursor()
+
+    cur.execute("SELECT MIN(measurement_ts), MAX(measurement_ts) FROM sensor_data ")
+    first, last = cur.fetchone()
+
+    if first is None:
+        log.info('no data in sensor_data, nothing to recompute')
+        return 0
+
+    if restart:
+        cur.execute("DELETE FROM aqi_recompute_progress WHERE job_id = %s ", (job,))
+    cur.execute("SELECT chunk_start, chunk_end FROM aqi_recompute_progress WHERE job_id = %s "
+                "ORDER BY chunk_start ASC ", (job,))
+    finished = [(pd.Timestamp(start).tz_convert('UTC'), pd.Timestamp(end).tz_convert('UTC'))
+                for start, end in cur.fetchall()]
+    conn.commit()
+
+    chunks = list(chunkBounds(first, last, chunk))
+    tasks = [(job, chunkStart, chunkEnd) for chunkStart, chunkEnd in chunks
+             if not covered(chunkStart, chunkEnd, finished)]
+
+    log.info('recomputing AQI', extra={'fields': {
+        'job_id': job, 'chunks': len(chunks), 'pending': len(tasks), 'processes': processes or os.cpu_count()}})
+
+    started = time.perf_counter()
+    skipped = done = len(chunks) - len(tasks)
+    total = 0
+
+    with multiprocessing.Pool(processes, initializer=initWorker,
+                              initargs=(databaseUrl, breakpointsFile, descriptionsFile)) as pool:
+        for chunkStart, rows in pool.imap_unordered(recomputeChunkTask, tasks):
+            done += 1
+            total += rows
+            elapsed = time.perf_counter() - started
+
+            log.info('recomputed AQI chunk', extra={'fields': {
+                'job_id': job, 'start': chunkStart.date(), 'rows': rows,
+                'done': done, 'chunks': len(chunks),
+                'eta_s': round(elapsed / (done - skipped) * (len(chunks) - done))}})
+
+    summaries.rebuild(cur)
+    conn.commit()
+
+    dv.reexportArchive(conn, first)
+
+    # Drop cached results in every process, and have them reload their hot tiers, which hold the old values.
+    sc.cache.bump('sensor')
+    ce.notify(cur, 'sensor', recomputed=job)
+    conn.commit()
+    cur.close()
+
+    log.info('recomputed AQI', extra={'fields': {'job_id': job, 'rows': total}})
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute stored AQI values from the AQI breakpoints.')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes; defaults to the number of CPUs')
+    parser.add_argument('--chunk-days', type=float, default=7,
+                        help='days of history recomputed per task')
+    parser.add_argument('--breakpoints', default='aqi_breakpoints.csv')
+    parser.add_argument('--descriptions', default='aqi_colors_messages.csv')
+    parser.add_argument('--restart', action='store_true',
+                        help='recompute chunks finished by an earlier run too')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(us.databaseUrl)
+    recompute(conn, args.processes, pd.Timedelta(days=args.chunk_days),
+              args.breakpoints, args.descriptions, args.restart)
+    conn.close()
@@ -0,0 +1,250 @@
+
+"""
+Tools for moving closed months of sensor and weather data into a local Parquet archive and reading them back.
+
+Run directly to archive every closed month that isn't archived yet:
+    python archive_management.py
+"""
+
+
+import json
+import os
+
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import user_settings as us
+import structured_logging as slog
+
+
+# Tables that can be archived, with the timestamp column each is partitioned on.
+archivedTables = {'sensor_data': 'measurement_ts', 'weather_data': 'ts'}
+
+# PostgreSQL type code for `numeric` columns, returned as Decimal by psycopg2.
+NUMERIC_TYPE_CODE = 1700
+
+# Rows per Parquet row group. About a week of 2-minute readings, so column statistics can prune within a month.
+rowGroupSize = 5000
+
+manifestName = 'manifest.json'
+
+log = slog.getLogger(__name__)
+
+# Manifest contents cached by file modification time.
+manifestCache = {'mtime': None, 'manifest': {}}
+
+
+def monthPath(archiveDir, tableName, monthStart):
+    return os.path.join(archiveDir, tableName, '{}.parquet'.format(monthStart.strftime('%Y-%m')))
+
+
+def loadManifest(archiveDir):
+    """
+    Read the archive manifest, which records how far each table has been archived.
+
+    Args:
+        archiveDir: path to archive directory; str
+
+    Returns:
+        dict of table name -> exclusive upper bound of archived data (tz-aware pandas Timestamp)
+    """
+    path = os.path.join(archiveDir, manifestName)
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+
+    if manifestCache['mtime'] != mtime:
+        with open(path) as f:
+            manifest = json.load(f)
+
+        manifestCache['manifest'] = {tableName: pd.Timestamp(through)
+                                     for tableName, through in manifest.items()}
+        manifestCache['mtime'] = mtime
+
+    return manifestCache['manifest']
+
+
+def saveManifest(archiveDir, manifest):
+    path = os.path.join(archiveDir, manifestName)
+    tmpPath = path + '.tmp'
+
+    with open(tmpPath, 'w') as f:
+        json.dump({tableName: through.isoformat()
+                   for tableName, through in manifest.items()}, f)
+
+    os.replace(tmpPath, path)
+
+
+def archivedThrough(tableName, archiveDir=us.archiveDir):
+    """
+    Get the point before which all of a table's data can be read from the archive.
+
+    Args:
+        tableName: str
+
+    Returns:
+        tz-aware pandas Timestamp, or None if the table has no archived months
+    """
+    if not archiveDir:
+        return None
+
+    return loadManifest(archiveDir).get(tableName)
+
+
+def archiveMonth(conn, archiveDir, tableName, monthStart):
+    """
+    Export one month of a table to a Parquet file.
+
+    Args:
+        conn: psycopg2 connection
+        archiveDir: path to archive directory; str
+        tableName: str; key of archivedTables
+        monthStart: tz-aware pandas Timestamp at the start of the month
+
+    Returns:
+        number of rows archived
+    """
+    tsColumn = archivedTables[tableName]
+    monthEnd = monthStart + pd.DateOffset(months=1)
+
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM {} WHERE {} >= %s AND {} < %s ORDER BY {} ASC ".format(
+        tableName, tsColumn, tsColumn, tsColumn),
+        (monthStart.to_pydatetime(), monthEnd.to_pydatetime()))
+
+    columns = [desc[0] for desc in cur.description]
+    numericColumns = [desc[0] for desc in cur.description
+                      if desc[1] == NUMERIC_TYPE_CODE]
+
+    records = pd.DataFrame([tuple(row) for row in cur.fetchall()], columns=columns)
+    cur.close()
+
+    # Store numeric columns as floats and timestamps in UTC so the files can be scanned without conversion.
+    for column in numericColumns:
+        records[column] = pd.to_numeric(records[column]).astype('float64')
+    records[tsColumn] = pd.to_datetime(records[tsColumn], utc=True)
+
+    path = monthPath(archiveDir, tableName, monthStart)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = path + '.tmp'
+
+    pq.write_table(pa.Table.from_pandas(records, preserve_index=False), tmpPath,
+                   row_group_size=rowGroupSize, compression='snappy',
+                   write_statistics=True)
+    os.replace(tmpPath, path)
+
+    return len(records)
+
+
+def archiveClosedMonths(conn, archiveDir=us.archiveDir):
+    """
+    Export every closed month (any month before the current one) that isn't already archived.
+
+    Archived rows are left in the database; readers only stop querying them once the manifest moves past them.
+
+    Args:
+        conn: psycopg2 connection
+        archiveDir: path to archive directory; str
+
+    Returns:
+        NULL
+    """
+    if not archiveDir:
+        raise Exception(
+            'Archive directory not provided. Please set environment variable ARCHIVE_DIR to a persistent storage path.')
+
+    os.makedirs(archiveDir, exist_ok=True)
+
+    manifest = dict(loadManifest(archiveDir))
+    currentMonth = pd.Timestamp.now(tz='UTC').normalize().replace(day=1)
+
+    for tableName, tsColumn in archivedTables.items():
+        monthStart = manifest.get(tableName)
+
+        if monthStart is None:
+            cur = conn.cursor()
+            cur.execute("SELECT MIN({}) FROM {} ".format(tsColumn, tableName))
+            earliest = cur.fetchone()[0]
+            cur.close()
+
+            if earliest is None:
+                log.info('no data in %s, nothing to archive', tableName)
+                continue
+
+            monthStart = pd.Timestamp(earliest).tz_convert(
+                'UTC').normalize().replace(day=1)
+
+        while monthStart < currentMonth:
+            rowCount = archiveMonth(conn, archiveDir, tableName, monthStart)
+            log.info('archived month', extra={'fields': {
+                'table': tableName, 'month': monthStart.strftime('%Y-%m'), 'rows': rowCount}})
+
+            monthStart = monthStart + pd.DateOffset(months=1)
+            manifest[tableName] = monthStart
+            saveManifest(archiveDir, manifest)
+
+    conn.rollback()  # End read-only transaction.
+
+
+def readArchive(tableName, columns, start=None, end=None, archiveDir=us.archiveDir, equals=None):
+    """
+    Read archived rows of a table within a time range.
+
+    Only monthly files overlapping the range are opened, and row groups outside it are skipped using column statistics.
+
+    Args:
+        tableName: str; key of archivedTables
+        columns: list of str; columns to read, including the timestamp column
+        start: tz-aware pandas Timestamp or None; inclusive lower bound
+        end: tz-aware pandas Timestamp or None; exclusive upper bound
+        equals: dict of column -> value rows must have. Files archived before a column existed are read in full.
+
+    Returns:
+        pandas dataframe sorted by time, newest first
+    """
+    tsColumn = archivedTables[tableName]
+    tableDir = os.path.join(archiveDir, tableName)
+
+    filters = []
+    if start is not None:
+        filters.append((tsColumn, '>=', start.tz_convert('UTC')))
+    if end is not None:
+        filters.append((tsColumn, '<', end.tz_convert('UTC')))
+
+    firstMonth = start.tz_convert('UTC').strftime('%Y-%m') if start is not None else ''
+    lastMonth = end.tz_convert('UTC').strftime('%Y-%m') if end is not None else '9999-12'
+
+    try:
+        fileNames = sorted(os.listdir(tableDir))
+    except OSError:
+        fileNames = []
+
+    frames = []
+    for fileName in fileNames:
+        if not fileName.endswith('.parquet') or not firstMonth <= fileName[:7] <= lastMonth:
+            continue
+
+        path = os.path.join(tableDir, fileName)
+        fileFilters = list(filters)
+        if equals:
+            fileColumns = pq.read_schema(path).names
+            fileFilters += [(column, '=', value) for column, value in equals.items()
+                            if column in fileColumns]
+
+        frames.append(pq.read_table(path, columns=columns,
+                                    filters=fileFilters or None).to_pandas())
+
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    records = pd.concat(frames, ignore_index=True)
+
+    return records.sort_values(tsColumn, ascending=False, ignore_index=True)
+
+
+if __name__ == '__main__':
+    archiveClosedMonths(psycopg2.connect(us.databaseUrl))
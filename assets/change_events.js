@@ -0,0 +1,39 @@
+// Refresh the dashboard when the server reports new data.
+// Each event clicks a hidden button that the plot and forecast callbacks listen to.
+(function () {
+    if (!window.EventSource) {
+        return;
+    }
+
+    // Bursts of events (e.g. a backlog of readings) trigger one refresh.
+    var debounceMs = 1000;
+    var pending = {};
+
+    function refresh(kind) {
+        if (pending[kind]) {
+            return;
+        }
+        pending[kind] = setTimeout(function () {
+            pending[kind] = null;
+            var button = document.getElementById(kind + '-data-changed');
+            if (button) {
+                button.click();
+            }
+        }, debounceMs);
+    }
+
+    var connected = false;
+    var source = new EventSource('/events');
+
+    source.addEventListener('sensor', function () { refresh('sensor'); });
+    source.addEventListener('weather', function () { refresh('weather'); });
+
+    source.onopen = function () {
+        // Pick up anything missed while the stream was down.
+        if (connected) {
+            refresh('sensor');
+            refresh('weather');
+        }
+        connected = true;
+    };
+})();
@@ -0,0 +1,169 @@
+// Unit and species toggles for the temperature, AQI and trend panels.
+// The server stores each panel's data for the selected date range (temp-data, aqi-data, trend-data);
+// these functions redraw the panels from it, so toggling never waits on the server.
+// The view functions record where time-series plots are zoomed (temp-view, humid-view, aqi-view),
+// so the server refetches what they show at a level of detail matching their width.
+
+// Zoomed x-axis range and pixel width of a plot after a relayout, tagged with the date selection it was zoomed under.
+// Null when the plot is reset to the whole range. Relayouts that don't change the x-axis, like the initial autosize, change nothing.
+var plotView = function (graphId, relayoutData, standardDate, customStart, customEnd) {
+    if (!relayoutData) {
+        return window.dash_clientside.no_update;
+    }
+    if (relayoutData['xaxis.autorange']) {
+        return null;
+    }
+
+    var range = relayoutData['xaxis.range'] ||
+        [relayoutData['xaxis.range[0]'], relayoutData['xaxis.range[1]']];
+    if (typeof range[0] !== 'string' || typeof range[1] !== 'string') {
+        return window.dash_clientside.no_update;
+    }
+
+    var graph = document.getElementById(graphId);
+    return {
+        selection: [standardDate, customStart, customEnd],
+        range: range,
+        width: graph ? graph.offsetWidth : null
+    };
+};
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    airdash: {
+        tempView: function (relayoutData, standardDate, customStart, customEnd) {
+            return plotView('temp-vs-time', relayoutData, standardDate, customStart, customEnd);
+        },
+
+        humidView: function (relayoutData, standardDate, customStart, customEnd) {
+            return plotView('humid-vs-time', relayoutData, standardDate, customStart, customEnd);
+        },
+
+        aqiView: function (relayoutData, standardDate, customStart, customEnd) {
+            return plotView('aqi-vs-time', relayoutData, standardDate, customStart, customEnd);
+        },
+
+        // Temperature plot and statements in the selected unit. Stored values are in °F.
+        temperaturePanel: function (data, tempUnit) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+
+            var celsius = tempUnit === 'temp_c';
+            var convert = function (value) {
+                if (value === null || value === undefined) {
+                    return value;
+                }
+                return celsius ? (value - 32) * (5 / 9) : value;
+            };
+
+            var figure = JSON.parse(JSON.stringify(data.figure));
+            figure.data.forEach(function (trace) {
+                if (trace.y) {
+                    trace.y = Array.prototype.map.call(trace.y, convert);
+                }
+            });
+            figure.layout.yaxis = Object.assign({}, figure.layout.yaxis, {
+                title: {text: celsius ? 'Temperature [°C]' : 'Temperature [°F]'}
+            });
+
+            var format = function (value, digits) {
+                return value === null ? 'Unknown' : convert(value).toFixed(digits) + '°';
+            };
+
+            var extremes = data.extremes ?
+                format(data.extremes[0], 0) + ' / ' + format(data.extremes[1], 0) : 'Unknown';
+
+            return [figure,
+                'Current sensor temperature: ' + format(data.sensor, 0),
+                'Current outside temperature: ' + format(data.outside, 1),
+                "Today's sensor high/low: " + extremes];
+        },
+
+        // Trend heatmap, with temperatures in the selected unit. Stored temperatures are in °F.
+        trendPanel: function (data, tempUnit) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+
+            var figure = JSON.parse(JSON.stringify(data.figure));
+            if (data.temperature && tempUnit === 'temp_c') {
+                figure.data.forEach(function (trace) {
+                    if (trace.z) {
+                        trace.z = Array.prototype.map.call(trace.z, function (value) {
+                            return value === null ? null : (value - 32) * (5 / 9);
+                        });
+                    }
+                    trace.colorbar = Object.assign({}, trace.colorbar, {
+                        title: {text: 'Temperature [°C]'}
+                    });
+                });
+            }
+
+            return figure;
+        },
+
+        // AQI plot with the selected species, color bands up to the highest value shown, and the warning of whichever selected species has the highest current AQI.
+        aqiPanel: function (data, aqiSpecies) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+
+            // Default to showing PM 2.5.
+            var species = aqiSpecies && aqiSpecies.length ? aqiSpecies : ['pm_2_5_aqi'];
+
+            var figure = JSON.parse(JSON.stringify(data.figure));
+            var yBound = 0;
+            var bands = [];
+
+            figure.data.forEach(function (trace) {
+                var meta = trace.meta || {};
+                if (meta.species) {
+                    trace.visible = species.indexOf(meta.species) >= 0;
+                    if (trace.visible && meta.series === 'measured' && trace.y) {
+                        Array.prototype.forEach.call(trace.y, function (value) {
+                            if (value !== null && value > yBound) {
+                                yBound = value;
+                            }
+                        });
+                    }
+                } else if (meta.band) {
+                    bands.push(trace);
+                }
+            });
+
+            if (bands.length) {
+                // Show bands up to the one that includes the max AQI value.
+                var bandTop = null;
+                bands.forEach(function (trace) {
+                    trace.visible = bandTop === null;
+                    if (bandTop === null && Math.floor(yBound) < trace.meta.band) {
+                        bandTop = trace.meta.band;
+                    }
+                });
+
+                // Past the last band's cutoff, cap y range at nearest hundred greater than max AQI value.
+                var lastCutoff = bands[bands.length - 1].meta.band;
+                figure.layout.yaxis = Object.assign({}, figure.layout.yaxis, {
+                    range: [0, bandTop !== lastCutoff ? bandTop : Math.round((yBound + 100) / 100) * 100]
+                });
+            }
+
+            var highest = null;
+            species.forEach(function (aqiType) {
+                var info = (data.latest || {})[aqiType];
+                if (info && info.aqi !== null && (highest === null || info.aqi > highest.aqi)) {
+                    highest = info;
+                }
+            });
+
+            if (highest === null) {
+                return [figure, '', {}, data.hoursAbove];
+            }
+
+            return [figure,
+                [highest.description, '.\r', highest.message],
+                {backgroundColor: highest.rgb},
+                data.hoursAbove];
+        }
+    }
+});
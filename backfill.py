@@ -0,0 +1,220 @@
+
+"""
+Fill recorded sensor gaps from local files, e.g. the CSV files a PurpleAir sensor writes to its SD card or earlier exports of this app.
+
+Only readings inside a gap in sensor_gaps are inserted, so files can overlap stored data freely. Afterwards NowCast and window statistics are recomputed from each filled gap to a day past it, and the gaps of the affected sensors are swept again:
+
+    python backfill.py 20200820.csv 20200821.csv
+
+SD card files are matched to gaps by the sensor MAC address they contain. Use --sensor for files without a sensor ID.
+"""
+
+
+import argparse
+import bisect
+import csv
+import gzip
+import json
+
+import pandas as pd
+import psycopg2
+from psycopg2 import extras
+
+import change_events as ce
+import derivations as dv
+import gaps  # Sensor gap index.
+import metrics  # Backfill counters.
+import payload_schema as ps  # Validating readings.
+import shared_cache as sc
+import structured_logging as slog
+import summaries  # Hourly and daily summaries.
+import user_settings as us
+import window_stats as ws
+
+
+log = slog.getLogger(__name__)
+
+# Columns of PurpleAir SD card files that have different payload keys. Other columns share the payload's names.
+sdCardKeys = {'UTCDateTime': 'DateTime', 'mac_address': 'SensorId', 'firmware_ver': 'version',
+              'hardware': 'hardwareversion', 'pm2.5_aqi_atm': 'pm2.5_aqi'}
+
+# Payload keys of sensor_data columns, for files exported by this app.
+exportKeys = {field['column']: field['key'] for field in ps.fields}
+
+batchRows = 1000
+
+
+def readRecords(path):
+    """
+    Read rows of a CSV or NDJSON file, optionally gzipped.
+
+    Returns:
+        iterator of dicts of column -> value. Empty CSV fields are None.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rt', newline='') as f:
+        if path.endswith(('.ndjson', '.ndjson.gz')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for record in csv.DictReader(f):
+                yield {column: value if value != '' else None for column, value in record.items()}
+
+
+def toPayload(record, sensorId=None):
+    """
+    Convert a file row into a sensor payload.
+    """
+    keys = exportKeys if 'measurement_ts' in record else sdCardKeys
+
+    # Keys the file doesn't have are stored as NULL.
+    payload = dict.fromkeys(ps.transformer.keys)
+    payload.update({keys.get(column, column): value for column, value in record.items()})
+    if sensorId is not None:
+        payload['SensorId'] = sensorId
+
+    return payload
+
+
+class GapIndex(object):
+    """
+    Recorded gaps by sensor, for testing whether readings fall in one.
+    """
+
+    def __init__(self, rows):
+        self.gaps = dict()  # Sensor ID -> (list of gap starts, list of gap ends), by start
+        for sensorId, gapStart, gapEnd in rows:
+            starts, ends = self.gaps.setdefault(sensorId, ([], []))
+            starts.append(pd.Timestamp(gapStart))
+            ends.append(pd.Timestamp(gapEnd))
+
+    def find(self, sensorId, ts):
+        """
+        Returns:
+            (gap start, gap end) of the gap containing ts, or None
+        """
+        if sensorId not in self.gaps:
+            return None
+
+        starts, ends = self.gaps[sensorId]
+        index = bisect.bisect_left(starts, ts) - 1
+        if index >= 0 and ts < ends[index]:
+            return starts[index], ends[index]
+        return None
+
+
+def insertRows(cur, rows):
+    """
+    Insert backfilled rows with their derived values. NowCast and window statistics are recomputed afterwards.
+
+    Returns:
+        list of inserted rows
+    """
+    for row, derived in zip(rows, dv.deriveRows(rows)):
+        row.update(derived)
+
+    columns = tuple(rows[0])
+    inserted = {tuple(key) for key in extras.execute_values(
+        cur,
+        "INSERT INTO sensor_data ({}) VALUES %s ON CONFLICT DO NOTHING RETURNING sensor_id, measurement_ts ".format(
+            ', '.join(columns)),
+        [tuple(row[column] for column in columns) for row in rows], page_size=len(rows), fetch=True)}
+
+    rows = [row for row in rows if (row['sensor_id'], row['measurement_ts']) in inserted]
+    summaries.add(cur, rows)
+
+    return rows
+
+
+def mergeRanges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def backfill(conn, paths, sensorId=None):
+    """
+    Insert readings from files that fall in recorded gaps.
+
+    Args:
+        conn: psycopg2 connection
+        paths: list of str; CSV or NDJSON files
+        sensorId: str or None; sensor ID of readings in files without one
+
+    Returns:
+        number of readings inserted
+    """
+    cur = conn.cursor()
+    index = GapIndex(gaps.fetchGaps(cur))
+    conn.commit()
+
+    pending = []
+    filled = set()  # (sensor ID, gap start, gap end)
+    total = skipped = invalid = 0
+
+    def flush():
+        nonlocal total
+        if pending:
+            total += len(insertRows(cur, pending))
+            conn.commit()
+            pending.clear()
+
+    for path in paths:
+        for record in readRecords(path):
+            try:
+                row = ps.transformer.row(ps.transformer(toPayload(record, sensorId)))
+            except ps.PayloadError as e:
+                log.warning('skipped invalid reading: %s', e, extra={'fields': {'file': path}, 'sample': 100})
+                invalid += 1
+                continue
+
+            key = row['sensor_id'] or ''
+            gap = index.find(key, pd.Timestamp(row['measurement_ts']))
+            if gap is None:
+                skipped += 1
+                continue
+
+            filled.add((key,) + gap)
+            pending.append(row)
+            if len(pending) >= batchRows:
+                flush()
+
+        log.info('read backfill file', extra={'fields': {'file': path}})
+
+    flush()
+
+    if total:
+        # Readings after each gap were computed without the readings in it.
+        for start, end in mergeRanges([(gapStart, gapEnd + ws.window) for key, gapStart, gapEnd in filled]):
+            dv.recomputeHistory(conn, start=start, end=end)
+
+        gaps.sweep(cur, sorted({key for key, gapStart, gapEnd in filled}))
+
+        # Drop cached results in every process, and have them reload their hot tiers, which lack the filled readings.
+        sc.cache.bump('sensor')
+        ce.notify(cur, 'sensor', backfilled=total)
+        conn.commit()
+
+    cur.close()
+
+    metrics.increment('sensor_rows_backfilled', total)
+    log.info('backfilled sensor gaps', extra={'fields': {
+        'rows': total, 'gaps': len(filled), 'outside_gaps': skipped, 'invalid': invalid}})
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill sensor gaps from SD card or exported files.')
+    parser.add_argument('files', nargs='+', help='CSV or NDJSON files, optionally gzipped')
+    parser.add_argument('--sensor', help='sensor ID of readings in files without one')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(us.databaseUrl)
+    backfill(conn, args.files, args.sensor)
+    conn.close()
@@ -0,0 +1,128 @@
+
+"""
+Fan out database change notifications to open dashboards.
+
+Ingest sends a PostgreSQL NOTIFY on `notifyChannel` whenever it commits new sensor or weather data. Each app process LISTENs on one dedicated connection and forwards notifications to its browsers as server-sent events, so dashboards refresh only when there's new data.
+"""
+
+
+import json
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+
+import structured_logging as slog
+
+
+notifyChannel = 'airdash_updates'
+
+# Seconds between keepalive comments on idle event streams. Keeps proxies from closing them.
+keepaliveSeconds = 30
+
+log = slog.getLogger(__name__)
+
+
+class ChangeListener(object):
+    """
+    Background thread that LISTENs for change notifications and hands them to subscribers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        # Functions called with (kind, payload dict) for each notification.
+        self.callbacks = []
+        self.thread = None
+
+    def start(self, databaseUrl):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, args=(databaseUrl,), daemon=True)
+            self.thread.start()
+
+    def run(self, databaseUrl):
+        retrySeconds = 1
+
+        while True:
+            try:
+                conn = psycopg2.connect(databaseUrl)
+                conn.set_session(autocommit=True)
+                cur = conn.cursor()
+                cur.execute("LISTEN {} ".format(notifyChannel))
+                log.info('listening for database changes')
+                retrySeconds = 1
+
+                while True:
+                    # Wait for the connection to become readable, i.e. a notification arrives.
+                    if select.select([conn], [], [], keepaliveSeconds) == ([], [], []):
+                        continue
+
+                    conn.poll()
+                    while conn.notifies:
+                        notification = conn.notifies.pop(0)
+                        self.publish(json.loads(notification.payload))
+
+            except (psycopg2.Error, OSError, ValueError) as e:
+                log.error('change listener failed, retrying in %ss: %s', retrySeconds, e)
+                time.sleep(retrySeconds)
+                retrySeconds = min(retrySeconds * 2, 60)
+
+    def publish(self, payload):
+        kind = payload.get('kind')
+
+        for callback in self.callbacks:
+            callback(kind, payload)
+
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            subscriber.put((kind, payload))
+
+    def stream(self):
+        """
+        Generate a server-sent event stream of change notifications for one browser.
+
+        Yields:
+            str; event stream chunks
+        """
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.add(subscriber)
+
+        try:
+            yield 'retry: 5000\n\n'
+
+            while True:
+                try:
+                    kind, payload = subscriber.get(timeout=keepaliveSeconds)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                else:
+                    yield 'event: {}\ndata: {}\n\n'.format(kind, json.dumps(payload))
+
+        finally:
+            with self.lock:
+                self.subscribers.discard(subscriber)
+
+
+def notify(cur, kind, **payload):
+    """
+    Queue a change notification. PostgreSQL delivers it when the current transaction commits.
+
+    The notification also carries `lsn`, the primary's WAL position as of the write, so readers can tell when a replica has replayed it. Only the transaction's commit record follows it, so a replica at that position is at most that one record behind the write.
+
+    Args:
+        cur: psycopg2 cursor
+        kind: str; 'sensor' or 'weather'
+        payload: JSON-serializable values sent along with the notification
+    """
+    payload['kind'] = kind
+    cur.execute("SELECT pg_notify(%s, (%s::jsonb || jsonb_build_object('lsn', pg_current_wal_lsn()))::text) ",
+                (notifyChannel, json.dumps(payload)))
+
+
+listener = ChangeListener()
@@ -5,8 +5,32 @@ Tools for managing PostgreSQL database containing air sensor data.
 
 
 import psycopg2  # Manipulating PostgreSQL.
-import aqi  # Calculating AQI.
+import structured_logging as slog
+import psycopg2.pool
+import psycopg2.extensions
+from psycopg2 import extras
+import derivations  # Derived measurements computed at ingest time.
+import metrics  # Ingest counters.
+import window_stats as ws  # Sliding-window statistics computed at ingest time.
+import change_events as ce  # Notifying dashboards of new data.
+import weather_fetch as wf  # Weather location keys.
+import alerts  # Threshold alerts evaluated at ingest.
+import summaries  # Hourly and daily summaries updated at ingest.
+import payload_schema as ps  # Validating sensor payloads.
+import gaps  # Gap index maintained at ingest.
+import user_settings as us
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
 from datetime import datetime as dt
+from datetime import timezone
+
+
+log = slog.getLogger(__name__)
 
 
 def getCarefullyFromDict(d, key):
@@ -16,152 +40,590 @@ def getCarefullyFromDict(d, key):
         return None
 
 
-class AirDatabase(object):
+@lru_cache(maxsize=None)
+def insertSensorRowQuery(columns):
     """
-    Initializes and manipulates PostgreSQL database.
+    Build the INSERT statement for a row with the given columns. Values are passed as a tuple in column order. Repeated readings are skipped by the database instead of raising a unique violation.
+
+    Args:
+        columns: tuple of str
+
+    Returns:
+        str
     """
+    return "INSERT INTO sensor_data ({}) VALUES ({}) ON CONFLICT DO NOTHING".format(
+        ', '.join(columns), ', '.join(['%s'] * len(columns)))
 
-    def __init__(self, connection):
+
+class RecentKeyFilter(object):
+    """
+    Remembers the latest reading timestamps of each sensor so repeated readings can be dropped without a database round trip.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        # Sensor id -> (deque of timestamps in arrival order, set of the same timestamps).
+        self.recent = dict()
+        self.lock = threading.Lock()
+
+    def seen(self, sensorId, ts):
+        with self.lock:
+            entry = self.recent.get(sensorId)
+            return entry is not None and ts in entry[1]
+
+    def add(self, sensorId, ts):
+        with self.lock:
+            order, keys = self.recent.setdefault(sensorId, (deque(), set()))
+
+            if ts not in keys:
+                order.append(ts)
+                keys.add(ts)
+
+                if len(order) > self.size:
+                    keys.discard(order.popleft())
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """
+    No connection became free in time, or too many requests were already waiting for one.
+    """
+
+
+class PooledConnections(object):
+    """
+    Context-managed checkout for classes with the pool interface (getconn and putconn).
+    """
+
+    @contextmanager
+    def connection(self):
         """
-        Initialize empty database or establish connection to database of the same name.
+        Check out a connection, returning it to the pool however the block exits. Connections that broke during the block are closed rather than reused.
+
+        Yields:
+            psycopg2 connection
         """
-        self.conn = connection
-        self.cur = self.conn.cursor()
+        conn = self.getconn()
+        try:
+            yield conn
+        except psycopg2.extensions.QueryCanceledError:
+            # Cancelled or timed out. The connection still works.
+            self.putconn(conn)
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, close=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+
+        self.putconn(conn)
+
+
+class BlockingConnectionPool(PooledConnections):
+    """
+    Thread-safe connection pool whose checkouts wait for a free connection rather than failing while all are in use.
 
-        print('got cursor')
+    Connections are opened as needed, up to maxconn, and stay open between checkouts, with their session characteristics set once when they're opened. At most maxWaiting checkouts wait at a time, each for up to waitSeconds, after which PoolTimeout is raised. Connections idle for a while are checked before they're reused, and ones older than maxAgeSeconds are closed when returned.
+    """
 
+    def __init__(self, maxconn, *args, name='pool', session=None, waitSeconds=us.poolWaitSeconds,
+                 maxWaiting=us.poolMaxWaiting, maxAgeSeconds=us.poolMaxAgeSeconds, checkIdleSeconds=30, **kwargs):
+        """
+        Args:
+            maxconn: most connections open at once
+            args, kwargs: psycopg2.connect arguments
+            name: str; prefix of the pool's metrics
+            session: dict of set_session arguments, e.g. {'readonly': True}, or None
+            waitSeconds: how long a checkout waits for a free connection
+            maxWaiting: most checkouts waiting at once. Further ones fail right away.
+            maxAgeSeconds: age after which connections are closed rather than reused
+            checkIdleSeconds: idle time after which connections are checked before they're reused
+        """
+        self.maxconn = maxconn
+        self.connectArgs = args
+        self.connectKwargs = kwargs
+        self.name = name
+        self.session = session
+        self.waitSeconds = waitSeconds
+        self.maxWaiting = maxWaiting
+        self.maxAgeSeconds = maxAgeSeconds
+        self.checkIdleSeconds = checkIdleSeconds
+
+        self.condition = threading.Condition()
+        self.idle = []  # (connection, time returned), most recently returned last
+        self.openedAt = dict()  # id of open connection -> time opened
+        self.opening = 0  # Connections being opened
+        self.waiting = 0
+        self.closed = False
+
+    def available(self):
+        return bool(self.idle) or len(self.openedAt) + self.opening < self.maxconn
+
+    def open(self):
+        conn = psycopg2.connect(*self.connectArgs, **self.connectKwargs)
         try:
-            self.cur.execute("CREATE TABLE sensor_data ( "
-                             # Metadata
-                             "id numeric "
-                             ", sensor_id text "
-                             ", place text "
-                             ", version text "
-                             ", hardware_version text "
-                             ", uptime_s numeric CHECK (uptime_s >= 0) "
-                             ", rssi_dbm numeric "
-                             # Implied UNIQUE and NOT NULL constraint
-                             ", measurement_ts timestamptz PRIMARY KEY "
-
-                             # Environment data
-                             ", temp_f numeric "
-                             ", temp_c numeric "
-                             ", humidity numeric CHECK (humidity >= 0 AND humidity <= 100) "
-                             ", dewpoint_f numeric CHECK (dewpoint_f <= temp_f) "
-                             ", pressure_mbar numeric "
-
-                             # Air data
-                             ", pm_2_5_aqi numeric "
-                             ", pm_2_5_aqi_rgb text "
-                             ", pm_2_5_aqi_description text "
-                             ", pm_2_5_aqi_message text "
-
-                             ", pm_10_0_aqi numeric "
-                             ", pm_10_0_aqi_rgb text "
-                             ", pm_10_0_aqi_description text "
-                             ", pm_10_0_aqi_message text "
-
-                             ", pm_1_0_um_m3 numeric "
-                             ", pm_2_5_um_m3 numeric "
-                             ", pm_10_0_um_m3 numeric "
-
-                             ", p_0_3_count_dl numeric "
-                             ", p_0_5_count_dl numeric "
-                             ", p_1_0_count_dl numeric "
-                             ", p_2_5_count_dl numeric "
-                             ", p_5_0_count_dl numeric "
-                             ", p_10_0_count_dl numeric "
-                             ") ")
+            if self.session:
+                conn.set_session(**self.session)
+        except psycopg2.Error:
+            conn.close()
+            raise
 
-        except psycopg2.ProgrammingError as e:
-            # Table already exists. Roll back command.
-            print(e)
-            self.conn.rollback()
-        else:
-            print('created sensor_data table')
+        metrics.increment('{}_pool_connections_opened'.format(self.name))
+        return conn
 
-        # Create table of outside weather data.
+    def healthy(self, conn):
         try:
-            self.cur.execute("CREATE TABLE weather_data ("
-                             "id SERIAL " # Auto-incrementing
-                             ", ts timestamptz PRIMARY KEY " # Implied UNIQUE and NOT NULL constraint
-                             ", timezone text "
-                             ", ts_offset numeric "
-
-                             # Environment data
-                             ", temp_f numeric "
-                             ", temp_c numeric "
-                             ", temp_feels_like_f numeric "
-                             ", temp_feels_like_c numeric "
-                             ", humidity numeric CHECK (humidity >= 0 AND humidity <= 100) "
-                             ", dewpoint_f numeric CHECK (dewpoint_f <= temp_f) "
-                             ", pressure_mbar numeric "
-
-                             ")")
+            cur = conn.cursor()
+            cur.execute("SELECT 1 ")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            log.warning('discarding broken pooled connection: %s', e, extra={'fields': {'pool': self.name}})
+            return False
+
+    def discard(self, conn):
+        with self.condition:
+            self.openedAt.pop(id(conn), None)
+            self.condition.notify()
+
+        if not conn.closed:
+            conn.close()
+
+    def getconn(self, key=None):
+        """
+        Check out a connection, waiting for one to become free if all are in use.
 
-        except psycopg2.ProgrammingError as e:
-            # Table already exists. Roll back command.
-            print(e)
-            self.conn.rollback()
-        else:
-            print('created weather_data table')
+        Raises:
+            PoolTimeout if none became free in time or too many checkouts are waiting
+        """
+        start = time.monotonic()
+        deadline = start + self.waitSeconds
+
+        while True:
+            with self.condition:
+                if self.closed:
+                    raise psycopg2.pool.PoolError('connection pool is closed')
+
+                if not self.available():
+                    if self.waiting >= self.maxWaiting:
+                        metrics.increment('{}_pool_rejected'.format(self.name))
+                        raise PoolTimeout('{} checkouts already waiting for a connection'.format(self.waiting))
+
+                    metrics.increment('{}_pool_saturated'.format(self.name))
+                    self.waiting += 1
+                    try:
+                        freed = self.condition.wait_for(self.available, deadline - time.monotonic())
+                    finally:
+                        self.waiting -= 1
+
+                    if not freed:
+                        metrics.increment('{}_pool_timeouts'.format(self.name))
+                        log.warning('no pooled connection became free', extra={'fields': {
+                            'pool': self.name, 'wait_s': self.waitSeconds}})
+                        raise PoolTimeout('no connection became free within {} s'.format(self.waitSeconds))
+
+                if self.idle:
+                    conn, returnedAt = self.idle.pop()
+                else:
+                    conn, returnedAt = None, None
+                    self.opening += 1
+
+            if conn is None:
+                try:
+                    conn = self.open()
+                finally:
+                    with self.condition:
+                        self.opening -= 1
+                        if conn is not None:
+                            self.openedAt[id(conn)] = time.monotonic()
+                        self.condition.notify()
+
+            elif conn.closed or (time.monotonic() - returnedAt > self.checkIdleSeconds and not self.healthy(conn)):
+                metrics.increment('{}_pool_connections_broken'.format(self.name))
+                self.discard(conn)
+                continue
+
+            metrics.observe('{}_pool_wait_ms'.format(self.name), (time.monotonic() - start) * 1000)
+            with self.condition:
+                metrics.observe('{}_pool_in_use'.format(self.name), len(self.openedAt) - len(self.idle))
+            return conn
+
+    def putconn(self, conn, key=None, close=False):
+        """
+        Return a checked-out connection. Its open transaction is rolled back.
+
+        Args:
+            close: bool; close it rather than reuse it
+        """
+        if not close and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        with self.condition:
+            openedAt = self.openedAt.get(id(conn))
+            recycle = (close or conn.closed or self.closed or openedAt is None or
+                       time.monotonic() - openedAt > self.maxAgeSeconds)
+
+            if not recycle:
+                self.idle.append((conn, time.monotonic()))
+                self.condition.notify()
+
+        if recycle:
+            self.discard(conn)
+
+    def closeall(self):
+        """
+        Close idle connections, and checked-out ones as they're returned.
+        """
+        with self.condition:
+            self.closed = True
+            idle = [conn for conn, returnedAt in self.idle]
+            self.idle = []
+            self.condition.notify_all()
+
+        for conn in idle:
+            self.discard(conn)
+
+
+def lsnValue(lsn):
+    # PostgreSQL WAL positions look like '16/B374D848'.
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class FreshReads(PooledConnections):
+    """
+    Pool interface of a ReplicaRoutingPool for reads that must include the latest writes.
+    """
+
+    def __init__(self, router):
+        self.router = router
+
+    def getconn(self, key=None):
+        return self.router.checkout(fresh=True)
 
-        # Create table of daily weather forecast.
+    def putconn(self, conn, key=None, close=False):
+        self.router.putconn(conn, key, close)
+
+
+class QueryScope(object):
+    """
+    Connections checked out while serving one dashboard request.
+    """
+
+    def __init__(self, key, timeoutSeconds):
+        self.key = key
+        self.timeoutMs = None if timeoutSeconds is None else int(timeoutSeconds * 1000)
+        self.connections = dict()  # id of connection -> (connection, function returning it to its pool closed)
+        self.superseded = False
+
+
+class QueryScopes(object):
+    """
+    Tags queries with the request they serve, so a newer request for the same key (e.g. a session and output) cancels the queries of the one it supersedes, and bounds them with a statement timeout.
+    """
+
+    # Marks connections whose statement timeout is unknown.
+    unknown = object()
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latest = dict()  # Key -> its newest QueryScope
+        self.scopes = dict()  # id of connection -> QueryScope it's checked out in
+        # Connection -> statement timeout in ms it was last given. Weak, since pools close and replace connections.
+        self.timeouts = weakref.WeakKeyDictionary()
+
+    @contextmanager
+    def scope(self, key, timeoutSeconds=None):
+        """
+        Run a request's queries in a scope. Cancels queries of the previous scope with the same key still running.
+
+        Args:
+            key: hashable; requests with the same key supersede each other
+            timeoutSeconds: statement timeout of the scope's queries, or None for the database default
+
+        Yields:
+            QueryScope; its superseded attribute says whether a newer request cancelled it
+        """
+        scope = QueryScope(key, timeoutSeconds)
+
+        with self.lock:
+            previous = self.latest.get(key)
+            self.latest[key] = scope
+
+            if previous is not None:
+                previous.superseded = True
+                for conn, release in previous.connections.values():
+                    try:
+                        conn.cancel()
+                        metrics.increment('queries_cancelled')
+                    except psycopg2.Error as e:
+                        log.warning('cancelling query failed: %s', e)
+
+        self.local.scope = scope
         try:
-            self.cur.execute("CREATE TABLE daily_weather_forecast ("
-                             "id SERIAL " # Auto-incrementing
-                             ", ts timestamptz PRIMARY KEY " # Implied UNIQUE and NOT NULL constraint
-                             ", timezone text "
-                             ", ts_offset numeric "
-
-                             # Environment data
-                             ", min_f numeric "
-                             ", min_c numeric "
-                             ", max_f numeric "
-                             ", max_c numeric "
-                             ", weather_type_id numeric "
-                             ", short_weather_descrip text "
-                             ", detail_weather_descrip text "
-                             ", weather_icon text "
-                             ", precip_chance numeric "
-                             ", uvi numeric "
-
-                             ")")
+            yield scope
+        finally:
+            self.local.scope = None
 
-        except psycopg2.ProgrammingError as e:
-            # Table already exists. Roll back command.
-            print(e)
-            self.conn.rollback()
-        else:
-            print('created daily_weather_forecast table')
+            with self.lock:
+                if self.latest.get(key) is scope:
+                    del self.latest[key]
+                leftovers = list(scope.connections.values())
+
+            # Connections not returned because a query raised.
+            for conn, release in leftovers:
+                release()
+
+    def track(self, conn, release):
+        """
+        Tag a checked-out connection with the current scope and give it the scope's statement timeout.
+
+        Args:
+            conn: psycopg2 connection, idle
+            release: function returning it to its pool closed
+        """
+        scope = getattr(self.local, 'scope', None)
+        timeoutMs = None if scope is None else scope.timeoutMs
+
+        if self.timeouts.get(conn, self.unknown) != timeoutMs:
+            cur = conn.cursor()
+            if timeoutMs is None:
+                cur.execute("SET statement_timeout TO DEFAULT ")
+            else:
+                cur.execute("SET statement_timeout = %s ", (timeoutMs,))
+            cur.close()
+            # End the transaction, so session characteristics can still be set.
+            conn.commit()
+            self.timeouts[conn] = timeoutMs
+
+        if scope is not None:
+            with self.lock:
+                scope.connections[id(conn)] = (conn, release)
+                self.scopes[id(conn)] = scope
+
+    def untrack(self, conn, close=False):
+        """
+        Forget a connection being returned to its pool.
+
+        Returns:
+            bool; whether to close it, which it should be if its scope was superseded, since a cancel request may still reach it
+        """
+        with self.lock:
+            scope = self.scopes.pop(id(conn), None)
+            if scope is not None:
+                scope.connections.pop(id(conn), None)
+
+            close = close or (scope is not None and scope.superseded)
+            if close:
+                self.timeouts.pop(conn, None)
+
+        return close
+
+
+class ReplicaRoutingPool(PooledConnections):
+    """
+    Sends reads to a replica while it keeps up with the primary, and to the primary otherwise. Same interface as BlockingConnectionPool.
+
+    Reads through `latest` also see every write this process has been notified of (read-your-writes): they use the replica only once it has replayed the primary's WAL up to the position notifications report for the last write, and the primary until then.
+    """
+
+    def __init__(self, primary, replica=None, maxLagSeconds=30, checkSeconds=5, scopes=None):
+        """
+        Args:
+            primary: BlockingConnectionPool
+            replica: BlockingConnectionPool or None to read from the primary only
+            maxLagSeconds: replication lag beyond which reads go to the primary
+            checkSeconds: how long a lag measurement is used for
+            scopes: QueryScopes tagging checked-out connections, or None
+        """
+        self.primary = primary
+        self.replica = replica
+        self.maxLagSeconds = maxLagSeconds
+        self.checkSeconds = checkSeconds
+        self.scopes = scopes
+
+        self.lag = None
+        self.lagCheckedAt = 0
+        self.lastWrite = 0
+        self.verifiedAt = 0
+        # Highest primary WAL position reported with a write, and whether a write came without one since the replica was last verified.
+        self.writeLsn = 0
+        self.unknownWrite = False
+
+        # id of checked-out connection -> pool it came from.
+        self.owners = dict()
+        self.lock = threading.Lock()
+
+        self.latest = FreshReads(self)
+
+    def noteWrite(self, lsn=None):
+        """
+        Record that a write was committed, e.g. on a change notification.
 
-        # Create table of hourly weather forecast.
+        Args:
+            lsn: str; the primary's WAL position as of the write, or None if unknown, in which case the replica must catch up with the primary's current position
+        """
+        with self.lock:
+            self.lastWrite = time.monotonic()
+            if lsn is None:
+                self.unknownWrite = True
+            else:
+                self.writeLsn = max(self.writeLsn, lsnValue(lsn))
+
+    def query(self, pool, statement):
+        conn = pool.getconn()
         try:
-            self.cur.execute("CREATE TABLE hourly_weather_forecast ("
-                             "id SERIAL " # Auto-incrementing
-                             ", ts timestamptz PRIMARY KEY " # Implied UNIQUE and NOT NULL constraint
-                             ", timezone text "
-                             ", ts_offset numeric "
-
-                             # Environment data
-                             ", temp_f numeric "
-                             ", temp_c numeric "
-                             ", humidity numeric CHECK (humidity >= 0 AND humidity <= 100) "
-                             ", dewpoint_f numeric CHECK (dewpoint_f <= temp_f) "
-                             ", weather_type_id numeric "
-                             ", short_weather_descrip text "
-                             ", detail_weather_descrip text "
-                             ", weather_icon text "
-                             ", precip_chance numeric "
-
-                             ")")
+            cur = conn.cursor()
+            cur.execute(statement)
+            value = cur.fetchone()
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            pool.putconn(conn, close=True)
+            raise
+
+        pool.putconn(conn)
+        return value
+
+    def replicaLag(self):
+        """
+        Replication lag in seconds, measured at most every checkSeconds. None if the replica can't be reached.
+        """
+        if time.monotonic() - self.lagCheckedAt < self.checkSeconds:
+            return self.lag
 
-        except psycopg2.ProgrammingError as e:
-            # Table already exists. Roll back command.
-            print(e)
-            self.conn.rollback()
-        else:
-            print('created hourly_weather_forecast table')
+        self.lagCheckedAt = time.monotonic()
+        previous = self.lag
+
+        try:
+            # Nothing is behind when all received WAL is replayed. NULL when the replica isn't in recovery, e.g. a standalone copy.
+            lag = self.query(self.replica,
+                             "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                             "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END ")[0]
+            self.lag = 0.0 if lag is None else float(lag)
+        except psycopg2.Error as e:
+            log.warning('replica lag check failed: %s', e)
+            self.lag = None
+
+        metrics.observe('replica_lag_s', self.lag if self.lag is not None else -1)
+        healthy = self.lag is not None and self.lag <= self.maxLagSeconds
+        if healthy != (previous is not None and previous <= self.maxLagSeconds):
+            log.info('routing reads to the %s', 'replica' if healthy else 'primary',
+                     extra={'fields': {'lag_s': self.lag}})
+
+        return self.lag
+
+    def caughtUp(self):
+        """
+        Whether the replica has replayed the writes noted so far.
+        """
+        checkedAt = time.monotonic()
+
+        with self.lock:
+            target = self.writeLsn
+            unknownWrite = self.unknownWrite
+
+        try:
+            if unknownWrite:
+                target = max(target, lsnValue(self.query(self.primary, "SELECT pg_current_wal_lsn() ")[0]))
+            replicaLsn = self.query(self.replica, "SELECT pg_last_wal_replay_lsn() ")[0]
+        except psycopg2.Error as e:
+            log.warning('replica position check failed: %s', e)
+            return False
+
+        if replicaLsn is not None and lsnValue(replicaLsn) < target:
+            return False
+
+        with self.lock:
+            self.verifiedAt = checkedAt
+            if self.lastWrite < checkedAt:
+                self.unknownWrite = False
+        return True
+
+    def route(self, fresh):
+        if self.replica is None:
+            return self.primary
+
+        lag = self.replicaLag()
+        if lag is None or lag > self.maxLagSeconds:
+            return self.primary
+
+        if fresh and self.lastWrite >= self.verifiedAt and not self.caughtUp():
+            metrics.increment('fresh_reads_on_primary')
+            return self.primary
+
+        return self.replica
+
+    def checkout(self, fresh=False):
+        pool = self.route(fresh)
+        conn = pool.getconn()
+
+        with self.lock:
+            self.owners[id(conn)] = pool
+
+        if self.scopes is not None:
+            try:
+                self.scopes.track(conn, lambda: self.putconn(conn, close=True))
+            except psycopg2.Error:
+                self.putconn(conn, close=True)
+                raise
+
+        return conn
+
+    def getconn(self, key=None):
+        return self.checkout()
+
+    def putconn(self, conn, key=None, close=False):
+        with self.lock:
+            pool = self.owners.pop(id(conn), None)
+
+        if pool is None:
+            # Already returned, e.g. when its scope ended.
+            return
+
+        if self.scopes is not None:
+            close = self.scopes.untrack(conn, close)
+
+        pool.putconn(conn, close=close)
+
+    def closeall(self):
+        self.primary.closeall()
+        if self.replica is not None:
+            self.replica.closeall()
+
+
+class AirDatabase(object):
+    """
+    Initializes and manipulates PostgreSQL database.
+    """
+
+    def __init__(self, connection):
+        """
+        Establish connection to database. Tables are created and upgraded by migrations.py.
+        """
+        self.conn = connection
+        self.cur = self.conn.cursor()
+
+        self.recentKeys = RecentKeyFilter()
+        self.nowCast = derivations.NowCastTracker()
+        self.windowStats = ws.WindowStatistics()
+        self.alerts = alerts.AlertEngine(alerts.loadRules())
+        self.gaps = gaps.GapDetector()
+
+        # Functions called with a dict of column values after each row is committed.
+        self.sensorListeners = []
+        self.weatherListeners = []
+
+        # Sensor ID -> last recorded location key.
+        self.sensorLocations = dict()
+
+        log.info('got cursor')
 
     def insert_sensor_row(self, data):
         """
@@ -173,57 +635,221 @@ class AirDatabase(object):
         Returns:
             NULL
         """
-        data["temp_c"] = (data["current_temp_f"] - 32) * (5 / 9)
+        try:
+            values = ps.transformer(data)
+        except ps.PayloadError as e:
+            log.error('rejected sensor reading: %s', e, extra={'fields': {
+                'sensor_id': data.get('SensorId') if isinstance(data, dict) else None}})
+            metrics.increment('sensor_rows_rejected')
+            return
+
+        self.insert_sensor_values(values)
+
+    def insert_sensor_values(self, values):
+        """
+        Add a reading already validated by the payload spec.
 
-        breakpoints = aqi.loadAqiBreakpoints()
-        descriptions = aqi.loadAqiDescriptiveInfo()
+        Args:
+            values: tuple from ps.transformer
 
-        data["pm_10_0_aqi"] = aqi.getAqi(
-            data['pm10_0_cf_1'], breakpoints)
-        data["pm_10_0_aqi_rgb"] = aqi.aqiColor(
-            data['pm_10_0_aqi'], descriptions)
-        data['pm_10_0_aqi_description'] = aqi.aqiDescription(
-            data['pm_10_0_aqi'], descriptions)
-        data['pm_10_0_aqi_message'] = aqi.aqiMessage(
-            data['pm_10_0_aqi'], descriptions)
+        Returns:
+            NULL
+        """
+        row = ps.transformer.row(values)
+        sensorId = row['sensor_id']
+        measurementTs = row['measurement_ts']
 
-        data['p25aqic'] = aqi.aqiColor(data['pm2.5_aqi'], descriptions)
-        data['pm_2_5_aqi_description'] = aqi.aqiDescription(
-            data['pm2.5_aqi'], descriptions)
-        data['pm_2_5_aqi_message'] = aqi.aqiMessage(
-            data['pm2.5_aqi'], descriptions)
+        # Sensors resend readings after dropped connections.
+        if self.recentKeys.seen(sensorId, measurementTs):
+            log.info('dropped duplicate reading', extra={
+                'fields': {'sensor_id': sensorId, 'measurement_ts': measurementTs}})
+            metrics.increment('sensor_rows_duplicate_dropped')
+            return
 
         try:
-            print('inserting new obs into sensor_data table...')
-
-            self.cur.execute("INSERT INTO sensor_data (id, sensor_id, place"
-                             ", version, hardware_version, uptime_s, rssi_dbm"
-                             ", measurement_ts, temp_f, temp_c, humidity"
-                             ", dewpoint_f, pressure_mbar, pm_2_5_aqi"
-                             ", pm_2_5_aqi_rgb, pm_2_5_aqi_description"
-                             ", pm_2_5_aqi_message, pm_10_0_aqi"
-                             ", pm_10_0_aqi_rgb, pm_10_0_aqi_description "
-                             ", pm_10_0_aqi_message"
-                             ", pm_1_0_um_m3, pm_2_5_um_m3, pm_10_0_um_m3"
-                             ", p_0_3_count_dl, p_0_5_count_dl, p_1_0_count_dl"
-                             ", p_2_5_count_dl, p_5_0_count_dl, p_10_0_count_dl"
-                             ") "
-                             "VALUES (%(Id)s, %(SensorId)s, %(place)s"
-                             ", %(version)s, %(hardwareversion)s, %(uptime)s, %(rssi)s"
-                             ", %(DateTime)s, %(current_temp_f)s, %(temp_c)s, %(current_humidity)s"
-                             ", %(current_dewpoint_f)s, %(pressure)s, %(pm2.5_aqi)s"
-                             ", %(p25aqic)s, %(pm_2_5_aqi_description)s, %(pm_2_5_aqi_message)s"
-                             ", %(pm_10_0_aqi)s, %(pm_10_0_aqi_rgb)s"
-                             ", %(pm_10_0_aqi_description)s, %(pm_10_0_aqi_message)s"
-                             ", %(pm1_0_cf_1)s, %(pm2_5_cf_1)s, %(pm10_0_cf_1)s"
-                             ", %(p_0_3_um)s, %(p_0_5_um)s, %(p_1_0_um)s"
-                             ", %(p_2_5_um)s, %(p_5_0_um)s, %(p_10_0_um)s)",
-                             data)
-        except (psycopg2.ProgrammingError, psycopg2.errors.UniqueViolation, KeyError) as e:
-            print('failed: ', e)
+            row = self.build_sensor_row(row)
+            columns = tuple(row)
+
+            self.cur.execute(insertSensorRowQuery(columns), itemgetter(*columns)(row))
+            inserted = self.cur.rowcount != 0
+
+            # Alert state, summary and gap changes commit with the reading.
+            alertEvents = self.alerts.update(row, self.cur) if inserted else []
+
+            if inserted:
+                summaries.add(self.cur, [row])
+                self.gaps.update(row, self.cur)
+
+                # Delivered to listening dashboards on commit.
+                ce.notify(self.cur, 'sensor', sensor_id=sensorId,
+                          ts=measurementTs.isoformat())
+        except (psycopg2.ProgrammingError, psycopg2.IntegrityError, psycopg2.DataError) as e:
+            log.error('sensor row insert failed: %s', e,
+                      extra={'fields': {'sensor_id': sensorId}})
+            metrics.increment('sensor_rows_failed')
             self.conn.rollback()
+            self.forget_sensor_state([sensorId])
         else:
             self.conn.commit()  # Make database changes persistent.
+            self.recentKeys.add(sensorId, measurementTs)
+
+            if not inserted:
+                self.forget_derived_state([sensorId])
+                log.info('reading already in sensor_data table', extra={
+                    'fields': {'sensor_id': sensorId, 'measurement_ts': measurementTs}})
+                metrics.increment('sensor_rows_duplicate_ignored')
+                return
+
+            log.info('inserted sensor reading', extra={
+                'fields': {'sensor_id': sensorId, 'measurement_ts': measurementTs},
+                'sample': 30})
+            metrics.increment('sensor_rows_inserted')
+            alerts.dispatcher.dispatch(alertEvents)
+
+            for listener in self.sensorListeners:
+                listener(row)
+
+    def build_sensor_row(self, row, derived=None):
+        """
+        Complete a sensor_data row with derived values, NowCast AQI and window statistics.
+
+        Args:
+            row: dict of sensor_data column -> value, from ps.transformer.row
+            derived: dict of derived column -> value, if already computed with derivations.deriveRows
+
+        Returns:
+            the same dict, completed
+        """
+        row.update(derivations.deriveRow(row) if derived is None else derived)
+        row.update(self.nowCast.update(row, self.cur))
+        row.update({column: derivations.cleanValue(value) for column, value in
+                    self.windowStats.update(row, self.cur).items()})
+
+        return row
+
+    def forget_derived_state(self, sensorIds):
+        """
+        Drop in-memory NowCast and window state of sensors with a reading that was already stored. build_sensor_row added it to that state again, so it's reloaded from the database with their next readings.
+        """
+        for sensorId in sensorIds:
+            self.nowCast.forget(sensorId)
+            self.windowStats.forget(sensorId)
+
+    def forget_sensor_state(self, sensorIds):
+        """
+        Drop in-memory NowCast, window, alert and gap state of sensors whose readings were rolled back. It's reloaded from the database with their next readings.
+        """
+        for sensorId in sensorIds:
+            self.nowCast.forget(sensorId)
+            self.windowStats.forget(sensorId)
+            self.alerts.forget(sensorId)
+            self.gaps.forget(sensorId)
+
+    def insert_sensor_rows(self, payloads):
+        """
+        Add a batch of readings to the air database in one transaction, e.g. when replaying the spool. Derived values are computed for the whole batch at once. If the batch is rejected, readings are inserted one at a time, so one bad reading doesn't hold up the rest.
+
+        Args:
+            payloads: list of sensor data dicts, oldest first
+
+        Returns:
+            NULL
+
+        Raises:
+            psycopg2.OperationalError or psycopg2.InterfaceError if the database is unavailable. Nothing from the batch is stored.
+        """
+        fresh = []
+        batchKeys = set()
+        for data in payloads:
+            try:
+                values = ps.transformer(data)
+            except ps.PayloadError as e:
+                log.error('rejected sensor reading: %s', e, extra={'fields': {
+                    'sensor_id': data.get('SensorId') if isinstance(data, dict) else None}})
+                metrics.increment('sensor_rows_rejected')
+                continue
+
+            sensorId = ps.transformer.value(values, 'sensor_id')
+            measurementTs = ps.transformer.value(values, 'measurement_ts')
+
+            # Sensors resend readings after dropped connections.
+            if self.recentKeys.seen(sensorId, measurementTs) or (sensorId, measurementTs) in batchKeys:
+                metrics.increment('sensor_rows_duplicate_dropped')
+                continue
+            batchKeys.add((sensorId, measurementTs))
+            fresh.append((sensorId, measurementTs, values))
+
+        if not fresh:
+            return
+
+        sensorIds = {sensorId for sensorId, measurementTs, values in fresh}
+
+        try:
+            rows = [ps.transformer.row(values) for sensorId, measurementTs, values in fresh]
+            rows = [self.build_sensor_row(row, derived)
+                    for row, derived in zip(rows, derivations.deriveRows(rows))]
+            columns = tuple(rows[0])
+            rowValues = itemgetter(*columns)
+
+            inserted = {tuple(key) for key in extras.execute_values(
+                self.cur,
+                "INSERT INTO sensor_data ({}) VALUES %s ON CONFLICT DO NOTHING RETURNING sensor_id, measurement_ts ".format(
+                    ', '.join(columns)),
+                [rowValues(row) for row in rows], page_size=len(rows), fetch=True)}
+            duplicateSensorIds = {row['sensor_id'] for row in rows
+                                  if (row['sensor_id'], row['measurement_ts']) not in inserted}
+            rows = [row for row in rows if (row['sensor_id'], row['measurement_ts']) in inserted]
+
+            # Alert state, summary and gap changes commit with the readings.
+            alertEvents = [event for row in rows for event in self.alerts.update(row, self.cur)]
+            summaries.add(self.cur, rows)
+            for row in rows:
+                self.gaps.update(row, self.cur)
+
+            if rows:
+                ce.notify(self.cur, 'sensor', rows=len(rows),
+                          ts=rows[-1]['measurement_ts'].isoformat())
+        except (psycopg2.ProgrammingError, psycopg2.IntegrityError, psycopg2.DataError) as e:
+            log.error('sensor batch insert failed, inserting one at a time: %s', e,
+                      extra={'fields': {'rows': len(fresh)}})
+            self.conn.rollback()
+            self.forget_sensor_state(sensorIds)
+
+            for sensorId, measurementTs, values in fresh:
+                self.insert_sensor_values(values)
+            return
+        except Exception:
+            # Rolled back by the caller. In-memory state may have advanced past readings that weren't stored.
+            self.forget_sensor_state(sensorIds)
+            raise
+
+        self.conn.commit()
+        self.forget_derived_state(duplicateSensorIds)
+
+        for sensorId, measurementTs, values in fresh:
+            self.recentKeys.add(sensorId, measurementTs)
+
+        log.info('inserted sensor readings', extra={
+            'fields': {'rows': len(rows), 'duplicates': len(fresh) - len(rows)}})
+        metrics.increment('sensor_rows_inserted', len(rows))
+        metrics.increment('sensor_rows_duplicate_ignored', len(fresh) - len(rows))
+        alerts.dispatcher.dispatch(alertEvents)
+
+        for row in rows:
+            for listener in self.sensorListeners:
+                listener(row)
+
+    def reconnect(self, connection):
+        """
+        Replace a broken connection, e.g. after the database restarted.
+        """
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+
+        self.conn = connection
+        self.cur = self.conn.cursor()
 
     def table_exists(self, table_name):
         """
@@ -239,10 +865,10 @@ class AirDatabase(object):
             self.cur.execute(
                 "SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = {} ".format(table_name))
         except psycopg2.ProgrammingError as e:
-            print(e)
+            log.error('%s', e)
             self.conn.rollback()
         else:
-            print('checked if {} exists'.format(table_name))
+            log.info('checked if %s exists', table_name)
             return self.cur.rowcount != 0
 
     def del_row(self, data):
@@ -260,10 +886,10 @@ class AirDatabase(object):
                              "WHERE id = %(Id)s and measurement_ts = %(DateTime)s",
                              data)
         except psycopg2.ProgrammingError as e:
-            print(e)
+            log.error('%s', e)
             self.conn.rollback()
         else:
-            print('deleted row from sensor_data table')
+            log.info('deleted row from sensor_data table')
 
     def del_all(self, table_name):
         """
@@ -279,10 +905,10 @@ class AirDatabase(object):
             self.cur.execute(
                 "IF (EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = {} ) ) THEN DELETE FROM {} ; END IF; ".format(table_name, table_name))
         except psycopg2.ProgrammingError as e:
-            print(e)
+            log.error('%s', e)
             self.conn.rollback()
         else:
-            print('removed all rows from table {}'.format(table_name))
+            log.info('removed all rows from table %s', table_name)
 
     def del_table(self, table_name):
         """
@@ -298,10 +924,10 @@ class AirDatabase(object):
             self.cur.execute("DROP TABLE IF EXISTS {} ".format(
                 table_name))
         except psycopg2.ProgrammingError as e:
-            print(e)
+            log.error('%s', e)
             self.conn.rollback()
         else:
-            print('deleted table {}'.format(table_name))
+            log.info('deleted table %s', table_name)
 
     def close_comms(self):
         """
@@ -315,20 +941,66 @@ class AirDatabase(object):
         """
         self.cur.close()
         self.conn.close()
-        print('connection and cursor closed')
+        log.info('connection and cursor closed')
 
-    def insert_weather_row_and_forecasts(self, data):
+    def update_sensor_location(self, sensorId, latitude, longitude, locationKey):
         """
-        Add a row of sensor data to the air database.
+        Record where a sensor is. Only writes when the location changes.
+        """
+        if self.sensorLocations.get(sensorId) == (latitude, longitude):
+            return
+
+        try:
+            self.cur.execute("INSERT INTO sensors (sensor_id, latitude, longitude, location_key, updated_at) "
+                             "VALUES (%s, %s, %s, %s, now()) "
+                             "ON CONFLICT (sensor_id) DO UPDATE SET latitude = EXCLUDED.latitude "
+                             ", longitude = EXCLUDED.longitude, location_key = EXCLUDED.location_key "
+                             ", updated_at = EXCLUDED.updated_at ",
+                             (sensorId, latitude, longitude, locationKey))
+        except psycopg2.ProgrammingError as e:
+            log.error('sensor location update failed: %s', e)
+            self.conn.rollback()
+        else:
+            self.conn.commit()
+            self.sensorLocations[sensorId] = (latitude, longitude)
+
+    def claim_weather_fetch(self, locationKey, intervalSeconds):
+        """
+        Claim the next weather fetch for a location, unless another process fetched it within the interval.
+
+        Returns:
+            bool; True if this process should fetch
+        """
+        try:
+            self.cur.execute("INSERT INTO weather_fetches (location_key, fetched_at) "
+                             "VALUES (%s, now()) "
+                             "ON CONFLICT (location_key) DO UPDATE SET fetched_at = EXCLUDED.fetched_at "
+                             "WHERE weather_fetches.fetched_at < now() - %s * interval '1 second' "
+                             "RETURNING location_key ",
+                             (locationKey, intervalSeconds))
+            claimed = self.cur.fetchone() is not None
+        except psycopg2.ProgrammingError as e:
+            log.error('weather fetch claim failed: %s', e)
+            self.conn.rollback()
+            return False
+
+        self.conn.commit()
+        return claimed
+
+    def insert_weather_row_and_forecasts(self, data, locationKey=wf.primaryLocationKey):
+        """
+        Add a row of weather data and the latest forecasts for a location to the air database.
 
         Args:
-            data: sensor data in json/dictionary format.
+            data: weather data in json/dictionary format.
+            locationKey: str; grid cell the weather was fetched for
 
         Returns:
             NULL
         """
         cleanData = dict()
 
+        cleanData["location_key"] = locationKey
         cleanData["time"] = dt.fromtimestamp(data["current"]["dt"])
 
         cleanData["timezone_offset"] = getCarefullyFromDict(
@@ -346,52 +1018,72 @@ class AirDatabase(object):
         cleanData["pressure_mbar"] = data["current"]["pressure"]
 
         try:
-            print('inserting new obs into weather_data table...')
             self.cur.execute("INSERT INTO weather_data ( "
-                             "ts, timezone, ts_offset "
+                             "location_key, ts, timezone, ts_offset "
                              ", temp_f, temp_c, temp_feels_like_f "
                              ", temp_feels_like_c, humidity "
                              ", dewpoint_f, pressure_mbar "
                              ") "
                              "VALUES ( "
-                             "%(time)s, %(timezone)s, %(timezone_offset)s "
+                             "%(location_key)s, %(time)s, %(timezone)s, %(timezone_offset)s "
                              ", %(temp_f)s, %(temp_c)s, %(temp_feels_like_f)s "
                              ", %(temp_feels_like_c)s, %(humidity)s "
                              ", %(dewpoint_f)s, %(pressure_mbar)s "
-                             ") ",
+                             ") "
+                             "ON CONFLICT DO NOTHING ",
                              cleanData)
+            weatherInserted = self.cur.rowcount != 0
 
             # Add forecast data.
-            self.insert_daily_forecast_row(data)
-            self.insert_hourly_forecast_row(data)
+            self.insert_daily_forecast_row(data, locationKey)
+            self.insert_hourly_forecast_row(data, locationKey)
 
-        except (psycopg2.ProgrammingError, psycopg2.errors.UniqueViolation, KeyError) as e:
-            print('failed: ', e)
+        except (psycopg2.ProgrammingError, psycopg2.IntegrityError, KeyError) as e:
+            log.error('weather row insert failed: %s', e)
             self.conn.rollback()
         else:
+            if weatherInserted:
+                ce.notify(self.cur, 'weather', ts=data["current"]["dt"],
+                          location_key=locationKey)
             self.conn.commit()
 
-    def insert_daily_forecast_row(self, data):
+            if not weatherInserted:
+                # Upstream hasn't published a new observation since the last fetch.
+                metrics.increment('weather_rows_duplicate_ignored')
+                return
+
+            log.info('inserted weather observation',
+                     extra={'fields': {'location_key': locationKey}})
+
+            cleanData["ts"] = dt.fromtimestamp(data["current"]["dt"], timezone.utc)
+            for listener in self.weatherListeners:
+                listener(cleanData)
+
+    def insert_daily_forecast_row(self, data, locationKey=wf.primaryLocationKey):
         """
-        Add a row of forecast data to the daily forecast table.
+        Replace the daily forecast of a location.
 
         Args:
             data: forecast data in json/dictionary format.
+            locationKey: str; grid cell the forecast was fetched for
 
         Returns:
             NULL
         """
-        # Remove any existing data in table.
+        # Remove any existing forecast for this location.
         try:
-            self.cur.execute("DELETE FROM daily_weather_forecast ")
+            self.cur.execute("DELETE FROM daily_weather_forecast WHERE location_key = %s ",
+                             (locationKey,))
         except (psycopg2.ProgrammingError, psycopg2.errors.UniqueViolation) as e:
-            print(e)
+            log.error('%s', e)
             self.conn.rollback()
         else:
-            print('deleted all existing rows in daily_weather_forecast table')
+            log.debug('deleted existing rows in daily_weather_forecast table')
 
         cleanData = dict()
 
+        cleanData["location_key"] = locationKey
+
         cleanData["timezone_offset"] = getCarefullyFromDict(
             data, "timezone_offset")
         cleanData["timezone"] = getCarefullyFromDict(data, "timezone")
@@ -400,7 +1092,6 @@ class AirDatabase(object):
         dataList = getCarefullyFromDict(data, "daily")
 
         try:
-            print('inserting new obs into daily_weather_forecast table...')
 
             # Add new data row by row.
             for data in dataList:
@@ -422,14 +1113,14 @@ class AirDatabase(object):
                 cleanData["uvi"] = getCarefullyFromDict(data, "uvi")
 
                 self.cur.execute("INSERT INTO daily_weather_forecast ( "
-                                 "ts, timezone, ts_offset "
+                                 "location_key, ts, timezone, ts_offset "
                                  ", min_f, min_c, max_f "
                                  ", max_c, short_weather_descrip "
                                  ", detail_weather_descrip, weather_icon "
                                  ", precip_chance, uvi, weather_type_id "
                                  ") "
                                  "VALUES ( "
-                                 "%(time)s, %(timezone)s, %(timezone_offset)s "
+                                 "%(location_key)s, %(time)s, %(timezone)s, %(timezone_offset)s "
                                  ", %(min_f)s, %(min_c)s, %(max_f)s "
                                  ", %(max_c)s, %(short_weather_descrip)s "
                                  ", %(detail_weather_descrip)s, %(weather_icon)s "
@@ -438,32 +1129,36 @@ class AirDatabase(object):
                                  cleanData)
 
         except (psycopg2.ProgrammingError, psycopg2.errors.UniqueViolation, KeyError) as e:
-            print('failed: ', e)
+            log.error('daily forecast insert failed: %s', e)
             self.conn.rollback()
         else:
             self.conn.commit()
 
-    def insert_hourly_forecast_row(self, data):
+    def insert_hourly_forecast_row(self, data, locationKey=wf.primaryLocationKey):
         """
-        Add a row of forecast data to the hourly forecast table.
+        Replace the hourly forecast of a location.
 
         Args:
             data: forecast data in json/dictionary format.
+            locationKey: str; grid cell the forecast was fetched for
 
         Returns:
             NULL
         """
-        # Remove any existing data in table.
+        # Remove any existing forecast for this location.
         try:
-            self.cur.execute("DELETE FROM hourly_weather_forecast ")
+            self.cur.execute("DELETE FROM hourly_weather_forecast WHERE location_key = %s ",
+                             (locationKey,))
         except (psycopg2.ProgrammingError, psycopg2.errors.UniqueViolation) as e:
-            print(e)
+            log.error('%s', e)
             self.conn.rollback()
         else:
-            print('deleted all existing rows in hourly_weather_forecast table')
+            log.debug('deleted existing rows in hourly_weather_forecast table')
 
         cleanData = dict()
 
+        cleanData["location_key"] = locationKey
+
         cleanData["timezone_offset"] = getCarefullyFromDict(
             data, "timezone_offset")
         cleanData["timezone"] = getCarefullyFromDict(data, "timezone")
@@ -472,7 +1167,6 @@ class AirDatabase(object):
         dataList = getCarefullyFromDict(data, "hourly")
 
         try:
-            print('inserting new obs into hourly_weather_forecast table...')
 
             # Add new data row by row.
             for data in dataList:
@@ -492,14 +1186,14 @@ class AirDatabase(object):
                 cleanData["precip_chance"] = getCarefullyFromDict(data, "pop")
 
                 self.cur.execute("INSERT INTO hourly_weather_forecast ( "
-                                 "ts, timezone, ts_offset "
+                                 "location_key, ts, timezone, ts_offset "
                                  ", temp_f, temp_c, humidity "
                                  ", dewpoint_f, short_weather_descrip "
                                  ", detail_weather_descrip, weather_icon "
                                  ", precip_chance, weather_type_id "
                                  ") "
                                  "VALUES ( "
-                                 "%(time)s, %(timezone)s, %(timezone_offset)s "
+                                 "%(location_key)s, %(time)s, %(timezone)s, %(timezone_offset)s "
                                  ", %(temp_f)s, %(temp_c)s, %(humidity)s "
                                  ", %(dewpoint_f)s, %(short_weather_descrip)s "
                                  ", %(detail_weather_descrip)s, %(weather_icon)s "
@@ -508,12 +1202,12 @@ class AirDatabase(object):
                                  cleanData)
 
         except (psycopg2.ProgrammingError, psycopg2.errors.UniqueViolation, KeyError) as e:
-            print('failed: ', e)
+            log.error('hourly forecast insert failed: %s', e)
             self.conn.rollback()
         else:
             self.conn.commit()
 
     def load_historal_data(self):
         # TODO: Add all historical data to DB.
-        print('historical data load not yet implemented')
+        log.warning('historical data load not yet implemented')
         # self.conn.commit()
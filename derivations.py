@@ -0,0 +1,402 @@
+
+"""
+Derived measurements computed once at ingest time and stored alongside the raw sensor readings.
+
+Each stage is a vectorized function over a dataframe of sensor_data columns. Stages run in the order they're registered, so later stages can use earlier outputs.
+
+Run directly to recompute derived columns, including NowCast AQI and window statistics, for all stored readings after a correction changes:
+    python derivations.py
+"""
+
+
+import threading
+
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2 import extras
+
+import aqi  # Calculating AQI.
+import archive_management as am
+import window_stats as ws
+import shared_cache as sc
+import summaries  # Hourly and daily summaries.
+import structured_logging as slog
+import user_settings as us
+
+
+log = slog.getLogger(__name__)
+
+# Registered stages, in run order.
+stages = []
+
+
+def stage(inputs, outputs):
+    """
+    Register a derivation stage. Use as a decorator on a function that adds its outputs to a dataframe.
+
+    Args:
+        inputs: list of str; sensor_data columns the stage reads
+        outputs: dict of column name -> PostgreSQL type of each column the stage writes
+    """
+    def register(function):
+        stages.append({'name': function.__name__, 'inputs': inputs,
+                       'outputs': outputs, 'function': function})
+        return function
+
+    return register
+
+
+def derivedColumnTypes():
+    return {column: columnType for derivation in stages
+            for column, columnType in derivation['outputs'].items()}
+
+
+def inputColumns():
+    """
+    Raw sensor_data columns needed to run all stages.
+    """
+    derived = derivedColumnTypes()
+
+    return list(dict.fromkeys(column for derivation in stages
+                              for column in derivation['inputs'] if column not in derived))
+
+
+def cleanValue(value):
+    """
+    Convert a dataframe value to something psycopg2 stores as expected (NaN becomes NULL).
+    """
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def derive(records):
+    """
+    Run all stages over a dataframe of raw sensor_data columns.
+
+    Args:
+        records: pandas dataframe including the columns in inputColumns()
+
+    Returns:
+        the same dataframe with derived columns added
+    """
+    # Numeric columns are returned by psycopg2 as Decimal.
+    for column in inputColumns():
+        records[column] = pd.to_numeric(records[column], errors='coerce')
+
+    for derivation in stages:
+        derivation['function'](records)
+
+    return records
+
+
+def deriveRows(rows):
+    """
+    Run all stages over a batch of readings at once.
+
+    Args:
+        rows: list of dicts of sensor_data column -> value
+
+    Returns:
+        list of dicts of derived column -> value, in the same order
+    """
+    columns = inputColumns()
+    records = derive(pd.DataFrame([{column: row.get(column) for column in columns}
+                                   for row in rows]))
+
+    derived = list(derivedColumnTypes())
+    return [dict(zip(derived, map(cleanValue, values)))
+            for values in records[derived].itertuples(index=False, name=None)]
+
+
+def deriveRow(row):
+    """
+    Run all stages over a single reading.
+
+    Args:
+        row: dict of sensor_data column -> value
+
+    Returns:
+        dict of derived column -> value
+    """
+    return deriveRows([row])[0]
+
+
+# Corrections.
+# Temperature and humidity offsets: https://de-de.facebook.com/groups/purpleair/permalink/722201454903597/?comment_id=722403448216731
+tempOffsetF = -8
+humidityOffset = 4
+
+
+def fahrenheitToCelsius(tempF):
+    return (tempF - 32) * (5 / 9)
+
+
+@stage(['temp_f'], {'temp_f_corrected': 'numeric'})
+def correctTemp(records):
+    records['temp_f_corrected'] = records['temp_f'] + tempOffsetF
+
+
+@stage(['humidity'], {'humidity_corrected': 'numeric'})
+def correctHumid(records):
+    records['humidity_corrected'] = (
+        records['humidity'] + humidityOffset).clip(upper=100)
+
+
+@stage(['temp_f', 'temp_f_corrected'], {'temp_c': 'numeric', 'temp_c_corrected': 'numeric'})
+def convertToCelsius(records):
+    records['temp_c'] = fahrenheitToCelsius(records['temp_f'])
+    records['temp_c_corrected'] = fahrenheitToCelsius(
+        records['temp_f_corrected'])
+
+
+@stage(['pm_2_5_um_m3', 'humidity'], {'pm_2_5_epa_um_m3': 'numeric'})
+def correctPm25Epa(records):
+    # US-wide PurpleAir correction (CF=1 channel, raw relative humidity): https://www.epa.gov/air-sensor-toolbox/technical-approaches-sensor-data-airnow-fire-and-smoke-map
+    records['pm_2_5_epa_um_m3'] = (0.524 * records['pm_2_5_um_m3'] -
+                                   0.0862 * records['humidity'] + 5.75).clip(lower=0)
+
+
+# AQI.
+pm25Breakpoints = aqi.loadAqiBreakpoints(
+    pollutant='PM2.5 - Local Conditions')
+pm10Breakpoints = aqi.loadAqiBreakpoints()
+descriptions = aqi.loadAqiDescriptiveInfo()
+
+# AQI species with stored descriptive columns, and the descriptions.csv column each is filled from.
+aqiSpecies = ['pm_2_5_aqi', 'pm_10_0_aqi', 'pm_2_5_epa_aqi']
+aqiFeatures = {'rgb': 'color', 'description': 'description', 'message': 'message'}
+
+
+@stage(['pm_10_0_um_m3'], {'pm_10_0_aqi': 'numeric'})
+def calculatePm10Aqi(records):
+    records['pm_10_0_aqi'] = aqi.getAqiArray(
+        records['pm_10_0_um_m3'], pm10Breakpoints)
+
+
+@stage(['pm_2_5_epa_um_m3'], {'pm_2_5_epa_aqi': 'numeric'})
+def calculatePm25EpaAqi(records):
+    records['pm_2_5_epa_aqi'] = aqi.getAqiArray(
+        records['pm_2_5_epa_um_m3'], pm25Breakpoints, decimals=1)
+
+
+@stage(aqiSpecies, {'{}_{}'.format(species, feature): 'text'
+                    for species in aqiSpecies for feature in aqiFeatures})
+def describeAqi(records):
+    for species in aqiSpecies:
+        for feature, descriptionColumn in aqiFeatures.items():
+            records['{}_{}'.format(species, feature)] = aqi.getAqiDescriptiveFeatureArray(
+                descriptions, descriptionColumn, records[species])
+
+
+# NowCast AQI columns, each with the concentration column, breakpoints and rounding it's computed from. NowCast depends on the readings before each one, so it's computed outside the stages.
+nowCastSpecies = {
+    'pm_2_5_nowcast_aqi': ('pm_2_5_um_m3', pm25Breakpoints, 1),
+    'pm_10_0_nowcast_aqi': ('pm_10_0_um_m3', pm10Breakpoints, 0)}
+
+
+def storedColumnTypes():
+    """
+    All sensor_data columns computed from raw readings, with their PostgreSQL types.
+    """
+    columnTypes = derivedColumnTypes()
+    columnTypes.update({column: 'numeric' for column in nowCastSpecies})
+    columnTypes.update(ws.windowColumnTypes)
+
+    return columnTypes
+
+
+def nowCastHistory(records, species=None):
+    """
+    Add NowCast AQI columns to a dataframe of stored readings, computed per sensor.
+
+    Args:
+        records: pandas dataframe with measurement_ts, sensor_id and the concentration columns of nowCastSpecies, sorted by time
+        species: dict like nowCastSpecies, e.g. with revised breakpoints. Defaults to nowCastSpecies.
+
+    Returns:
+        the same dataframe with NowCast columns added
+    """
+    species = species or nowCastSpecies
+    ts = pd.to_datetime(records['measurement_ts'], utc=True).values.astype('int64')
+    sensors = records.groupby(records['sensor_id'].fillna(''), sort=False).indices
+
+    for column, (source, breakpoints, decimals) in species.items():
+        concentrations = pd.to_numeric(records[source], errors='coerce').to_numpy(dtype='float64')
+        nowCast = np.full(len(records), np.nan)
+
+        for rowIndex in sensors.values():
+            nowCast[rowIndex] = aqi.nowCastArray(ts[rowIndex], concentrations[rowIndex])
+
+        records[column] = aqi.getAqiArray(nowCast, breakpoints, decimals)
+
+    return records
+
+
+class NowCastTracker(object):
+    """
+    Streaming NowCast AQI for incoming readings.
+
+    A sensor's accumulators are loaded from the database the first time it's seen, and again whenever readings seem to have been missed (e.g. ingested by another process).
+    """
+
+    # Time between readings beyond which a sensor's accumulators are reloaded.
+    reloadGap = pd.Timedelta(minutes=5)
+
+    def __init__(self):
+        self.calculators = {column: aqi.NowCastCalculator()
+                            for column in nowCastSpecies}
+        self.lastSeen = dict()
+        self.lock = threading.Lock()
+
+    def load(self, cur, sensorId, before):
+        """
+        Reload a sensor's accumulators from readings in the 12 hours before a time.
+        """
+        for calculator in self.calculators.values():
+            calculator.reset(sensorId)
+
+        sources = [source for source, breakpoints, decimals in nowCastSpecies.values()]
+        cur.execute("SELECT measurement_ts, {} FROM sensor_data "
+                    "WHERE sensor_id IS NOT DISTINCT FROM %s AND measurement_ts >= %s AND measurement_ts < %s "
+                    "ORDER BY measurement_ts ASC ".format(', '.join(sources)),
+                    (sensorId, before - pd.Timedelta(hours=aqi.hoursInNowCast), before))
+
+        for row in cur.fetchall():
+            for column, value in zip(nowCastSpecies, row[1:]):
+                self.calculators[column].update(sensorId, row[0], value)
+
+    def forget(self, sensorId):
+        """
+        Drop a sensor's accumulators, so they're reloaded with its next reading, e.g. after its readings were rolled back.
+        """
+        with self.lock:
+            self.lastSeen.pop(sensorId, None)
+
+    def update(self, row, cur):
+        """
+        Add a reading and get its NowCast AQI values.
+
+        Args:
+            row: dict of sensor_data column -> value
+            cur: psycopg2 cursor, used to reload accumulators
+
+        Returns:
+            dict of NowCast column -> value
+        """
+        sensorId = row.get('sensor_id')
+        ts = pd.Timestamp(row['measurement_ts'])
+
+        with self.lock:
+            lastSeen = self.lastSeen.get(sensorId)
+            if lastSeen is None or ts - lastSeen > self.reloadGap:
+                self.load(cur, sensorId, ts.to_pydatetime())
+            self.lastSeen[sensorId] = ts if lastSeen is None else max(lastSeen, ts)
+
+            values = dict()
+            for column, (source, breakpoints, decimals) in nowCastSpecies.items():
+                nowCast = self.calculators[column].update(
+                    sensorId, ts, row.get(source))
+                values[column] = cleanValue(
+                    aqi.getAqiArray([nowCast], breakpoints, decimals)[0])
+
+        return values
+
+
+def recomputeHistory(conn, chunk=pd.DateOffset(months=1), start=None, end=None):
+    """
+    Recompute derived columns for every stored reading, one chunk of time at a time, and re-export archived months so the archive matches.
+
+    Args:
+        conn: psycopg2 connection
+        chunk: pandas DateOffset; time span updated per transaction
+        start, end: tz-aware pandas Timestamps or None; recompute only readings in this range, e.g. around backfilled readings. Defaults to all readings.
+
+    Returns:
+        NULL
+    """
+    inputs = inputColumns() + ['sensor_id']
+    outputTypes = storedColumnTypes()
+    outputs = list(outputTypes)
+
+    cur = conn.cursor()
+    cur.execute("SELECT MIN(measurement_ts), MAX(measurement_ts) FROM sensor_data ")
+    first, last = cur.fetchone()
+
+    if first is None:
+        log.info('no data in sensor_data, nothing to recompute')
+        return
+
+    updateQuery = ("UPDATE sensor_data SET {} FROM (VALUES %s) AS derived (sensor_id, measurement_ts, {}) "
+                   "WHERE sensor_data.sensor_id = derived.sensor_id "
+                   "AND sensor_data.measurement_ts = derived.measurement_ts ").format(
+        ', '.join('{0} = derived.{0}'.format(column) for column in outputs),
+        ', '.join(outputs))
+    # Casts keep all-NULL columns from being read as text.
+    template = '(%s::text, %s::timestamptz, {})'.format(
+        ', '.join('%s::{}'.format(outputTypes[column]) for column in outputs))
+
+    chunkStart = pd.Timestamp(first).tz_convert('UTC').normalize().replace(day=1) if start is None else start
+    last = pd.Timestamp(last)
+
+    while chunkStart <= last and (end is None or chunkStart < end):
+        chunkEnd = chunkStart + chunk if end is None else min(chunkStart + chunk, end)
+
+        # Read the preceding day too, which NowCast and window statistics need.
+        cur.execute("SELECT measurement_ts, {} FROM sensor_data WHERE measurement_ts >= %s AND measurement_ts < %s "
+                    "ORDER BY measurement_ts ASC ".format(', '.join(inputs)),
+                    ((chunkStart - ws.window).to_pydatetime(), chunkEnd.to_pydatetime()))
+        records = derive(pd.DataFrame([tuple(row) for row in cur.fetchall()],
+                                      columns=['measurement_ts'] + inputs))
+        records = ws.windowHistory(nowCastHistory(records))
+        records = records[pd.to_datetime(records['measurement_ts'], utc=True) >= chunkStart]
+
+        rows = [tuple(cleanValue(value) for value in row)
+                for row in records[['sensor_id', 'measurement_ts'] + outputs].itertuples(index=False)]
+        extras.execute_values(cur, updateQuery, rows,
+                              template=template, page_size=1000)
+        conn.commit()
+
+        log.info('recomputed chunk', extra={'fields': {
+            'rows': len(rows), 'start': chunkStart.date(), 'end': chunkEnd.date()}})
+        chunkStart = chunkEnd
+
+    if start is None and end is None:
+        # Corrections may have changed. Derived values of a range are recomputed from the same corrections, so its summaries still hold.
+        summaries.rebuild(cur)
+        conn.commit()
+
+    reexportArchive(conn, first if start is None else start, end)
+
+    # Drop cached results built from the old values.
+    sc.cache.bump('sensor')
+
+
+def reexportArchive(conn, first, end=None):
+    """
+    Re-export archived months of sensor_data after stored values change, since they hold copies of the old values.
+
+    Args:
+        conn: psycopg2 connection
+        first: datetime of the oldest changed reading
+        end: datetime after the newest changed reading, or None to re-export every archived month from first on
+    """
+    archiveCutoff = am.archivedThrough('sensor_data')
+    if archiveCutoff is None:
+        return
+
+    monthStart = pd.Timestamp(first).tz_convert('UTC').normalize().replace(day=1)
+
+    while monthStart < archiveCutoff and (end is None or monthStart < end):
+        am.archiveMonth(conn, us.archiveDir, 'sensor_data', monthStart)
+        monthStart = monthStart + pd.DateOffset(months=1)
+
+    conn.rollback()  # End read-only transaction.
+    log.info('re-exported archived months')
+
+
+if __name__ == '__main__':
+    recomputeHistory(psycopg2.connect(us.databaseUrl))
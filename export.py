@@ -0,0 +1,314 @@
+
+"""
+Stream sensor and weather data out of the database as CSV, NDJSON or Parquet.
+
+Rows are read through a server-side cursor and written out one chunk at a time, so memory use doesn't grow with the size of the export. Served at /export by the app, or run directly:
+
+    python export.py sensor_data --start 2020-08-01 --end 2020-09-01 --format csv --compression gzip -o august.csv.gz
+"""
+
+
+import argparse
+import csv
+import io
+import json
+import sys
+import zlib
+from datetime import timezone
+from decimal import Decimal
+
+import pandas as pd
+import psycopg2
+import psycopg2.extensions
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import derivations
+import payload_schema as ps
+import user_settings as us
+
+
+# Columns that can be exported from each table. Doubles as the whitelist for user-supplied column names.
+exportableColumns = {
+    'sensor_data': ['measurement_ts'] + [column for column in ps.transformer.columns
+                                         if column != 'measurement_ts'] +
+    [column for column in derivations.storedColumnTypes() if column not in ps.transformer.columns],
+    'weather_data': ['ts', 'location_key', 'timezone', 'ts_offset', 'temp_f', 'temp_c',
+                     'temp_feels_like_f', 'temp_feels_like_c', 'humidity',
+                     'dewpoint_f', 'pressure_mbar']}
+
+tsColumns = {'sensor_data': 'measurement_ts', 'weather_data': 'ts'}
+
+formats = {'csv': ('text/csv', 'csv'),
+           'ndjson': ('application/x-ndjson', 'ndjson'),
+           'parquet': ('application/vnd.apache.parquet', 'parquet')}
+
+# Rows fetched from the server-side cursor at a time.
+chunkRows = 5000
+
+# PostgreSQL type codes and their Parquet types. Anything else is exported as text.
+arrowTypes = {1700: pa.float64(),  # numeric
+              1184: pa.timestamp('us', tz='UTC'),  # timestamptz
+              23: pa.int64(),  # integer
+              20: pa.int64(),  # bigint
+              701: pa.float64()}  # double precision
+
+
+class ExportError(ValueError):
+    """
+    Invalid export request.
+    """
+    pass
+
+
+def parseBound(value, timezone=us.timezone):
+    """
+    Parse a date or time, taken to be local time if no offset is given.
+
+    Returns:
+        tz-aware pandas Timestamp, or None
+    """
+    if not value:
+        return None
+
+    try:
+        ts = pd.Timestamp(value)
+    except ValueError:
+        raise ExportError('invalid date: {}'.format(value))
+
+    return ts.tz_localize(timezone) if ts.tzinfo is None else ts
+
+
+def validateRequest(tableName, columns, exportFormat, compression):
+    """
+    Check an export request against the whitelists.
+
+    Returns:
+        list of str; columns to export, defaulting to all
+    """
+    if tableName not in exportableColumns:
+        raise ExportError('unknown table: {}'.format(tableName))
+    if exportFormat not in formats:
+        raise ExportError('unknown format: {}'.format(exportFormat))
+    if compression not in (None, 'gzip'):
+        raise ExportError('unknown compression: {}'.format(compression))
+
+    if not columns:
+        return exportableColumns[tableName]
+
+    unknown = [column for column in columns
+               if column not in exportableColumns[tableName]]
+    if unknown:
+        raise ExportError('unknown columns: {}'.format(', '.join(unknown)))
+
+    return list(columns)
+
+
+def fetchChunks(conn, tableName, columns, start=None, end=None, sensorId=None):
+    """
+    Read rows oldest first through a server-side cursor.
+
+    Yields:
+        (column descriptions, list of row tuples) per chunk
+    """
+    tsColumn = tsColumns[tableName]
+
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('{} >= %s'.format(tsColumn))
+        params.append(start.to_pydatetime())
+    if end is not None:
+        conditions.append('{} < %s'.format(tsColumn))
+        params.append(end.to_pydatetime())
+    if sensorId is not None and tableName == 'sensor_data':
+        conditions.append('sensor_id = %s')
+        params.append(sensorId)
+
+    whereClause = 'WHERE {} '.format(' AND '.join(conditions)) if conditions else ''
+
+    cur = conn.cursor(name='airdash_export',
+                      cursor_factory=psycopg2.extensions.cursor)
+    cur.itersize = chunkRows
+
+    try:
+        cur.execute("SELECT {} FROM {} {}ORDER BY {} ASC ".format(
+            ', '.join(columns), tableName, whereClause, tsColumn), params)
+
+        rows = cur.fetchmany(chunkRows)
+        description = cur.description
+
+        while rows:
+            yield description, rows
+            rows = cur.fetchmany(chunkRows)
+    finally:
+        cur.close()
+        conn.rollback()  # End read-only transaction.
+
+
+def jsonValue(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def encodeCsv(chunks, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    for description, rows in chunks:
+        writer.writerows([[jsonValue(value) for value in row] for row in rows])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue().encode('utf-8')
+
+
+def encodeNdjson(chunks, columns):
+    for description, rows in chunks:
+        yield ''.join(json.dumps(dict(zip(columns, [jsonValue(value) for value in row]))) + '\n'
+                      for row in rows).encode('utf-8')
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only file that collects bytes until they're taken, so Parquet output can be streamed.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def arrowColumn(values, arrowType):
+    if pa.types.is_floating(arrowType):
+        values = [None if value is None else float(value) for value in values]
+    elif pa.types.is_timestamp(arrowType):
+        values = [None if value is None else value.astimezone(timezone.utc).replace(tzinfo=None)
+                  for value in values]
+    elif pa.types.is_string(arrowType):
+        values = [None if value is None else str(value) for value in values]
+
+    return pa.array(values, type=arrowType)
+
+
+def encodeParquet(chunks, columns, compression=None):
+    sink = ChunkSink()
+    writer = None
+
+    for description, rows in chunks:
+        if writer is None:
+            schema = pa.schema([(desc[0], arrowTypes.get(desc[1], pa.string()))
+                                for desc in description])
+            writer = pq.ParquetWriter(sink, schema,
+                                      compression=compression or 'snappy')
+
+        arrays = [arrowColumn([row[index] for row in rows], field.type)
+                  for index, field in enumerate(schema)]
+
+        # One row group per chunk.
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        yield sink.take()
+
+    if writer is None:
+        # No rows. Write an empty file with text columns.
+        writer = pq.ParquetWriter(sink, pa.schema([(column, pa.string()) for column in columns]))
+    writer.close()
+    yield sink.take()
+
+
+def gzipStream(parts):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+
+    for part in parts:
+        compressed = compressor.compress(part)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def exportStream(conn, tableName, columns=None, start=None, end=None, sensorId=None,
+                 exportFormat='csv', compression=None):
+    """
+    Export rows of a table within a time range.
+
+    Args:
+        conn: psycopg2 connection, not used by anything else until the stream is exhausted
+        tableName: str; sensor_data or weather_data
+        columns: list of str or None; defaults to all exportable columns
+        start: tz-aware pandas Timestamp or None; inclusive lower bound
+        end: tz-aware pandas Timestamp or None; exclusive upper bound
+        sensorId: str or None; only export this sensor's readings
+        exportFormat: str; 'csv', 'ndjson' or 'parquet'
+        compression: str or None; 'gzip'. Parquet is compressed internally.
+
+    Returns:
+        generator of bytes
+    """
+    columns = validateRequest(tableName, columns, exportFormat, compression)
+    chunks = fetchChunks(conn, tableName, columns, start, end, sensorId)
+
+    if exportFormat == 'parquet':
+        return encodeParquet(chunks, columns, compression)
+
+    encoded = encodeCsv(chunks, columns) if exportFormat == 'csv' else encodeNdjson(chunks, columns)
+    return gzipStream(encoded) if compression == 'gzip' else encoded
+
+
+def fileName(tableName, exportFormat, compression):
+    name = '{}.{}'.format(tableName, formats[exportFormat][1])
+    if compression == 'gzip' and exportFormat != 'parquet':
+        name += '.gz'
+    return name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export sensor or weather data.')
+    parser.add_argument('table', choices=sorted(exportableColumns))
+    parser.add_argument('--start', help='first date or time to export, local time')
+    parser.add_argument('--end', help='date or time to stop at (exclusive), local time')
+    parser.add_argument('--sensor', help='only export this sensor ID')
+    parser.add_argument('--columns', help='comma-separated columns; defaults to all')
+    parser.add_argument('--format', default='csv', choices=sorted(formats))
+    parser.add_argument('--compression', choices=['gzip'])
+    parser.add_argument('-o', '--output', help='output file; defaults to stdout')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(us.databaseUrl)
+    conn.set_session(readonly=True)
+
+    try:
+        stream = exportStream(conn, args.table,
+                              args.columns.split(',') if args.columns else None,
+                              parseBound(args.start), parseBound(args.end), args.sensor,
+                              args.format, args.compression)
+    except ExportError as e:
+        parser.error(str(e))
+
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    for part in stream:
+        output.write(part)
+    output.close()
+
+    conn.close()
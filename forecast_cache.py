@@ -0,0 +1,71 @@
+
+"""
+In-memory snapshot of the weather forecast, shared by all dashboard sessions in a process.
+
+The forecast only changes when the weather API is polled, so the forecast tables are read once per weather update instead of once per session per update. Rendered panels go in the shared cache, so they're rendered once per update across all processes.
+"""
+
+
+import threading
+
+import page_helper as ph  # Functions to fetch data and build plots.
+import shared_cache as sc  # Results shared across worker processes.
+import structured_logging as slog
+
+
+log = slog.getLogger(__name__)
+
+
+dailyColumns = ['weather_type_id', 'short_weather_descrip', 'detail_weather_descrip',
+                'weather_icon', 'precip_chance', 'uvi', 'min_f', 'max_f', 'min_c', 'max_c']
+hourlyColumns = ['weather_type_id', 'short_weather_descrip', 'detail_weather_descrip',
+                 'weather_icon', 'precip_chance', 'temp_f', 'temp_c', 'humidity']
+
+
+class ForecastSnapshot(object):
+    """
+    Forecast data and rendered panels, rebuilt when the forecast is refreshed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Weather generation the snapshot was read at.
+        self.generation = None
+
+        self.daily = None
+        self.hourly = None
+
+    def refresh(self, pool):
+        with self.lock:
+            generation = sc.cache.generation('weather')
+            if generation == self.generation:
+                return
+
+            log.info('rebuilding forecast snapshot')
+            self.generation = generation
+
+            self.daily = ph.describeWeather(
+                ph.fetchDailyForecastData(pool, dailyColumns))
+            self.hourly = ph.describeWeather(
+                ph.fetchHourlyForecastData(pool, hourlyColumns))
+
+    def panel(self, pool, name, tempUnit, render):
+        """
+        Get a rendered forecast panel, rendering it only if the forecast changed since it was last rendered.
+
+        Args:
+            name: str; 'daily' or 'hourly'
+            tempUnit: str; 'temp_f' or 'temp_c'
+            render: function taking (forecast dataframe, tempUnit) and returning the panel
+
+        Returns:
+            rendered panel
+        """
+        def build():
+            self.refresh(pool)
+            return render(self.daily if name == 'daily' else self.hourly, tempUnit)
+
+        return sc.getOrCompute(['weather'], ('forecast', name, tempUnit), build)
+
+
+snapshot = ForecastSnapshot()
@@ -0,0 +1,209 @@
+
+"""
+Index of intervals in which a sensor didn't report, e.g. while its WiFi was down.
+
+Each sensor's reporting cadence is the median time between its readings. A gap is an interval between two consecutive readings longer than GAP_FACTOR (3 by default) times the cadence, stored in sensor_gaps from the last reading before it to the first one after. Gaps are recorded at ingest as readings arrive, and rebuilt from history with a window-function sweep:
+
+    python gaps.py
+
+backfill.py fills them from local files, and plots break their lines across them.
+"""
+
+
+import statistics
+import threading
+from collections import deque
+
+import pandas as pd
+import psycopg2
+
+import metrics  # Gap counters.
+import structured_logging as slog
+import user_settings as us
+
+
+log = slog.getLogger(__name__)
+
+# Intervals between readings used to estimate a sensor's cadence.
+cadenceReadings = 30
+
+
+def sweep(cur, sensorIds=None, factor=us.gapFactor):
+    """
+    Rebuild gaps from stored readings, for all sensors or some.
+
+    Args:
+        cur: psycopg2 cursor
+        sensorIds: list of str or None; sensors to rebuild ('' for readings without a sensor ID). Defaults to all.
+
+    Returns:
+        number of gaps found
+    """
+    condition = "WHERE COALESCE(sensor_id, '') = ANY(%s) " if sensorIds is not None else ''
+    params = [list(sensorIds)] if sensorIds is not None else []
+
+    cur.execute("DELETE FROM sensor_gaps {}".format(condition), params)
+    cur.execute("WITH intervals AS ( "
+                "SELECT COALESCE(sensor_id, '') AS sensor_id, measurement_ts, "
+                "LAG(measurement_ts) OVER (PARTITION BY COALESCE(sensor_id, '') ORDER BY measurement_ts) AS previous_ts "
+                "FROM sensor_data {0}"
+                "), cadences AS ( "
+                "SELECT sensor_id, percentile_cont(0.5) WITHIN GROUP ("
+                "ORDER BY EXTRACT(EPOCH FROM measurement_ts - previous_ts)) AS cadence_s "
+                "FROM intervals WHERE previous_ts IS NOT NULL GROUP BY sensor_id "
+                ") "
+                "INSERT INTO sensor_gaps (sensor_id, gap_start, gap_end, cadence_s) "
+                "SELECT intervals.sensor_id, previous_ts, measurement_ts, cadence_s "
+                "FROM intervals JOIN cadences USING (sensor_id) "
+                "WHERE EXTRACT(EPOCH FROM measurement_ts - previous_ts) > %s * cadence_s ".format(condition),
+                params + [factor])
+    found = cur.rowcount
+
+    log.info('swept sensor gaps', extra={'fields': {
+        'sensors': 'all' if sensorIds is None else len(sensorIds), 'gaps': found}})
+    return found
+
+
+def fetchGaps(cur, start=None, end=None, sensorIds=None):
+    """
+    Gaps overlapping a time range.
+
+    Args:
+        start, end: datetimes or None for unbounded
+        sensorIds: list of str or None for all sensors
+
+    Returns:
+        list of (sensor ID, gap start, gap end) tuples, oldest first
+    """
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('gap_end > %s')
+        params.append(start)
+    if end is not None:
+        conditions.append('gap_start < %s')
+        params.append(end)
+    if sensorIds is not None:
+        conditions.append('sensor_id = ANY(%s)')
+        params.append(list(sensorIds))
+
+    whereClause = 'WHERE {} '.format(' AND '.join(conditions)) if conditions else ''
+    cur.execute("SELECT sensor_id, gap_start, gap_end FROM sensor_gaps {}ORDER BY gap_start ASC ".format(
+        whereClause), params)
+
+    return [tuple(row) for row in cur.fetchall()]
+
+
+class GapDetector(object):
+    """
+    Records gaps as readings arrive, from the time since each sensor's previous reading.
+
+    A sensor's recent readings are loaded from the database the first time it's seen. Since other processes may have stored readings this one didn't see, a gap is only recorded once the database confirms there's no reading in it.
+    """
+
+    def __init__(self, factor=us.gapFactor):
+        self.factor = factor
+        # Sensor ID -> {'lastTs': latest reading time, 'intervals': deque of recent intervals in seconds}
+        self.sensors = dict()
+        self.lock = threading.Lock()
+
+    def load(self, cur, sensorId, before):
+        cur.execute("SELECT measurement_ts FROM sensor_data "
+                    "WHERE sensor_id IS NOT DISTINCT FROM %s AND measurement_ts < %s "
+                    "ORDER BY measurement_ts DESC LIMIT %s ",
+                    (sensorId, before, cadenceReadings + 1))
+        times = [pd.Timestamp(row[0]).tz_convert('UTC') for row in reversed(cur.fetchall())]
+
+        state = {'lastTs': times[-1] if times else None,
+                 'intervals': deque([(later - earlier).total_seconds() for earlier, later in zip(times, times[1:])],
+                                    maxlen=cadenceReadings)}
+        self.sensors[sensorId] = state
+        return state
+
+    def forget(self, sensorId):
+        """
+        Drop a sensor's recent readings, so they're reloaded with its next reading, e.g. after its readings were rolled back.
+        """
+        with self.lock:
+            self.sensors.pop(sensorId, None)
+
+    def cadence(self, state):
+        return statistics.median(state['intervals']) if state['intervals'] else None
+
+    def update(self, row, cur):
+        """
+        Add an inserted reading, recording the gap before it or splitting the gap it falls in. Runs in the inserting transaction.
+
+        Args:
+            row: dict of sensor_data column -> value
+            cur: psycopg2 cursor
+        """
+        sensorId = row.get('sensor_id')
+        ts = pd.Timestamp(row['measurement_ts']).tz_convert('UTC')
+
+        with self.lock:
+            state = self.sensors.get(sensorId)
+            if state is None:
+                state = self.load(cur, sensorId, ts.to_pydatetime())
+                # Readings stored by other processes may be newer, with a gap around this one.
+                self.split(cur, sensorId, ts)
+
+            lastTs = state['lastTs']
+            if lastTs is not None and ts <= lastTs:
+                # Late reading, e.g. replayed after newer ones. It may fall in a recorded gap.
+                self.split(cur, sensorId, ts)
+                return
+
+            if lastTs is not None:
+                interval = (ts - lastTs).total_seconds()
+                cadence = self.cadence(state)
+
+                if cadence and interval > self.factor * cadence:
+                    self.record(cur, sensorId, ts, cadence)
+
+                state['intervals'].append(interval)
+
+            state['lastTs'] = ts
+
+    def record(self, cur, sensorId, ts, cadence):
+        # The reading before this one may have been stored by another process.
+        cur.execute("SELECT MAX(measurement_ts) FROM sensor_data "
+                    "WHERE sensor_id IS NOT DISTINCT FROM %s AND measurement_ts < %s ",
+                    (sensorId, ts.to_pydatetime()))
+        previousTs = cur.fetchone()[0]
+
+        if previousTs is None or (ts - pd.Timestamp(previousTs)).total_seconds() <= self.factor * cadence:
+            return
+
+        # Another process may also have stored readings after this one, and the gap from the previous one past it.
+        self.split(cur, sensorId, ts)
+        cur.execute("INSERT INTO sensor_gaps (sensor_id, gap_start, gap_end, cadence_s) "
+                    "VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING ",
+                    (sensorId or '', previousTs, ts.to_pydatetime(), cadence))
+
+        log.info('sensor gap detected', extra={'fields': {
+            'sensor_id': sensorId, 'gap_start': previousTs, 'gap_end': ts}})
+        metrics.increment('sensor_gaps_detected')
+
+    def split(self, cur, sensorId, ts):
+        """
+        Replace a gap containing a reading by the parts before and after it that are still gaps.
+        """
+        cur.execute("DELETE FROM sensor_gaps WHERE sensor_id = %s AND gap_start < %s AND gap_end > %s "
+                    "RETURNING gap_start, gap_end, cadence_s ",
+                    (sensorId or '', ts.to_pydatetime(), ts.to_pydatetime()))
+
+        for gapStart, gapEnd, cadence in cur.fetchall():
+            for partStart, partEnd in ((gapStart, ts.to_pydatetime()), (ts.to_pydatetime(), gapEnd)):
+                if (partEnd - partStart).total_seconds() > self.factor * float(cadence):
+                    cur.execute("INSERT INTO sensor_gaps (sensor_id, gap_start, gap_end, cadence_s) "
+                                "VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING ",
+                                (sensorId or '', partStart, partEnd, cadence))
+
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(us.databaseUrl)
+    cur = conn.cursor()
+    sweep(cur)
+    conn.commit()
+    conn.close()
@@ -0,0 +1,342 @@
+
+"""
+In-memory hot tier holding the last couple of weeks of sensor and weather readings, so short date ranges don't need a database round trip.
+"""
+
+
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import user_settings as us
+import weather_fetch as wf
+import structured_logging as slog
+
+
+log = slog.getLogger(__name__)
+
+# Numeric columns kept in memory. Any other column is fetched from the database.
+sensorColumns = ['temp_f', 'temp_c', 'humidity', 'dewpoint_f', 'pressure_mbar',
+                 'pm_2_5_aqi', 'pm_10_0_aqi',
+                 'pm_1_0_um_m3', 'pm_2_5_um_m3', 'pm_10_0_um_m3',
+                 'temp_f_corrected', 'temp_c_corrected', 'humidity_corrected',
+                 'pm_2_5_epa_um_m3', 'pm_2_5_epa_aqi',
+                 'pm_2_5_nowcast_aqi', 'pm_10_0_nowcast_aqi',
+                 'pm_2_5_24h_avg_um_m3', 'pm_2_5_24h_aqi', 'hours_above_aqi_threshold_24h',
+                 'temp_f_day_high', 'temp_f_day_low']
+
+weatherColumns = ['temp_f', 'temp_c', 'temp_feels_like_f', 'temp_feels_like_c',
+                  'humidity', 'dewpoint_f', 'pressure_mbar']
+
+# Rows per day of one sensor with readings every 2 minutes, plus headroom for irregular reporting.
+rowsPerDay = 24 * 30 * 1.25
+
+# Minimum time between checks for rows written by other processes.
+catchUpSeconds = 30
+
+# How far before the newest row held catching up looks again. Another process's rows can commit after newer ones, e.g. a spool batch replayed while readings are written directly.
+catchUpOverlap = pd.Timedelta(minutes=10)
+
+
+class RingBuffer(object):
+    """
+    Fixed-capacity, time-ordered buffer of numeric rows backed by numpy arrays.
+
+    Each row is written twice, `capacity` slots apart, so the newest rows always form one contiguous slice that can be returned as a view.
+    """
+
+    def __init__(self, columns, capacity):
+        self.columns = list(columns)
+        self.capacity = int(capacity)
+        self.ts = np.zeros(2 * self.capacity, dtype='int64')  # ns since epoch, UTC
+        self.values = np.full((len(self.columns), 2 * self.capacity), np.nan)
+        self.count = 0  # Rows ever appended.
+
+    def size(self):
+        return min(self.count, self.capacity)
+
+    def window(self):
+        """
+        Slice bounds of the rows currently held, oldest first.
+        """
+        end = self.count % self.capacity + self.capacity
+        return end - self.size(), end
+
+    def latest(self):
+        if not self.count:
+            return None
+        return self.ts[self.window()[1] - 1]
+
+    def append(self, ts, values):
+        """
+        Append a row newer than any row held. Returns the timestamp of the row evicted to make room, if any.
+        """
+        evicted = self.ts[self.window()[0]] if self.count >= self.capacity else None
+
+        position = self.count % self.capacity
+        for index in (position, position + self.capacity):
+            self.ts[index] = ts
+            self.values[:, index] = values
+
+        self.count += 1
+        return evicted
+
+    def reset(self, ts, values):
+        """
+        Replace buffer contents with rows sorted oldest first. Only the newest `capacity` rows are kept.
+
+        Args:
+            ts: int64 array of ns since epoch
+            values: float array of shape (number of columns, number of rows)
+        """
+        ts = ts[-self.capacity:]
+        values = values[:, -self.capacity:]
+
+        self.count = 0
+        self.ts[:len(ts)] = ts
+        self.ts[self.capacity:self.capacity + len(ts)] = ts
+        self.values[:, :len(ts)] = values
+        self.values[:, self.capacity:self.capacity + len(ts)] = values
+        self.count = len(ts)
+
+    def slice(self, start=None, end=None):
+        """
+        Rows with start <= ts < end, oldest first, as views into the buffer.
+
+        Returns:
+            (ts, values) tuple of numpy array views
+        """
+        lo, hi = self.window()
+        ts = self.ts[lo:hi]
+
+        first = 0 if start is None else np.searchsorted(ts, start, side='left')
+        last = len(ts) if end is None else np.searchsorted(ts, end, side='left')
+
+        return ts[first:last], self.values[:, lo + first:lo + last]
+
+
+class HotTier(object):
+    """
+    Recent rows of one table, fed by the ingest path and kept current with rows other processes wrote.
+
+    Rows are held in one ring buffer per value of a key column, e.g. per sensor, so each sensor keeps `days` of readings however many report, and readings of different sensors at the same time are all kept.
+    """
+
+    def __init__(self, tableName, tsColumn, columns, days, equals=None, keyColumn=None):
+        self.tableName = tableName
+        self.tsColumn = tsColumn
+        self.columns = list(columns)
+        # Column -> value rows must have to be held, e.g. one weather location.
+        self.equals = dict(equals or {})
+        # Column rows are buffered by, or None for one buffer.
+        self.keyColumn = keyColumn
+        self.days = days
+        self.capacity = days * rowsPerDay
+        self.buffers = dict()  # Key column value -> RingBuffer
+        self.lock = threading.Lock()
+
+        # Time (ns since epoch) the tier was last warmed from, and per key, the time from which on its rows are all in its buffer. None until warmed.
+        self.coverageStart = None
+        self.keyCoverage = dict()
+        self.lastCatchUp = 0
+
+    def rowValues(self, row):
+        return [np.nan if row.get(column) is None else float(row[column])
+                for column in self.columns]
+
+    def query(self, pool, since):
+        """
+        Fetch rows newer than `since` from the database, oldest first.
+
+        Returns:
+            dict of key -> (ts, values) arrays as held in the key's buffer
+        """
+        conditions = ''.join(' AND {} = %s'.format(column) for column in self.equals)
+        keySelect = '' if self.keyColumn is None else ', ' + self.keyColumn
+
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT {}{} FROM {} WHERE {} > %s{} ORDER BY {} ASC ".format(
+                ', '.join([self.tsColumn] + self.columns), keySelect, self.tableName, self.tsColumn,
+                conditions, self.tsColumn),
+                [since.to_pydatetime()] + list(self.equals.values()))
+            rows = cur.fetchall()
+            cur.close()
+
+        rowsByKey = dict()
+        for row in rows:
+            rowsByKey.setdefault(None if self.keyColumn is None else row[-1], []).append(row)
+
+        columnCount = len(self.columns)
+        return {key: (np.array([pd.Timestamp(row[0]).value for row in keyRows], dtype='int64'),
+                      np.array([[np.nan if value is None else value for value in row[1:1 + columnCount]]
+                                for row in keyRows], dtype='float64').reshape(len(keyRows), columnCount).T)
+                for key, keyRows in rowsByKey.items()}
+
+    def warm(self, pool):
+        """
+        Load the last `days` days of rows from the database.
+        """
+        since = pd.Timestamp.now(tz='UTC') - pd.DateOffset(days=self.days)
+        rowsByKey = self.query(pool, since)
+
+        with self.lock:
+            self.buffers = dict()
+            self.keyCoverage = dict()
+            for key, (ts, values) in rowsByKey.items():
+                buffer = self.buffers[key] = RingBuffer(self.columns, self.capacity)
+                buffer.reset(ts, values)
+                self.keyCoverage[key] = since.value if len(ts) <= buffer.capacity else ts[-buffer.capacity]
+            self.coverageStart = since.value
+            self.lastCatchUp = time.time()
+
+        log.info('warmed hot tier', extra={'fields': {
+            'table': self.tableName, 'keys': len(rowsByKey),
+            'rows': sum(len(ts) for ts, values in rowsByKey.values())}})
+
+    def latest(self):
+        """
+        Newest timestamp held for any key, or None.
+        """
+        with self.lock:
+            held = [buffer.latest() for buffer in self.buffers.values() if buffer.count]
+        return max(held) if held else None
+
+    def catchUp(self, pool):
+        """
+        Add rows written by other processes since shortly before the newest row held. Rows already held are skipped. Runs at most every catchUpSeconds.
+        """
+        if self.coverageStart is None or time.time() - self.lastCatchUp < catchUpSeconds:
+            return
+
+        self.lastCatchUp = time.time()
+
+        latest = self.latest()
+        since = pd.Timestamp(self.coverageStart if latest is None
+                             else max(self.coverageStart, latest - catchUpOverlap.value), tz='UTC')
+
+        for key, (ts, values) in self.query(pool, since).items():
+            for index in range(len(ts)):
+                self.addValues(key, ts[index], values[:, index])
+
+    def reload(self, pool):
+        """
+        Load all rows again, e.g. after another process added or changed rows older than the newest held, which catching up misses. Rows ingested meanwhile are caught up on the next read.
+        """
+        self.warm(pool)
+        self.expire()
+
+    def expire(self):
+        """
+        Catch up on the next read instead of waiting out catchUpSeconds, e.g. when another process reports new rows.
+        """
+        self.lastCatchUp = 0
+
+    def add(self, row):
+        """
+        Add a newly ingested row.
+
+        Args:
+            row: dict of column name -> value, including the timestamp and key columns
+        """
+        if self.coverageStart is None:
+            return
+        if any(row.get(column) != value for column, value in self.equals.items()):
+            return
+
+        key = None if self.keyColumn is None else row.get(self.keyColumn)
+        self.addValues(key, pd.Timestamp(row[self.tsColumn]).value, self.rowValues(row))
+
+    def addValues(self, key, ts, values):
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                # First row of a key since warming. Rows before it weren't in the database then.
+                buffer = self.buffers[key] = RingBuffer(self.columns, self.capacity)
+                self.keyCoverage[key] = self.coverageStart
+
+            latest = buffer.latest()
+
+            if latest is None or ts > latest:
+                evicted = buffer.append(ts, values)
+                if evicted is not None:
+                    self.keyCoverage[key] = max(self.keyCoverage[key], evicted + 1)
+                return
+
+            # Late reading. Rebuild the key's buffer in time order unless it's a duplicate.
+            heldTs, heldValues = buffer.slice()
+            position = np.searchsorted(heldTs, ts)
+            if position < len(heldTs) and heldTs[position] == ts:
+                return
+
+            buffer.reset(np.insert(heldTs, position, ts),
+                         np.insert(heldValues, position, values, axis=1))
+
+    def select(self, names, start, end=None, equals=None):
+        """
+        Answer a time range query from memory.
+
+        Args:
+            names: list of str; timestamp column followed by data columns, which may include the key column
+            start: tz-aware pandas Timestamp; inclusive lower bound
+            end: tz-aware pandas Timestamp or None; exclusive upper bound
+            equals: dict of column -> value rows must have; must match the tier's, apart from the key column
+
+        Returns:
+            pandas dataframe of matching rows, newest first, or None if the query can't be answered from memory
+        """
+        if self.coverageStart is None or start is None or start.value < self.coverageStart:
+            return None
+        if any(name not in self.columns and name != self.keyColumn for name in names[1:]):
+            return None
+
+        equals = dict(equals or {})
+        keys = [equals.pop(self.keyColumn)] if self.keyColumn in equals else None
+        if equals != self.equals:
+            return None
+
+        valueNames = [name for name in names[1:] if name != self.keyColumn]
+
+        with self.lock:
+            if keys is None:
+                keys = list(self.buffers)
+
+            parts = []
+            for key in keys:
+                if key not in self.buffers:
+                    continue
+                if start.value < self.keyCoverage[key]:
+                    return None
+
+                ts, values = self.buffers[key].slice(start.value, None if end is None else end.value)
+
+                # Reversed views give newest-first order without copying.
+                part = pd.DataFrame({name: values[self.columns.index(name)][::-1] for name in valueNames},
+                                    columns=valueNames)
+                part.insert(0, self.tsColumn, pd.to_datetime(ts[::-1], utc=True))
+                if self.keyColumn in names:
+                    part[self.keyColumn] = key
+                parts.append(part)
+
+        if not parts:
+            return pd.DataFrame({name: [] for name in names}).astype({self.tsColumn: 'datetime64[ns, UTC]'})
+
+        if len(parts) == 1:
+            return parts[0][names]
+
+        return pd.concat(parts, ignore_index=True).sort_values(
+            self.tsColumn, ascending=False, kind='stable', ignore_index=True)[names]
+
+
+sensorTier = HotTier('sensor_data', 'measurement_ts', sensorColumns, us.hotTierDays, keyColumn='sensor_id')
+weatherTier = HotTier('weather_data', 'ts', weatherColumns, us.hotTierDays,
+                      equals={'location_key': wf.primaryLocationKey})
+
+tiers = {tier.tableName: tier for tier in (sensorTier, weatherTier)} if us.hotTierDays else {}
+
+
+def warmAll(pool):
+    for tier in tiers.values():
+        tier.warm(pool)
@@ -0,0 +1,49 @@
+
+"""
+Process-wide counters and timings, served as JSON from /metrics.
+"""
+
+
+import os
+import threading
+
+
+lock = threading.Lock()
+
+counters = {}
+
+# Name -> {'count', 'total', 'max'} of observed values.
+timings = {}
+
+
+def increment(name, amount=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def observe(name, value):
+    """
+    Record one observation of a timing or size.
+
+    Args:
+        name: str
+        value: numeric
+    """
+    with lock:
+        summary = timings.setdefault(name, {'count': 0, 'total': 0, 'max': 0})
+        summary['count'] += 1
+        summary['total'] += value
+        summary['max'] = max(summary['max'], value)
+
+
+def snapshot():
+    """
+    Copy of all metrics recorded by this process.
+
+    Returns:
+        dict
+    """
+    with lock:
+        return {'pid': os.getpid(),
+                'counters': dict(counters),
+                'timings': {name: dict(summary) for name, summary in timings.items()}}
@@ -0,0 +1,416 @@
+
+"""
+Versioned schema migrations for the air database.
+
+Each migration runs once, in order, in its own transaction, and is recorded in the schema_version table. Run pending migrations before starting or upgrading the app:
+
+    python migrations.py
+
+`python migrations.py status` lists applied and pending migrations.
+"""
+
+
+import argparse
+
+import psycopg2
+
+import user_settings as us
+import weather_fetch as wf
+import structured_logging as slog
+
+
+log = slog.getLogger(__name__)
+
+
+# Advisory lock held while migrating, so concurrent runs wait for each other.
+lockKey = 0x61697264  # 'aird'
+
+# (version, description, function taking a cursor), in version order.
+migrations = []
+
+
+def migration(version, description):
+    """
+    Register a migration. Versions must be added in increasing order and never changed once released.
+    """
+    def register(function):
+        if migrations and version <= migrations[-1][0]:
+            raise ValueError(
+                'migration {} registered out of order'.format(version))
+        migrations.append((version, description, function))
+        return function
+    return register
+
+
+def addColumns(cur, tableName, columnTypes):
+    for column, columnType in columnTypes.items():
+        cur.execute("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {} ".format(
+            tableName, column, columnType))
+
+
+@migration(1, 'create sensor, weather and forecast tables')
+def createTables(cur):
+    # IF NOT EXISTS adopts databases created before migrations existed.
+    cur.execute("CREATE TABLE IF NOT EXISTS sensor_data ( "
+                # Metadata
+                "id numeric "
+                ", sensor_id text "
+                ", place text "
+                ", version text "
+                ", hardware_version text "
+                ", uptime_s numeric CHECK (uptime_s >= 0) "
+                ", rssi_dbm numeric "
+                # Implied UNIQUE and NOT NULL constraint
+                ", measurement_ts timestamptz PRIMARY KEY "
+
+                # Environment data
+                ", temp_f numeric "
+                ", temp_c numeric "
+                ", humidity numeric CHECK (humidity >= 0 AND humidity <= 100) "
+                ", dewpoint_f numeric CHECK (dewpoint_f <= temp_f) "
+                ", pressure_mbar numeric "
+
+                # Air data
+                ", pm_2_5_aqi numeric "
+                ", pm_2_5_aqi_rgb text "
+                ", pm_2_5_aqi_description text "
+                ", pm_2_5_aqi_message text "
+
+                ", pm_10_0_aqi numeric "
+                ", pm_10_0_aqi_rgb text "
+                ", pm_10_0_aqi_description text "
+                ", pm_10_0_aqi_message text "
+
+                ", pm_1_0_um_m3 numeric "
+                ", pm_2_5_um_m3 numeric "
+                ", pm_10_0_um_m3 numeric "
+
+                ", p_0_3_count_dl numeric "
+                ", p_0_5_count_dl numeric "
+                ", p_1_0_count_dl numeric "
+                ", p_2_5_count_dl numeric "
+                ", p_5_0_count_dl numeric "
+                ", p_10_0_count_dl numeric "
+                ") ")
+
+    # Outside weather data.
+    cur.execute("CREATE TABLE IF NOT EXISTS weather_data ("
+                "id SERIAL "  # Auto-incrementing
+                ", ts timestamptz PRIMARY KEY "  # Implied UNIQUE and NOT NULL constraint
+                ", timezone text "
+                ", ts_offset numeric "
+
+                # Environment data
+                ", temp_f numeric "
+                ", temp_c numeric "
+                ", temp_feels_like_f numeric "
+                ", temp_feels_like_c numeric "
+                ", humidity numeric CHECK (humidity >= 0 AND humidity <= 100) "
+                ", dewpoint_f numeric CHECK (dewpoint_f <= temp_f) "
+                ", pressure_mbar numeric "
+                ")")
+
+    # Daily weather forecast.
+    cur.execute("CREATE TABLE IF NOT EXISTS daily_weather_forecast ("
+                "id SERIAL "  # Auto-incrementing
+                ", ts timestamptz PRIMARY KEY "  # Implied UNIQUE and NOT NULL constraint
+                ", timezone text "
+                ", ts_offset numeric "
+
+                # Environment data
+                ", min_f numeric "
+                ", min_c numeric "
+                ", max_f numeric "
+                ", max_c numeric "
+                ", weather_type_id numeric "
+                ", short_weather_descrip text "
+                ", detail_weather_descrip text "
+                ", weather_icon text "
+                ", precip_chance numeric "
+                ", uvi numeric "
+                ")")
+
+    # Hourly weather forecast.
+    cur.execute("CREATE TABLE IF NOT EXISTS hourly_weather_forecast ("
+                "id SERIAL "  # Auto-incrementing
+                ", ts timestamptz PRIMARY KEY "  # Implied UNIQUE and NOT NULL constraint
+                ", timezone text "
+                ", ts_offset numeric "
+
+                # Environment data
+                ", temp_f numeric "
+                ", temp_c numeric "
+                ", humidity numeric CHECK (humidity >= 0 AND humidity <= 100) "
+                ", dewpoint_f numeric CHECK (dewpoint_f <= temp_f) "
+                ", weather_type_id numeric "
+                ", short_weather_descrip text "
+                ", detail_weather_descrip text "
+                ", weather_icon text "
+                ", precip_chance numeric "
+                ")")
+
+
+@migration(2, 'add corrected and EPA-corrected sensor columns')
+def addDerivedColumns(cur):
+    addColumns(cur, 'sensor_data', {'temp_f_corrected': 'numeric',
+                                    'temp_c_corrected': 'numeric',
+                                    'humidity_corrected': 'numeric',
+                                    'pm_2_5_epa_um_m3': 'numeric',
+                                    'pm_2_5_epa_aqi': 'numeric',
+                                    'pm_2_5_epa_aqi_rgb': 'text',
+                                    'pm_2_5_epa_aqi_description': 'text',
+                                    'pm_2_5_epa_aqi_message': 'text'})
+
+
+@migration(3, 'add NowCast AQI columns')
+def addNowCastColumns(cur):
+    addColumns(cur, 'sensor_data', {'pm_2_5_nowcast_aqi': 'numeric',
+                                    'pm_10_0_nowcast_aqi': 'numeric'})
+
+
+@migration(4, 'add sliding-window statistics columns')
+def addWindowColumns(cur):
+    addColumns(cur, 'sensor_data', {'pm_2_5_24h_avg_um_m3': 'numeric',
+                                    'pm_2_5_24h_aqi': 'numeric',
+                                    'hours_above_aqi_threshold_24h': 'numeric',
+                                    'temp_f_day_high': 'numeric',
+                                    'temp_f_day_low': 'numeric'})
+
+
+@migration(5, 'index sensor readings by sensor and time')
+def indexSensorReadings(cur):
+    # Used by per-sensor history loads at ingest.
+    cur.execute("CREATE INDEX IF NOT EXISTS sensor_data_sensor_id_measurement_ts_idx "
+                "ON sensor_data (sensor_id, measurement_ts) ")
+
+
+@migration(6, 'key weather data and forecasts by location')
+def keyWeatherByLocation(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS sensors ( "
+                "sensor_id text PRIMARY KEY "
+                ", latitude numeric "
+                ", longitude numeric "
+                ", location_key text "
+                ", updated_at timestamptz "
+                ") ")
+
+    # Last weather fetch per location, claimed by whichever process fetches next.
+    cur.execute("CREATE TABLE IF NOT EXISTS weather_fetches ( "
+                "location_key text PRIMARY KEY "
+                ", fetched_at timestamptz NOT NULL "
+                ") ")
+
+    # Existing rows were fetched for the configured location.
+    for tableName in ('weather_data', 'daily_weather_forecast', 'hourly_weather_forecast'):
+        addColumns(cur, tableName, {'location_key': 'text'})
+        cur.execute("UPDATE {} SET location_key = %s WHERE location_key IS NULL ".format(tableName),
+                    (wf.primaryLocationKey,))
+        cur.execute("ALTER TABLE {0} ALTER COLUMN location_key SET NOT NULL "
+                    ", DROP CONSTRAINT IF EXISTS {0}_pkey "
+                    ", ADD PRIMARY KEY (location_key, ts) ".format(tableName))
+
+
+@migration(7, 'add alert state table')
+def createAlertState(cur):
+    # One row per ongoing rule breach. sensor_id is '' for readings without one.
+    cur.execute("CREATE TABLE IF NOT EXISTS alert_state ( "
+                "sensor_id text NOT NULL "
+                ", rule_id text NOT NULL "
+                ", breach_start timestamptz NOT NULL "
+                ", fired_at timestamptz "
+                ", PRIMARY KEY (sensor_id, rule_id) "
+                ") ")
+
+
+@migration(8, 'add AQI recompute progress table')
+def createRecomputeProgress(cur):
+    # One row per chunk of history recomputed by aqi_recompute.py, committed with the chunk's updates.
+    cur.execute("CREATE TABLE IF NOT EXISTS aqi_recompute_progress ( "
+                "job_id text NOT NULL "
+                ", chunk_start timestamptz NOT NULL "
+                ", chunk_end timestamptz NOT NULL "
+                ", rows_updated integer NOT NULL "
+                ", completed_at timestamptz NOT NULL DEFAULT now() "
+                ", PRIMARY KEY (job_id, chunk_start) "
+                ") ")
+
+
+@migration(9, 'add hourly and daily summary tables')
+def createSummaries(cur):
+    # Count, sum, minimum and maximum of a few metrics per sensor, per UTC hour and per local calendar day. See summaries.py.
+    metrics = ['pm_2_5_aqi', 'pm_2_5_epa_aqi', 'temp_f_corrected']
+    columnTypes = {'{}_{}'.format(metric, statistic): columnType for metric in metrics
+                   for statistic, columnType in [('count', 'integer NOT NULL DEFAULT 0'),
+                                                 ('sum', 'numeric NOT NULL DEFAULT 0'),
+                                                 ('min', 'numeric'), ('max', 'numeric')]}
+    statistics = ', '.join('COUNT({0}), COALESCE(SUM({0}), 0), MIN({0}), MAX({0})'.format(metric)
+                           for metric in metrics)
+
+    buckets = [('hourly_summary', 'hour', 'timestamptz',
+                "date_trunc('hour', measurement_ts AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'", []),
+               ('daily_summary', 'day', 'date', "(measurement_ts AT TIME ZONE %s)::date", [us.timezone])]
+
+    for tableName, bucketColumn, bucketType, bucket, params in buckets:
+        cur.execute("CREATE TABLE IF NOT EXISTS {0} ( "
+                    "sensor_id text NOT NULL "
+                    ", {1} {2} NOT NULL "
+                    ", {3} "
+                    ", PRIMARY KEY (sensor_id, {1}) "
+                    ") ".format(tableName, bucketColumn, bucketType,
+                                ', '.join('{} {}'.format(column, columnType) for column, columnType in columnTypes.items())))
+
+        # Summarize existing readings.
+        cur.execute("DELETE FROM {} ".format(tableName))
+        cur.execute("INSERT INTO {0} (sensor_id, {1}, {2}) "
+                    "SELECT COALESCE(sensor_id, ''), {3}, {4} FROM sensor_data GROUP BY 1, 2 ".format(
+                        tableName, bucketColumn, ', '.join(columnTypes), bucket, statistics),
+                    params)
+
+
+@migration(10, 'add sensor gap index')
+def createGapIndex(cur):
+    # One row per interval a sensor didn't report in, between the readings around it. sensor_id is '' for readings without one.
+    cur.execute("CREATE TABLE IF NOT EXISTS sensor_gaps ( "
+                "sensor_id text NOT NULL "
+                ", gap_start timestamptz NOT NULL "
+                ", gap_end timestamptz NOT NULL "
+                ", cadence_s numeric NOT NULL "
+                ", PRIMARY KEY (sensor_id, gap_start) "
+                ") ")
+    cur.execute("CREATE INDEX IF NOT EXISTS sensor_gaps_gap_end_idx ON sensor_gaps (gap_end) ")
+
+    # Find gaps in existing readings: intervals longer than gapFactor times the sensor's median interval. See gaps.py.
+    cur.execute("DELETE FROM sensor_gaps ")
+    cur.execute("WITH intervals AS ( "
+                "SELECT COALESCE(sensor_id, '') AS sensor_id, measurement_ts, "
+                "LAG(measurement_ts) OVER (PARTITION BY COALESCE(sensor_id, '') ORDER BY measurement_ts) AS previous_ts "
+                "FROM sensor_data "
+                "), cadences AS ( "
+                "SELECT sensor_id, percentile_cont(0.5) WITHIN GROUP ("
+                "ORDER BY EXTRACT(EPOCH FROM measurement_ts - previous_ts)) AS cadence_s "
+                "FROM intervals WHERE previous_ts IS NOT NULL GROUP BY sensor_id "
+                ") "
+                "INSERT INTO sensor_gaps (sensor_id, gap_start, gap_end, cadence_s) "
+                "SELECT intervals.sensor_id, previous_ts, measurement_ts, cadence_s "
+                "FROM intervals JOIN cadences USING (sensor_id) "
+                "WHERE EXTRACT(EPOCH FROM measurement_ts - previous_ts) > %s * cadence_s ",
+                (us.gapFactor,))
+
+
+@migration(11, 'key sensor readings by sensor and time')
+def keySensorReadings(cur):
+    # Readings were keyed by time alone, so two sensors reporting in the same second collided. Readings without a sensor ID are stored under '', as in the other per-sensor tables.
+    cur.execute("UPDATE sensor_data SET sensor_id = '' WHERE sensor_id IS NULL ")
+    cur.execute("ALTER TABLE sensor_data ALTER COLUMN sensor_id SET DEFAULT '' "
+                ", ALTER COLUMN sensor_id SET NOT NULL "
+                ", DROP CONSTRAINT IF EXISTS sensor_data_pkey "
+                ", ADD PRIMARY KEY (sensor_id, measurement_ts) ")
+
+    # The primary key replaces the per-sensor index. Date range queries over all sensors still need one by time.
+    cur.execute("DROP INDEX IF EXISTS sensor_data_sensor_id_measurement_ts_idx ")
+    cur.execute("CREATE INDEX IF NOT EXISTS sensor_data_measurement_ts_idx ON sensor_data (measurement_ts) ")
+
+
+def latestVersion():
+    return migrations[-1][0] if migrations else 0
+
+
+def appliedVersions(cur):
+    cur.execute("SELECT to_regclass('schema_version') ")
+    if cur.fetchone()[0] is None:
+        return set()
+
+    cur.execute("SELECT version FROM schema_version ")
+    return {row[0] for row in cur.fetchall()}
+
+
+def currentVersion(conn):
+    """
+    Highest applied migration version, or 0 for a database that has never been migrated.
+    """
+    cur = conn.cursor()
+    versions = appliedVersions(cur)
+    cur.close()
+    conn.rollback()
+
+    return max(versions, default=0)
+
+
+def migrate(conn, target=None):
+    """
+    Apply pending migrations in order.
+
+    Args:
+        conn: psycopg2 connection
+        target: int or None; highest version to apply. Defaults to all.
+
+    Returns:
+        list of int; versions applied
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s) ", (lockKey,))
+    conn.commit()
+
+    applied = []
+    try:
+        cur.execute("CREATE TABLE IF NOT EXISTS schema_version ( "
+                    "version integer PRIMARY KEY "
+                    ", description text "
+                    ", applied_at timestamptz NOT NULL DEFAULT now() "
+                    ") ")
+        conn.commit()
+
+        done = appliedVersions(cur)
+
+        for version, description, function in migrations:
+            if version in done or (target is not None and version > target):
+                continue
+
+            log.info('applying migration %s: %s', version, description)
+            try:
+                function(cur)
+                cur.execute("INSERT INTO schema_version (version, description) "
+                            "VALUES (%s, %s) ", (version, description))
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+            applied.append(version)
+
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s) ", (lockKey,))
+        conn.commit()
+        cur.close()
+
+    return applied
+
+
+def status(conn):
+    cur = conn.cursor()
+    done = appliedVersions(cur)
+    cur.close()
+    conn.rollback()
+
+    for version, description, function in migrations:
+        print('{} {:>3}  {}'.format('applied' if version in done else 'pending',
+                                    version, description))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate the air database schema.')
+    parser.add_argument('command', nargs='?', default='upgrade',
+                        choices=['upgrade', 'status'])
+    parser.add_argument('--target', type=int,
+                        help='highest migration version to apply')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(us.databaseUrl)
+
+    if args.command == 'status':
+        status(conn)
+    else:
+        applied = migrate(conn, args.target)
+        log.info('applied %s migrations, schema at version %s',
+                 len(applied), currentVersion(conn))
+
+    conn.close()
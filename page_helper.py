@@ -1,31 +1,328 @@
 # -*- coding: utf-8 -*-
 
+import math
+
 import plotly.graph_objects as go  # More complex plotly graphs
 import pandas as pd
 import psycopg2
 
+import archive_management as am  # Reading archived history.
+import hot_tier as ht  # Recent data held in memory.
+import window_stats as ws  # Stored sliding-window statistics.
 import user_settings as us
+import structured_logging as slog
+import weather_fetch as wf  # Weather location keys.
+import summaries  # Hourly and daily summary tables.
+import gaps  # Sensor gap index.
+
+
+# Stored columns with temperature and humidity corrections applied.
+correctedColumns = {'temp_f': 'temp_f_corrected',
+                    'temp_c': 'temp_c_corrected',
+                    'humidity': 'humidity_corrected'}
+
+# Display names and plot colors of AQI species.
+aqiLabels = {"pm_2_5_aqi": "PM 2.5", "pm_10_0_aqi": "PM 10.0",
+             "pm_2_5_epa_aqi": "PM 2.5 (EPA corrected)"}
+aqiColors = {"pm_2_5_aqi": "#636EFA", "pm_10_0_aqi": "#EF553B",
+             "pm_2_5_epa_aqi": "#00CC96"}
+
+# Stored NowCast AQI of each species that has one.
+nowCastColumns = {"pm_2_5_aqi": "pm_2_5_nowcast_aqi",
+                  "pm_10_0_aqi": "pm_10_0_nowcast_aqi"}
+
+# Stored 24-hour average AQI of each species that has one.
+dailyAverageColumns = {"pm_2_5_aqi": "pm_2_5_24h_aqi"}
+
+# Display names of summarized metrics.
+summaryLabels = {'pm_2_5_aqi': 'PM 2.5 AQI',
+                 'pm_2_5_epa_aqi': 'PM 2.5 AQI (EPA corrected)',
+                 'temp_f_corrected': 'Temperature [°F]'}
+
+# EPA AQI colors up to each level's upper cutoff, as a heatmap color scale over AQI 0-300.
+aqiColorScale = []
+for lower, upper, color in [(0, 50, 'rgb(0,228,0)'), (50, 100, 'rgb(255,255,0)'),
+                            (100, 150, 'rgb(255,126,0)'), (150, 200, 'rgb(255,0,0)'),
+                            (200, 300, 'rgb(143,63,151)')]:
+    aqiColorScale += [[lower / 300, color], [upper / 300, color]]
+
+# Statement timeout of dashboard queries for date ranges up to each length, in seconds. Longer ranges read more rows.
+queryTimeouts = [(pd.Timedelta(days=7), 5), (pd.Timedelta(days=31), 10), (pd.Timedelta(days=366), 30)]
+longestQueryTimeout = 60
+
+# Time-series plots are fetched for about this many pixels until the browser reports a plot's width, and for widths rounded up to a multiple of widthStep.
+defaultPlotWidth = 1000
+widthStep = 100
+
+log = slog.getLogger(__name__)
+
+
+def parseTimeRange(standardDate, customDate=None, timezone=us.timezone):
+    """
+    Convert a date range selection into absolute bounds.
+
+    Args:
+        standardDate: str; 'all', 'custom' or an interval such as '3 days'
+        customDate: list of two date str, used when standardDate is 'custom'
+
+    Returns:
+        (start, end) tuple of tz-aware pandas Timestamps, start inclusive and end exclusive. Either may be None if unbounded. None if the custom range is incomplete.
+    """
+    if standardDate == 'all':
+        return None, None
+
+    if standardDate == 'custom':
+        if not customDate or not customDate[0] or not customDate[1]:
+            return None
+
+        # Include all of the last selected day.
+        return (pd.Timestamp(customDate[0], tz=timezone),
+                pd.Timestamp(customDate[1], tz=timezone) + pd.DateOffset(days=1))
+
+    count, unit = standardDate.split()
+    if not unit.endswith('s'):
+        unit += 's'
+
+    return pd.Timestamp.now(tz='UTC') - pd.DateOffset(**{unit: int(count)}), None
+
+
+def queryTimeoutSeconds(standardDate, customDate=None, timezone=us.timezone):
+    """
+    Statement timeout for the queries of a date range selection.
+    """
+    bounds = parseTimeRange(standardDate, customDate, timezone)
+    if bounds is None:
+        return queryTimeouts[0][1]
+
+    start, end = bounds
+    if start is None:
+        return longestQueryTimeout
+
+    length = (end if end is not None else pd.Timestamp.now(tz='UTC')) - start
+    for maxLength, timeoutSeconds in queryTimeouts:
+        if length <= maxLength:
+            return timeoutSeconds
+
+    return longestQueryTimeout
+
+
+def plotView(view, standardDate, customDate=None):
+    """
+    Zoomed x-axis range and pixel width of a time-series plot, as reported by assets/toggles.js.
+
+    Args:
+        view: dict with the date selection the plot was zoomed under, its x-axis range and its width, or None if it isn't zoomed
+
+    Returns:
+        (x0, x1, width) tuple. x0 and x1 are the axis range as str, or None if the plot isn't zoomed within the current date selection.
+    """
+    if not view:
+        return None, None, defaultPlotWidth
+
+    width = int(math.ceil((view.get('width') or defaultPlotWidth) / widthStep)) * widthStep
+    if view.get('selection') != [standardDate] + list(customDate or [None, None]):
+        return None, None, width
+
+    x0, x1 = sorted(view['range'])
+    return x0, x1, width
+
+
+def zoomRange(bounds, x0=None, x1=None, timezone=us.timezone):
+    """
+    Narrow date range bounds to a zoomed plot's x-axis range, with a margin on each side so lines reach the plot edges and short pans don't show empty space.
+
+    Args:
+        bounds: (start, end) tuple as returned by parseTimeRange, or None
+        x0, x1: str; x-axis range, as wall-clock times in the dashboard's timezone. None if not zoomed.
+
+    Returns:
+        (start, end) tuple, or bounds as given if not zoomed
+    """
+    if bounds is None or x0 is None:
+        return bounds
+
+    try:
+        x0, x1 = [pd.Timestamp(x).tz_localize(timezone, ambiguous=True, nonexistent='shift_forward') for x in (x0, x1)]
+    except ValueError:
+        log.info('ignored invalid plot range', extra={'fields': {'range': [x0, x1]}})
+        return bounds
+
+    margin = (x1 - x0) / 10
+    start, end = bounds
+    start = x0 - margin if start is None else max(start, x0 - margin)
+    end = x1 + margin if end is None else min(end, x1 + margin)
+
+    return start, max(start, end)
+
+
+def decimate(records, width, tsColumn='measurement_ts', keyColumn='sensor_id'):
+    """
+    Thin rows to what a plot can show at a pixel width: in the time span of each pixel, the rows with the lowest and highest value of each column, per sensor if the rows have a key column. Peaks are kept, and the number of points is bounded however long the range. Rows from the database are thinned in SQL already (see bucketedQuery); this covers rows from the hot tier and archive.
+
+    Args:
+        records: pandas dataframe
+        width: plot width in pixels
+
+    Returns:
+        pandas dataframe of some of the rows, in their original order
+    """
+    valueColumns = records.columns.drop([tsColumn, keyColumn], errors='ignore')
+    if len(records) <= 2 * width or valueColumns.empty:
+        return records
+
+    records = records.reset_index(drop=True)
+    times = pd.DatetimeIndex(pd.to_datetime(records[tsColumn], utc=True)).asi8
+    span = max((times.max() - times.min()) // width, 1)
+    buckets = pd.Series((times - times.min()) // span, index=records.index)
+
+    kept = []
+    for column in valueColumns:
+        values = pd.to_numeric(records[column], errors='coerce').dropna()
+        groups = [buckets[values.index]]
+        if keyColumn in records:
+            groups.append(records[keyColumn][values.index])
+        grouped = values.groupby(groups)
+        kept += [grouped.idxmin(), grouped.idxmax()]
+
+    rows = pd.Index(pd.concat(kept)).unique().sort_values()
+    return records.loc[rows].reset_index(drop=True)
+
+
+def bucketedQuery(tableName, tsColumn, names, whereClause, keyColumn=None):
+    """
+    SQL thinning rows to what a plot can show, as decimate does: the time span of the rows is split into buckets, one per pixel, and in each bucket the rows with the lowest and highest value of each column are kept, per value of keyColumn if given. Long ranges aren't transferred in full.
 
+    Takes the plot width as the first parameter, followed by the parameters of whereClause twice.
+    """
+    columns = ', '.join(names)
+    valueColumns = [name for name in names[1:] if name != keyColumn]
+    partition = 'bucket' if keyColumn is None else '{}, bucket'.format(keyColumn)
+    ranks = ', '.join('row_number() OVER (PARTITION BY {1} ORDER BY {0} ASC NULLS LAST) AS {0}_low, '
+                      'row_number() OVER (PARTITION BY {1} ORDER BY {0} DESC NULLS LAST) AS {0}_high'.format(
+                          column, partition)
+                      for column in valueColumns)
+    extremes = ' OR '.join('{0}_low = 1 OR {0}_high = 1'.format(column) for column in valueColumns)
+
+    return ("WITH extent AS (SELECT min({ts}) AS first_ts, "
+            "GREATEST(EXTRACT(EPOCH FROM max({ts}) - min({ts})) / %s, 1) AS span FROM {table} {where}), "
+            "bucketed AS (SELECT {columns}, floor(EXTRACT(EPOCH FROM {ts} - first_ts) / span) AS bucket "
+            "FROM {table}, extent {where}), "
+            "ranked AS (SELECT {columns}, {ranks} FROM bucketed) "
+            "SELECT {columns} FROM ranked WHERE {extremes} ORDER BY {ts} DESC ").format(
+        ts=tsColumn, table=tableName, where=whereClause, columns=columns, ranks=ranks, extremes=extremes)
+
+
+def fetchTimeRange(pool, tableName, tsColumn, names, queryFields, bounds, timezone=us.timezone, plainColumns=True, equals=None, width=None):
+    """
+    Fetch rows of a table within a time range. Recent ranges are answered from the in-memory hot tier, archived months are read from Parquet and the rest comes from the database.
+
+    Args:
+        tableName: str; sensor_data or weather_data
+        tsColumn: str; timestamp column of the table
+        names: list of str; names of returned columns, starting with tsColumn
+        queryFields: str; SQL select list producing names
+        bounds: (start, end) tuple as returned by parseTimeRange
+        plainColumns: bool; False if queryFields contains SQL expressions, which only the database can evaluate
+        equals: dict of column -> value rows must have, or None
+        width: int or None; pixel width of the plot the rows are for. Rows from the database are then thinned to what it can show, see bucketedQuery.
 
-def fetchSensorData(pool, varName, standardDate=us.defaultTimeRange, customDate=None, queryFields=None, timezone=us.timezone):
+    Returns:
+        pandas dataframe of data fetched, newest first
+    """
+    start, end = bounds
+    archived = None
+
+    tier = ht.tiers.get(tableName) if plainColumns else None
+    if tier is not None:
+        # Catching up should include the latest writes.
+        tier.catchUp(getattr(pool, 'latest', pool))
+        records = tier.select(names, start, end, equals)
+
+        if records is not None:
+            records[tsColumn] = records[tsColumn].dt.tz_convert(timezone)
+            return records
+
+    # Read archived months locally and only ask the database for data past the archive.
+    archiveCutoff = am.archivedThrough(tableName) if plainColumns else None
+
+    if archiveCutoff is not None and (start is None or start < archiveCutoff):
+        archiveEnd = archiveCutoff if end is None else min(end, archiveCutoff)
+        archived = am.readArchive(tableName, names, start, archiveEnd, equals=equals)
+
+        if end is not None and end <= archiveCutoff:
+            # Entire range is archived.
+            archived[tsColumn] = archived[tsColumn].dt.tz_convert(timezone)
+            return archived
+
+        start = archiveCutoff
+
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('{} >= %s'.format(tsColumn))
+        params.append(start.to_pydatetime())
+    if end is not None:
+        conditions.append('{} < %s'.format(tsColumn))
+        params.append(end.to_pydatetime())
+    for column, value in (equals or {}).items():
+        conditions.append('{} = %s'.format(column))
+        params.append(value)
+
+    whereClause = 'WHERE {} '.format(' AND '.join(conditions)) if conditions else ''
+
+    with pool.connection() as conn:
+        cur = conn.cursor()
+
+        keyColumn = 'sensor_id' if 'sensor_id' in names else None
+        if width and plainColumns and len([name for name in names[1:] if name != keyColumn]):
+            cur.execute(bucketedQuery(tableName, tsColumn, names, whereClause, keyColumn),
+                        [width] + params + params)
+        else:
+            cur.execute("SELECT {} FROM {} {}ORDER BY {} DESC ".format(
+                queryFields, tableName, whereClause, tsColumn), params)
+
+        # Format data.
+        try:
+            records = pd.DataFrame([{name: row[name] for name in names}
+                                    for row in cur.fetchall()], columns=names)
+
+        except psycopg2.ProgrammingError:
+            log.info('no data in selected timeframe, creating empty dataframe')
+            records = pd.DataFrame(columns=names)
+
+        cur.close()
+
+    if archived is not None:
+        records[tsColumn] = pd.to_datetime(records[tsColumn], utc=True)
+        records = pd.concat([records, archived], ignore_index=True)
+
+    if not records.empty:
+        records[tsColumn] = records[tsColumn].apply(
+            lambda ts: ts.tz_convert(timezone))
+
+    return records
+
+
+def fetchSensorData(pool, varName, standardDate=us.defaultTimeRange, customDate=None, queryFields=None, timezone=us.timezone, zoom=(None, None), width=None, bySensor=False):
     """
     Fetch updated data for a single variable or a list of variables when date range is changed.
 
     Args:
         varName: str or list of str corresponding to fields in the sensor_data table
         standardDate: str
+        zoom: (x0, x1) x-axis range of a zoomed plot, as returned by plotView, to fetch only what it shows
+        width: int or None; pixel width of the plot, to thin rows from the database to what it can show
+        bySensor: bool; also fetch sensor_id ('' for readings without one), e.g. to plot each sensor's readings as its own line
 
     Returns:
         pandas dataframe of data fetched
     """
-    conn = pool.getconn()
-    conn.set_session(readonly=True)
-    cur = conn.cursor()
-
     if isinstance(varName, str):
         varName = [varName]
 
-    names = ['measurement_ts'] + varName
+    names = ['measurement_ts'] + varName + (['sensor_id'] if bySensor else [])
+
+    plainColumns = not queryFields
 
     if not queryFields:
         queryFields = ', '.join(names)
@@ -33,144 +330,228 @@ def fetchSensorData(pool, varName, standardDate=us.defaultTimeRange, customDate=
         if isinstance(queryFields, str):
             queryFields = [queryFields]
 
-        queryFields = ', '.join(['measurement_ts'] + queryFields)
+        queryFields = ', '.join(['measurement_ts'] + queryFields + (['sensor_id'] if bySensor else []))
 
-    records = None
+    bounds = zoomRange(parseTimeRange(standardDate, customDate, timezone), *zoom, timezone=timezone)
+    if bounds is None:
+        return pd.DataFrame(columns=names)
 
-    print("getting sensor data from database...")
+    with slog.timed(log, 'fetched sensor data', sample=10,
+                    columns=names[1:], range=standardDate, zoomed=zoom[0] is not None) as fields:
+        records = fetchTimeRange(pool, 'sensor_data', 'measurement_ts', names,
+                                 queryFields, bounds, timezone, plainColumns, width=width)
+        fields['rows'] = len(records)
 
-    # Get data from database within desired time frame.
-    if standardDate != 'custom':
-        if standardDate == 'all':
-            cur.execute(
-                "SELECT {} FROM sensor_data ORDER BY measurement_ts DESC ".format(queryFields))
-        else:
-            cur.execute(
-                "SELECT {} FROM sensor_data WHERE measurement_ts >= NOW() - INTERVAL '{}' ORDER BY measurement_ts DESC ".format(queryFields, standardDate))
+    if bySensor:
+        # Archived readings from before sensor IDs were required have none.
+        records['sensor_id'] = records['sensor_id'].fillna('')
 
-    else:
-        if customDate[0] and customDate[1]:
-            cur.execute("SELECT {} FROM sensor_data WHERE measurement_ts >= '{}' and measurement_ts <= '{}' ORDER BY measurement_ts DESC ".format(
-                queryFields, customDate[0], customDate[1]))
-        else:
-            records = pd.DataFrame(columns=names)
+    return records
 
-    # Format data.
-    if not records:
-        try:
-            records = pd.DataFrame([{name: row[name] for name in names}
-                                    for row in cur.fetchall()], columns=names)
 
-            records.measurement_ts = records.measurement_ts.apply(
-                lambda ts: ts.tz_convert(timezone))
+def fetchCorrectedSensorData(pool, varName, standardDate=us.defaultTimeRange, customDate=None, timezone=us.timezone, zoom=(None, None), width=None, bySensor=False):
+    """
+    Fetch sensor data with ingest-time corrections applied (see derivations.py), under the uncorrected column names.
 
-        except psycopg2.ProgrammingError:
-            print('no data in selected timeframe, creating empty dataframe')
-            records = pd.DataFrame(columns=names)
+    Args:
+        varName: str or list of str; keys of correctedColumns
+        standardDate: str
+
+    Returns:
+        pandas dataframe of data fetched
+    """
+    if isinstance(varName, str):
+        varName = [varName]
 
-    print("got data")
+    records = fetchSensorData(pool, [correctedColumns[name] for name in varName],
+                              standardDate, customDate, timezone=timezone, zoom=zoom, width=width, bySensor=bySensor)
 
-    cur.close()
-    pool.putconn(conn)
-    return records
+    return records.rename(columns={correctedColumns[name]: name for name in varName})
+
+
+def fetchLatestAqiInfo(pool, aqiSpecies=['pm_2_5_aqi', 'pm_10_0_aqi'], standardDate=us.defaultTimeRange, customDate=None):
+    """
+    Fetch the most recent AQI and warning info (color, description and message) of each species in a date range.
 
+    Args:
+        aqiSpecies: list of str; keys of aqiLabels
 
-def fetchAqiWarningInfo(pool, aqiSpecies=['pm_2_5_aqi', 'pm_10_0_aqi'], standardDate=us.defaultTimeRange, customDate=None):
+    Returns:
+        dict of species -> dict with aqi, rgb, description and message; empty if there are no readings
+    """
     varNames = ['rgb', 'description', 'message']
+    species = [aqiType for aqiType in aqiSpecies if aqiType in aqiLabels]
 
-    # AQI warning text and color.
-    if "pm_2_5_aqi" in aqiSpecies and "pm_10_0_aqi" not in aqiSpecies:
-        warningVars = ['pm_2_5_aqi_rgb as rgb',
-                       'pm_2_5_aqi_description as description',
-                       'pm_2_5_aqi_message as message']
+    records = fetchSensorData(pool, species + ['{}_{}'.format(aqiType, name) for aqiType in species for name in varNames],
+                              standardDate, customDate)
+    if records.empty:
+        return {}
 
-    elif "pm_2_5_aqi" not in aqiSpecies and "pm_10_0_aqi" in aqiSpecies:
-        warningVars = ['pm_10_0_aqi_rgb as rgb',
-                       'pm_10_0_aqi_description as description',
-                       'pm_10_0_aqi_message as message']
+    latest = records.iloc[0]
 
-    elif "pm_2_5_aqi" in aqiSpecies and "pm_10_0_aqi" in aqiSpecies:
-        warningVars = [
-            'CASE WHEN pm_2_5_aqi >= pm_10_0_aqi THEN pm_2_5_aqi_rgb ELSE pm_10_0_aqi_rgb END AS rgb',
-            'CASE WHEN pm_2_5_aqi >= pm_10_0_aqi THEN pm_2_5_aqi_description ELSE pm_10_0_aqi_description END AS description',
-            'CASE WHEN pm_2_5_aqi >= pm_10_0_aqi THEN pm_2_5_aqi_message ELSE pm_10_0_aqi_message END AS message']
+    return {aqiType: dict({'aqi': None if pd.isna(latest[aqiType]) else float(latest[aqiType])},
+                          **{name: latest['{}_{}'.format(aqiType, name)] for name in varNames})
+            for aqiType in species}
 
-    else:
-        warningVars = []
-        varNames = []
 
-    try:
-        # First (most recent) row of warning info.
-        warnings = fetchSensorData(pool,
-                                   varNames, standardDate, customDate, warningVars).iloc[0]
+def fetchWindowSummary(pool, timezone=us.timezone):
+    """
+    Fetch the sliding-window statistics stored with the most recent reading (see window_stats.py).
+
+    Returns:
+        pandas Series indexed by window statistics column, or None if there are no readings in the last day
+    """
+    names = list(ws.windowColumnTypes)
+    start, end = parseTimeRange('1 day', timezone=timezone)
+
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT {} FROM sensor_data WHERE measurement_ts >= %s "
+                    "ORDER BY measurement_ts DESC LIMIT 1 ".format(', '.join(names)),
+                    (start.to_pydatetime(),))
+        row = cur.fetchone()
+        cur.close()
+
+    if row is None:
+        return None
+
+    return pd.Series({name: row[name] for name in names})
+
+
+def fetchSummary(pool, tableName, metric, standardDate=us.defaultTimeRange, customDate=None, timezone=us.timezone):
+    """
+    Fetch the mean and maximum of a metric per bucket of a summary table, over all sensors (see summaries.py).
+
+    Args:
+        tableName: str; daily_summary or hourly_summary
+        metric: str; one of summaries.summaryMetrics
+
+    Returns:
+        pandas dataframe with bucket, mean and max columns, oldest first. Hourly buckets are in local time.
+    """
+    if metric not in summaries.summaryMetrics or tableName not in summaries.summaryTables:
+        raise ValueError('no {} of {}'.format(tableName, metric))
+
+    bucketColumn = summaries.summaryTables[tableName][0]
+    names = ['bucket', 'mean', 'max']
+
+    bounds = parseTimeRange(standardDate, customDate, timezone)
+    if bounds is None:
+        return pd.DataFrame(columns=names)
+
+    conditions = []
+    params = []
+    for operator, bound in zip(('>=', '<'), bounds):
+        if bound is not None:
+            conditions.append('{} {} %s'.format(bucketColumn, operator))
+            params.append(bound.tz_convert(timezone).date() if tableName == 'daily_summary'
+                          else bound.to_pydatetime())
 
-        warningMessage = [warnings['description'], '.\r', warnings['message']]
-        style = {
-            'backgroundColor': warnings['rgb']
-        }
-    except IndexError:
-        warningMessage = ''
-        style = {}
+    whereClause = 'WHERE {} '.format(' AND '.join(conditions)) if conditions else ''
 
-    return warningMessage, style
+    with slog.timed(log, 'fetched summary', sample=10,
+                    table=tableName, metric=metric, range=standardDate) as fields:
+        with pool.connection() as conn:
+            cur = conn.cursor()
 
+            cur.execute("SELECT {1} AS bucket, SUM({0}_sum) / NULLIF(SUM({0}_count), 0) AS mean, MAX({0}_max) AS max "
+                        "FROM {2} {3}GROUP BY {1} ORDER BY {1} ASC ".format(metric, bucketColumn, tableName, whereClause),
+                        params)
+            records = pd.DataFrame([tuple(row) for row in cur.fetchall()], columns=names)
 
-def fetchWeatherDataNewTimeRange(pool, varName, standardDate=us.defaultTimeRange, customDate=None, timezone=us.timezone):
+            cur.close()
+        fields['rows'] = len(records)
+
+    for column in ('mean', 'max'):
+        records[column] = pd.to_numeric(records[column], errors='coerce')
+    if tableName == 'hourly_summary' and not records.empty:
+        records['bucket'] = pd.to_datetime(records['bucket'], utc=True).dt.tz_convert(timezone)
+
+    return records
+
+
+def fetchGaps(pool, standardDate=us.defaultTimeRange, customDate=None, timezone=us.timezone, zoom=(None, None)):
+    """
+    Fetch recorded sensor gaps overlapping a date range (see gaps.py).
+
+    Args:
+        zoom: (x0, x1) x-axis range of a zoomed plot, as returned by plotView
+
+    Returns:
+        list of (sensor ID, gap start, gap end) tuples. Times are tz-aware pandas Timestamps.
+    """
+    bounds = zoomRange(parseTimeRange(standardDate, customDate, timezone), *zoom, timezone=timezone)
+    if bounds is None:
+        return []
+
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        rows = gaps.fetchGaps(cur, *[None if bound is None else bound.to_pydatetime() for bound in bounds])
+        cur.close()
+
+    return [(sensorId, pd.Timestamp(gapStart).tz_convert(timezone), pd.Timestamp(gapEnd).tz_convert(timezone))
+            for sensorId, gapStart, gapEnd in rows]
+
+
+def breakAtGaps(records, gapList, tsColumn='measurement_ts', keyColumn='sensor_id'):
+    """
+    Break plotted lines where a sensor didn't report, and between sensors.
+
+    Each sensor's rows are kept together, newest first, with an empty row between sensors, so each sensor's readings form a line of their own. An empty row in the middle of each of a sensor's gaps breaks only that sensor's line.
+
+    Args:
+        records: pandas dataframe with a key column (see fetchSensorData's bySensor), newest first
+        gapList: list of (sensor ID, gap start, gap end) tuples as returned by fetchGaps
+
+    Returns:
+        pandas dataframe without the key column
+    """
+    if records.empty:
+        return records.drop(columns=keyColumn)
+
+    sensorIds = set(records[keyColumn])
+    breaks = pd.DataFrame({tsColumn: [gapStart + (gapEnd - gapStart) / 2 for sensorId, gapStart, gapEnd in gapList
+                                      if sensorId in sensorIds],
+                           keyColumn: [sensorId for sensorId, gapStart, gapEnd in gapList if sensorId in sensorIds]})
+
+    parts = []
+    for sensorId, part in pd.concat([records, breaks], ignore_index=True).groupby(keyColumn, sort=True):
+        if parts:
+            # Placed at a reading's time, so it doesn't stretch the time axis.
+            parts.append(pd.DataFrame({tsColumn: [part[tsColumn].max()]}))
+        parts.append(part.drop(columns=keyColumn).sort_values(tsColumn, ascending=False))
+
+    return pd.concat(parts, ignore_index=True)
+
+
+def fetchWeatherDataNewTimeRange(pool, varName, standardDate=us.defaultTimeRange, customDate=None, timezone=us.timezone, zoom=(None, None)):
     """
     Fetch updated data for a single variable or a list of variables when date range is changed.
 
     Args:
         varName: str or list of str corresponding to fields in the weather_data table
+        zoom: (x0, x1) x-axis range of a zoomed plot, as returned by plotView
 
     Returns:
         pandas dataframe of data fetched
     """
-    conn = pool.getconn()
-    conn.set_session(readonly=True)
-    cur = conn.cursor()
-
     if isinstance(varName, str):
         varName = [varName]
 
     names = ['ts'] + varName
     queryFields = ', '.join(names)
 
-    records = None
-
-    print("getting weather data from database...")
-
-    # Get data from database.
-    if standardDate != 'custom':
-        if standardDate == 'all':
-            cur.execute(
-                "SELECT {} FROM weather_data ORDER BY ts DESC ".format(queryFields))
-        else:
-            cur.execute(
-                "SELECT {} FROM weather_data WHERE ts >= NOW() - INTERVAL '{}' ORDER BY ts DESC ".format(queryFields, standardDate))
-
-    else:
-        if customDate[0] and customDate[1]:
-            cur.execute("SELECT {} FROM weather_data WHERE ts >= '{}' and ts <= '{}' ORDER BY ts DESC ".format(
-                queryFields, customDate[0], customDate[1]))
-        else:
-            records = pd.DataFrame(columns=names)
-
-    # Format data
-    if not records:
-        try:
-            records = pd.DataFrame([{name: row[name] for name in names}
-                                    for row in cur.fetchall()], columns=names)
-            records.ts = records.ts.apply(
-                lambda ts: ts.tz_convert(timezone))
-
-        except psycopg2.ProgrammingError:
-            print('no data in selected timeframe, creating empty dataframe')
-            records = pd.DataFrame(columns=names)
+    bounds = zoomRange(parseTimeRange(standardDate, customDate, timezone), *zoom, timezone=timezone)
+    if bounds is None:
+        return pd.DataFrame(columns=names)
 
-    print("got data")
+    with slog.timed(log, 'fetched weather data', sample=10,
+                    columns=varName, range=standardDate) as fields:
+        records = fetchTimeRange(pool, 'weather_data', 'ts', names,
+                                 queryFields, bounds, timezone,
+                                 equals={'location_key': wf.primaryLocationKey})
+        fields['rows'] = len(records)
 
-    cur.close()
-    pool.putconn(conn)
     return records
 
 
@@ -184,37 +565,35 @@ def fetchForecastData(pool, varName, tableName, timezone=us.timezone):
     Returns:
         pandas dataframe of data fetched
     """
-    conn = pool.getconn()
-    conn.set_session(readonly=True)
-    cur = conn.cursor()
-
     if isinstance(varName, str):
         varName = [varName]
 
     names = ['ts'] + varName
     queryFields = ', '.join(names)
 
-    print("getting weather forecast from database...")
+    with pool.connection() as conn:
+        cur = conn.cursor()
 
-    # Get data from database.
-    cur.execute(
-        "SELECT {} FROM {} ORDER BY ts ASC ".format(queryFields, tableName))
+        # Get forecast for the dashboard's location from database.
+        cur.execute(
+            "SELECT {} FROM {} WHERE location_key = %s ORDER BY ts ASC ".format(queryFields, tableName),
+            (wf.primaryLocationKey,))
 
-    # Format data.
-    try:
-        records = pd.DataFrame([{name: row[name] for name in names}
-                                for row in cur.fetchall()], columns=names)
-        records.ts = records.ts.apply(
-            lambda ts: ts.tz_convert(timezone))
+        # Format data.
+        try:
+            records = pd.DataFrame([{name: row[name] for name in names}
+                                    for row in cur.fetchall()], columns=names)
+            records.ts = records.ts.apply(
+                lambda ts: ts.tz_convert(timezone))
 
-    except psycopg2.ProgrammingError:
-        print('no data in selected timeframe, creating empty dataframe')
-        records = pd.DataFrame(columns=names)
+        except psycopg2.ProgrammingError:
+            log.info('no forecast in database, creating empty dataframe')
+            records = pd.DataFrame(columns=names)
 
-    print('got data')
+        cur.close()
 
-    cur.close()
-    pool.putconn(conn)
+    log.info('fetched weather forecast',
+             extra={'fields': {'table': tableName, 'rows': len(records)}})
     return records
 
 
@@ -226,23 +605,36 @@ def fetchHourlyForecastData(pool, varName, timezone=us.timezone):
     return fetchForecastData(pool, varName, "hourly_weather_forecast", timezone)
 
 
-def correctTemp(records, tempUnit):
-    # Temp correction: https://de-de.facebook.com/groups/purpleair/permalink/722201454903597/?comment_id=722403448216731
-    if tempUnit == "temp_c":
-        records[tempUnit] = (
-            (((records[tempUnit] * 9 / 5) + 32) - 8) - 32) * 5 / 9
-    elif tempUnit == "temp_f":
-        records[tempUnit] = records[tempUnit] - 8
+def describeWeather(records):
+    """
+    Add a display description of each forecast's weather, chosen by weather type. Weather type codes here: https://openweathermap.org/weather-conditions#Weather-Condition-Codes-2
+
+    Args:
+        records: pandas dataframe with weather_type_id, short_weather_descrip and detail_weather_descrip columns
 
-    return records
+    Returns:
+        the same dataframe with a description column added
+    """
+    typeId = pd.to_numeric(records['weather_type_id']).astype('float64')
+    typeGroup = typeId.round(-2)
+    precipitation = typeGroup.isin([500, 600])
 
+    # Thunderstorms, clouds and precipitation get the detailed description; everything else gets the short one.
+    useDetail = (typeGroup == 200) | ((typeGroup == 800) & (typeId != 800)) | precipitation
+    description = records['detail_weather_descrip'].where(
+        useDetail, records['short_weather_descrip']).fillna('')
 
-def correctHumid(records):
-    # Humidity correction: https://de-de.facebook.com/groups/purpleair/permalink/722201454903597/?comment_id=722403448216731
-    records["humidity"] = records["humidity"] + 4
+    # Swap "shower" and following word, e.g. "shower rain" -> "rain shower".
+    description = description.where(~precipitation, description.str.replace(
+        r'(?<!\S)shower (\S+)', r'\1 shower', n=1, regex=True))
 
-    return records
+    # Drop any instances of "intensity" from rain descriptions.
+    description = description.where(typeGroup != 500, description.str.replace(
+        r'(?<!\S)intensity(?!\S)', '', regex=True).str.split().str.join(' '))
+
+    records['description'] = description.str.capitalize()
 
+    return records
 
 
 # Figures to insert.
@@ -329,71 +721,76 @@ def aqi_vs_time(records, species=["pm_2_5_aqi", "pm_10_0_aqi"], margin=defaultMa
     else:
         xBounds = [min(records.measurement_ts),
                    max(records.measurement_ts)]
-        yBound = max(max(item for item in records[aqiType] if item is not None)
+        yBound = max(pd.to_numeric(records[aqiType], errors='coerce').max()
                      for aqiType in species)
+        if pd.isna(yBound):
+            yBound = 0
 
-        # EPA color bands by AQI risk.
+        # EPA color bands by AQI risk, each tagged with its upper cutoff. Bands above the one that includes the max AQI value are hidden.
         # TODO: pull from csv instead of hard-coding.
         colorCutoffs = [
             [50, 'rgba(0,228,0,0.3)'], [100, 'rgba(255,255,0,0.3)'],
             [150, 'rgba(255,126,0,0.3)'], [200, 'rgba(255,0,0,0.3)'],
             [300, 'rgba(143,63,151,0.3)'], [10000, 'rgba(126,0,35,0.3)']]
-        colorList = list((item[1] for item in colorCutoffs))
-
-        # Put AQI color band info into dataframe. Data should span min ts to max ts to get full coloring of plot area.
-        colorCutoffs = [
-            [bound] + cutoff for bound in xBounds for cutoff in colorCutoffs]
-        colorCutoffs = pd.DataFrame(colorCutoffs, columns=[
-                                    "measurement_ts", "aqi", "color"])
-
-        # Add color stripe one at a time. Stop at the last AQI color band that includes the max AQI value seen in measured data.
-        for index, color in enumerate(colorList):
-            x = colorCutoffs.loc[colorCutoffs["color"]
-                                 == color]["measurement_ts"]
-            y = colorCutoffs.loc[colorCutoffs["color"] == color]["aqi"]
 
+        bandTop = None
+        for index, (cutoff, color) in enumerate(colorCutoffs):
             fig.add_trace(go.Scatter(
-                x=x, y=y,
+                x=xBounds, y=[cutoff, cutoff],
                 mode='lines',
                 line=dict(width=0),
                 fillcolor=color,
                 fill='tozeroy' if index == 0 else 'tonexty',
                 showlegend=False,
                 hovertemplate=None,
-                hoverinfo='skip'
+                hoverinfo='skip',
+                visible=bandTop is None,
+                meta={'band': cutoff}
             ))
 
-            # Max AQI value within most recently added color band.
-            if int(yBound) < y.iloc[0]:
-                break
-
-        # Set plot axes ranges.
-        if index == len(colorCutoffs) - 1:
-            # Cap y range at nearest hundred greater than max measured AQI value.
-            fig.update_layout(
-                yaxis_range=(0, round(yBound + 100, -2)),
-                xaxis_range=xBounds
-            )
-        else:
-            fig.update_layout(
-                yaxis_range=(0, y.iloc[0]),
-                xaxis_range=xBounds
-            )
+            if bandTop is None and int(yBound) < cutoff:
+                bandTop = cutoff
 
-    # Add measured AQI values.
-    aqiLabel = {"pm_2_5_aqi": "PM 2.5", "pm_10_0_aqi": "PM 10.0"}
-    aqiColor = {"pm_2_5_aqi": "#636EFA", "pm_10_0_aqi": "#EF553B"}
+        # Set plot axes ranges. Past the last band's cutoff, cap y range at nearest hundred greater than max measured AQI value.
+        fig.update_layout(
+            yaxis_range=(0, bandTop if bandTop != colorCutoffs[-1][0] else round(yBound + 100, -2)),
+            xaxis_range=xBounds
+        )
 
+    # Add measured AQI values.
     # Add measured series one by one.
     for aqiType in species:
         fig.add_trace(go.Scattergl(
             x=records["measurement_ts"], y=records[aqiType],
             mode="markers+lines",
             hovertemplate='%{y}',
-            name=aqiLabel[aqiType],
-            marker=dict(color=aqiColor[aqiType])
+            name=aqiLabels[aqiType],
+            marker=dict(color=aqiColors[aqiType]),
+            meta={'species': aqiType, 'series': 'measured'}
         ))
 
+        # Add 24-hour average as a dotted line if it was fetched.
+        if dailyAverageColumns.get(aqiType) in records:
+            fig.add_trace(go.Scattergl(
+                x=records["measurement_ts"], y=records[dailyAverageColumns[aqiType]],
+                mode="lines",
+                hovertemplate='%{y}',
+                name='{} 24-hour average'.format(aqiLabels[aqiType]),
+                line=dict(color=aqiColors[aqiType], dash='dot'),
+                meta={'species': aqiType, 'series': 'average'}
+            ))
+
+        # Add NowCast as a dashed line if it was fetched.
+        if nowCastColumns.get(aqiType) in records:
+            fig.add_trace(go.Scattergl(
+                x=records["measurement_ts"], y=records[nowCastColumns[aqiType]],
+                mode="lines",
+                hovertemplate='%{y}',
+                name='{} NowCast'.format(aqiLabels[aqiType]),
+                line=dict(color=aqiColors[aqiType], dash='dash'),
+                meta={'species': aqiType, 'series': 'nowcast'}
+            ))
+
     fig.update_layout(
         legend=dict(
             yanchor="top",
@@ -408,3 +805,107 @@ def aqi_vs_time(records, species=["pm_2_5_aqi", "pm_10_0_aqi"], margin=defaultMa
     fig.update_yaxes(title_text="AQI")
 
     return fig
+
+
+def hourly_forecast(records, tempUnit="temp_f", margin=defaultMargin):
+    """
+    Plot of forecast temperature with chance of rain as bars on a second axis.
+    """
+    newTempLabel = {
+        "temp_c": "Temperature [°C]", "temp_f": "Temperature [°F]"}[tempUnit]
+
+    if records.empty:
+        # Make empty/blank plot.
+        records = pd.DataFrame(
+            columns=["ts", tempUnit, "precip_chance", "description"])
+
+    fig = go.Figure()
+
+    fig.add_trace(go.Bar(x=records["ts"],
+                         y=pd.to_numeric(records["precip_chance"]) * 100,
+                         marker=dict(color='rgba(99,110,250,0.3)'),
+                         hovertemplate='%{y:.0f}%',
+                         name='Chance of rain',
+                         yaxis='y2'))
+
+    fig.add_trace(go.Scatter(x=records["ts"],
+                             y=records[tempUnit],
+                             mode='lines',
+                             text=records["description"],
+                             hovertemplate='%{y:.0f}° %{text}',
+                             line=dict(color='#EF553B'),
+                             name='Temperature'))
+
+    fig.update_layout(margin=margin,
+                      hovermode="x",
+                      legend=dict(
+                          yanchor="top",
+                          y=0.99,
+                          xanchor="left",
+                          x=0.01
+                      ),
+                      yaxis=dict(title_text=newTempLabel),
+                      yaxis2=dict(title_text="Chance of rain [%]",
+                                  overlaying='y', side='right',
+                                  range=[0, 100], showgrid=False))
+
+    return fig
+
+
+def summaryHeatmap(metric, z, x, y, text, margin):
+    if metric == 'temp_f_corrected':
+        colors = dict(colorscale='RdBu', reversescale=True)
+    else:
+        # Values past the last level are drawn in its color.
+        colors = dict(colorscale=aqiColorScale, zmin=0, zmax=300)
+
+    fig = go.Figure(go.Heatmap(
+        x=x, y=y, z=z, text=text,
+        hovertemplate='%{text}: %{z:.0f}<extra></extra>',
+        colorbar=dict(title=dict(text=summaryLabels[metric])),
+        xgap=1, ygap=1,
+        **colors))
+
+    fig.update_layout(margin=margin)
+
+    return fig
+
+
+def calendar_heatmap(records, metric, statistic='mean', margin=defaultMargin):
+    """
+    Calendar of daily values: one column per week, one row per weekday.
+
+    Args:
+        records: pandas dataframe as returned by fetchSummary for daily_summary
+        statistic: str; 'mean' or 'max'
+    """
+    days = pd.to_datetime(pd.Series(records['bucket'], dtype='object'))
+    weekStarts = days - pd.to_timedelta(days.dt.weekday, unit='D')
+
+    fig = summaryHeatmap(metric, records[statistic], weekStarts, days.dt.strftime('%a'),
+                         days.dt.strftime('%b %d, %Y'), margin)
+    fig.update_yaxes(categoryorder='array', autorange='reversed',
+                     categoryarray=['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
+    fig.update_xaxes(title_text='Week')
+
+    return fig
+
+
+def hour_of_day_heatmap(records, metric, statistic='mean', margin=defaultMargin):
+    """
+    Hourly values by day (columns) and local hour of day (rows).
+
+    Args:
+        records: pandas dataframe as returned by fetchSummary for hourly_summary
+        statistic: str; 'mean' or 'max'
+    """
+    hours = pd.Series(records['bucket'])
+    if records.empty:
+        hours = pd.to_datetime(hours, utc=True)
+
+    fig = summaryHeatmap(metric, records[statistic], hours.dt.strftime('%Y-%m-%d'), hours.dt.hour,
+                         hours.dt.strftime('%b %d, %H:00'), margin)
+    fig.update_yaxes(title_text='Hour of day', autorange='reversed', dtick=3)
+    fig.update_xaxes(title_text='Day')
+
+    return fig
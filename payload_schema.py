@@ -0,0 +1,191 @@
+
+"""
+Fields of the PurpleAir payload stored in sensor_data, declared once and compiled into a transformer.
+
+The transformer validates a payload and returns its stored values as a tuple in column order, listing every missing or invalid field at once, so bad readings are rejected when they arrive rather than failing inside the insert transaction. Values that are present but null are stored as NULL, or as their field's default.
+"""
+
+
+import math
+from datetime import datetime as dt
+from datetime import timezone
+from operator import itemgetter
+
+
+class PayloadError(ValueError):
+    """
+    A payload is missing fields or has invalid values.
+    """
+
+    def __init__(self, problems):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+
+# Field types. Each converts a payload value, raising TypeError or ValueError if it's invalid.
+def text(value):
+    if not isinstance(value, str):
+        raise TypeError('expected a string, got {!r}'.format(value))
+    return value
+
+
+def number(value):
+    # Numbers may come as JSON numbers or numeric strings. JSON true and false aren't numbers.
+    if isinstance(value, bool):
+        raise TypeError('expected a number, got {!r}'.format(value))
+    if not isinstance(value, (int, float)):
+        value = float(value)
+    if not math.isfinite(value):
+        raise ValueError('expected a finite number, got {!r}'.format(value))
+    return value
+
+
+def parsePurpleAirTime(timeString):
+    """
+    Parse the DateTime field of a PurpleAir payload, e.g. "2020/08/20T18:26:42z".
+
+    Returns:
+        tz-aware (UTC) datetime
+    """
+    try:
+        return dt.strptime(timeString, '%Y/%m/%dT%H:%M:%Sz').replace(tzinfo=timezone.utc)
+    except ValueError:
+        ts = dt.fromisoformat(timeString)
+        if ts.tzinfo is None:
+            raise ValueError('expected a time with a timezone, got {!r}'.format(timeString))
+        return ts
+
+
+def purpleAirTime(value):
+    return parsePurpleAirTime(text(value))
+
+
+def field(column, key, kind, minimum=None, maximum=None, default=None):
+    """
+    Declare a stored payload field.
+
+    Args:
+        column: str; sensor_data column
+        key: str; payload key
+        kind: function converting the payload value, e.g. number
+        minimum, maximum: inclusive limits of valid values, or None
+        default: value stored when the payload value is null
+    """
+    return {'column': column, 'key': key, 'kind': kind, 'minimum': minimum, 'maximum': maximum, 'default': default}
+
+
+# sensor_data columns filled from the payload. Remaining columns are computed by the stages in derivations.py. Limits are the sensors' measurement ranges: BME280 for temperature, humidity and pressure, PMS5003 for particles.
+fields = [
+    field('id', 'Id', number, minimum=0),
+    # sensor_data is keyed by sensor and time. Readings without a sensor ID are stored under ''.
+    field('sensor_id', 'SensorId', text, default=''),
+    field('place', 'place', text),
+    field('version', 'version', text),
+    field('hardware_version', 'hardwareversion', text),
+    field('uptime_s', 'uptime', number, minimum=0),
+    field('rssi_dbm', 'rssi', number),
+    field('measurement_ts', 'DateTime', purpleAirTime),
+    field('temp_f', 'current_temp_f', number, minimum=-40, maximum=185),
+    field('humidity', 'current_humidity', number, minimum=0, maximum=100),
+    field('dewpoint_f', 'current_dewpoint_f', number),
+    field('pressure_mbar', 'pressure', number, minimum=300, maximum=1100),
+    field('pm_2_5_aqi', 'pm2.5_aqi', number, minimum=0),
+    field('pm_1_0_um_m3', 'pm1_0_cf_1', number, minimum=0),
+    field('pm_2_5_um_m3', 'pm2_5_cf_1', number, minimum=0),
+    field('pm_10_0_um_m3', 'pm10_0_cf_1', number, minimum=0),
+    field('p_0_3_count_dl', 'p_0_3_um', number, minimum=0),
+    field('p_0_5_count_dl', 'p_0_5_um', number, minimum=0),
+    field('p_1_0_count_dl', 'p_1_0_um', number, minimum=0),
+    field('p_2_5_count_dl', 'p_2_5_um', number, minimum=0),
+    field('p_5_0_count_dl', 'p_5_0_um', number, minimum=0),
+    field('p_10_0_count_dl', 'p_10_0_um', number, minimum=0)]
+
+# Fields that must have a value.
+requiredColumns = {'measurement_ts'}
+
+
+def converter(spec):
+    """
+    Combine a field's type and limits into one function of a payload value.
+    """
+    kind, minimum, maximum, default = spec['kind'], spec['minimum'], spec['maximum'], spec['default']
+    nullable = spec['column'] not in requiredColumns
+
+    def convert(value):
+        if value is None:
+            if nullable:
+                return default
+            raise ValueError('must not be null')
+
+        value = kind(value)
+        if minimum is not None and value < minimum:
+            raise ValueError('{!r} is below {}'.format(value, minimum))
+        if maximum is not None and value > maximum:
+            raise ValueError('{!r} is above {}'.format(value, maximum))
+        return value
+
+    return convert
+
+
+class Transformer(object):
+    """
+    Payload validation and extraction compiled from a field spec. All keys are looked up with one itemgetter call, then each value goes through its field's converter.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.columns = tuple(field['column'] for field in spec)
+        self.keys = tuple(field['key'] for field in spec)
+        self.getter = itemgetter(*self.keys)
+        self.converters = tuple(converter(field) for field in spec)
+        self.columnIndex = {column: index for index, column in enumerate(self.columns)}
+
+    def __call__(self, payload):
+        """
+        Validate a payload and extract its stored values.
+
+        Args:
+            payload: sensor data dict, as posted by the sensor
+
+        Returns:
+            tuple of values in self.columns order
+
+        Raises:
+            PayloadError listing every missing or invalid field
+        """
+        try:
+            return tuple([convert(value) for convert, value in zip(self.converters, self.getter(payload))])
+        except (KeyError, TypeError, ValueError):
+            raise PayloadError(self.problems(payload)) from None
+
+    def problems(self, payload):
+        """
+        Describe everything wrong with a payload. Only called for invalid payloads, so it can be slow.
+        """
+        if not isinstance(payload, dict):
+            return ['expected a JSON object']
+
+        problems = []
+        for key, convert in zip(self.keys, self.converters):
+            if key not in payload:
+                problems.append('missing {}'.format(key))
+                continue
+            try:
+                convert(payload[key])
+            except (TypeError, ValueError) as e:
+                problems.append('invalid {}: {}'.format(key, e))
+
+        return problems
+
+    def row(self, values):
+        """
+        Returns:
+            dict of sensor_data column -> value
+        """
+        return dict(zip(self.columns, values))
+
+    def value(self, values, column):
+        return values[self.columnIndex[column]]
+
+
+transformer = Transformer(fields)
@@ -0,0 +1,266 @@
+
+"""
+Cache of query results and rendered figures shared by all worker processes on one host.
+
+Entries are pickled into files in a shared-memory directory (SHARED_CACHE_DIR, /dev/shm/airdash by default). Keys include the current generation of each kind of data they depend on, and ingest bumps a generation after writing new rows, so stale entries are never read again and age out of the directory. Without a usable directory, a per-process dictionary stands in.
+"""
+
+
+import functools
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+
+import metrics  # Cache hit and miss counters.
+import structured_logging as slog
+import user_settings as us
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+log = slog.getLogger(__name__)
+
+# Kinds of data entries can depend on. Each has its own generation counter.
+namespaces = ['sensor', 'weather']
+
+# Stripes of locks used to compute each missing entry once across processes.
+lockStripes = 64
+
+# Adds between checks of the directory size.
+sweepEvery = 50
+
+
+def cacheKey(key, generations):
+    return hashlib.sha1(pickle.dumps((key, generations))).hexdigest()
+
+
+class LocalCache(object):
+    """
+    Per-process stand-in with the same interface as SharedCache.
+    """
+
+    def __init__(self, maxEntries=256):
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self.computeLocks = [threading.Lock() for _ in range(lockStripes)]
+        self.generations = {namespace: 0 for namespace in namespaces}
+        self.entries = dict()
+
+    def generation(self, namespace):
+        return self.generations[namespace]
+
+    def bump(self, namespace):
+        with self.lock:
+            self.generations[namespace] += 1
+            self.entries = dict()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, value):
+        with self.lock:
+            if len(self.entries) >= self.maxEntries:
+                self.entries.pop(next(iter(self.entries)))
+            self.entries.setdefault(key, value)
+
+    def remoteChange(self, namespace):
+        """
+        Another process wrote new data. Only this process can invalidate its own entries.
+        """
+        self.bump(namespace)
+
+    def computeLock(self, key):
+        return self.computeLocks[int(key[:8], 16) % lockStripes]
+
+
+class StripeLock(object):
+    """
+    Exclusive lock held across processes and threads, via flock on one of a fixed set of files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, 'a+b')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+class SharedCache(object):
+    """
+    File-backed cache in a shared-memory directory, safe for concurrent use by several processes.
+    """
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.adds = 0
+        os.makedirs(os.path.join(directory, 'entries'), exist_ok=True)
+
+        # Generation counters, one int64 per namespace, mapped into every process.
+        path = os.path.join(directory, 'generations')
+        with open(path, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.path.getsize(path) < 8 * len(namespaces):
+                f.truncate(8 * len(namespaces))
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+        self.generationFile = open(path, 'r+b')
+        self.generations = mmap.mmap(self.generationFile.fileno(), 8 * len(namespaces))
+
+    def generation(self, namespace):
+        return struct.unpack_from('q', self.generations, 8 * namespaces.index(namespace))[0]
+
+    def bump(self, namespace):
+        """
+        Invalidate every entry depending on a kind of data.
+        """
+        offset = 8 * namespaces.index(namespace)
+
+        fcntl.flock(self.generationFile, fcntl.LOCK_EX)
+        try:
+            value = struct.unpack_from('q', self.generations, offset)[0]
+            struct.pack_into('q', self.generations, offset, value + 1)
+        finally:
+            fcntl.flock(self.generationFile, fcntl.LOCK_UN)
+
+    def remoteChange(self, namespace):
+        """
+        Another process wrote new data. It already bumped the shared generation.
+        """
+        pass
+
+    def entryPath(self, key):
+        return os.path.join(self.directory, 'entries', key)
+
+    def get(self, key):
+        try:
+            with open(self.entryPath(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def add(self, key, value):
+        """
+        Store an entry unless another process already has. Readers never see a partly written entry.
+        """
+        fd, tmpPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            # link fails if the entry exists, so the first writer wins.
+            os.link(tmpPath, self.entryPath(key))
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmpPath)
+
+        self.adds += 1
+        if self.adds % sweepEvery == 0:
+            self.sweep()
+
+    def sweep(self):
+        """
+        Delete the least recently written entries until the directory fits in maxBytes.
+        """
+        entries = []
+        for entry in os.scandir(os.path.join(self.directory, 'entries')):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def computeLock(self, key):
+        return StripeLock(os.path.join(
+            self.directory, 'lock-{:02d}'.format(int(key[:8], 16) % lockStripes)))
+
+
+def openCache():
+    if us.sharedCacheDir and fcntl is not None:
+        try:
+            return SharedCache(us.sharedCacheDir, us.sharedCacheMb * 2**20)
+        except OSError as e:
+            log.warning('shared cache unavailable, caching per process: %s', e)
+    return LocalCache()
+
+
+cache = openCache()
+
+
+def getOrCompute(dependsOn, key, compute):
+    """
+    Get a cached value, computing and storing it if missing. Each missing value is computed by one process at a time; the others wait for it.
+
+    Args:
+        dependsOn: list of str; namespaces whose new data invalidates the value
+        key: picklable key, unique to the value within its namespaces
+        compute: function taking no arguments and returning a picklable value
+
+    Returns:
+        value
+    """
+    key = cacheKey(key, [(namespace, cache.generation(namespace))
+                         for namespace in dependsOn])
+
+    value = cache.get(key)
+    if value is not None:
+        metrics.increment('shared_cache_hits')
+        return value
+
+    with cache.computeLock(key):
+        value = cache.get(key)
+        if value is None:
+            metrics.increment('shared_cache_misses')
+            value = compute()
+            cache.add(key, value)
+        else:
+            metrics.increment('shared_cache_hits')
+
+    return value
+
+
+def cached(*dependsOn):
+    """
+    Decorator caching a function's result by its name and arguments.
+
+    Args:
+        dependsOn: namespaces whose new data invalidates results
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            return getOrCompute(dependsOn, (function.__name__,) + args,
+                                lambda: function(*args))
+        return wrapper
+    return decorator
+
+
+def invalidator(namespace):
+    """
+    Listener function that bumps a namespace's generation, for AirDatabase sensorListeners and weatherListeners.
+    """
+    def listener(row=None):
+        cache.bump(namespace)
+    return listener
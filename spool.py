@@ -0,0 +1,366 @@
+
+"""
+Local write-ahead spool for incoming sensor readings.
+
+Readings are appended to a spool file and acknowledged once they're on disk, so ingest doesn't wait on (or fail with) the database. Concurrent appends share one fsync. Each process writes its own segment files in SPOOL_DIR, and one process at a time, elected with a file lock, replays all segments into the database in batches. Replay offsets are saved after each batch commits, so a crash replays at most one batch again, which the database ignores as repeated readings.
+"""
+
+
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+import psycopg2
+
+import metrics  # Spool counters.
+import structured_logging as slog
+import user_settings as us
+
+
+log = slog.getLogger(__name__)
+
+segmentSuffix = '.spool'
+
+
+def segmentName():
+    # Sorts by creation time. The process ID keeps names unique across workers.
+    return '{:020d}-{}{}'.format(time.time_ns(), os.getpid(), segmentSuffix)
+
+
+def syncDirectory(directory):
+    # Make created, renamed and removed files durable.
+    directoryFd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directoryFd)
+    finally:
+        os.close(directoryFd)
+
+
+class SpoolWriter(object):
+    """
+    Appends readings to this process's current segment, one JSON line each.
+
+    The segment is locked while it's being written, which tells the replayer it may still grow.
+    """
+
+    def __init__(self, directory, segmentBytes):
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        self.lock = threading.Lock()  # Guards writes and the current segment.
+        self.syncLock = threading.Lock()  # Held by the thread fsyncing for everyone.
+        self.fd = None
+        self.size = 0
+        self.written = 0  # Records written by this process.
+        self.synced = 0  # Records known to be on disk.
+        self.appended = threading.Event()  # Wakes a replayer in this process.
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Lock the segment before it gets its name, so the replayer never takes a new segment for a finished one.
+        path = os.path.join(self.directory, segmentName())
+        self.fd = os.open(path + '.new', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        os.rename(path + '.new', path)
+        syncDirectory(self.directory)
+        self.size = 0
+
+    def append(self, payload):
+        """
+        Write a reading and wait until it's on disk.
+
+        Args:
+            payload: sensor data dict
+        """
+        data = (json.dumps({'received': time.time(), 'payload': payload}) + '\n').encode('utf-8')
+
+        with self.lock:
+            if self.fd is None:
+                self.open()
+
+            # One write per record, so records from different threads don't interleave.
+            os.write(self.fd, data)
+            self.size += len(data)
+            self.written += 1
+            sequence = self.written
+
+        self.sync(sequence)
+        metrics.increment('spool_rows_appended')
+        self.appended.set()
+
+    def sync(self, sequence):
+        """
+        Wait until a record is on disk. Whoever gets the sync lock first fsyncs every record written so far, so threads that queue up behind it usually find theirs already synced.
+        """
+        with self.syncLock:
+            if self.synced >= sequence:
+                return
+
+            with self.lock:
+                target = self.written
+                fd = self.fd
+
+            start = time.perf_counter()
+            os.fsync(fd)
+            metrics.observe('spool_fsync_ms', (time.perf_counter() - start) * 1000)
+            metrics.observe('spool_fsync_records', target - self.synced)
+            self.synced = target
+
+            with self.lock:
+                if self.size >= self.segmentBytes:
+                    # Start a new segment. Records written since the fsync above are synced before it's closed.
+                    os.fsync(self.fd)
+                    self.synced = self.written
+                    os.close(self.fd)
+                    self.open()
+
+
+def receivedAt(record):
+    return record.get('received', 0) if isinstance(record, dict) else 0
+
+
+class Replayer(object):
+    """
+    Drains spool segments into the database in batches, oldest readings first.
+
+    A batch that fails for a reason other than the database, e.g. a malformed reading, is retried a few times, then inserted one reading at a time. Readings that still fail are moved to a dead-letter file, so they don't hold up the rest.
+    """
+
+    # Failed attempts at a batch before its readings are inserted one at a time.
+    maxAttempts = 3
+
+    def __init__(self, directory, batchRows, pollSeconds):
+        self.directory = directory
+        self.batchRows = batchRows
+        self.pollSeconds = pollSeconds
+        self.offsetsPath = os.path.join(directory, 'offsets.json')
+        self.deadLetterPath = os.path.join(directory, 'dead-letter.ndjson')
+        self.failures = 0  # Consecutive failed attempts at the current batch.
+        self.thread = None
+
+        # Functions called with the list of payloads after each batch is stored.
+        self.callbacks = []
+
+    def start(self, getDb, wake=None):
+        """
+        Replay in a background thread while this process holds the replay lock. Other processes wait to take over if it exits.
+
+        Args:
+            getDb: function returning the AirDatabase to insert with
+            wake: threading.Event set when readings are appended in this process
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, args=(getDb, wake or threading.Event()),
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self, getDb, wake):
+        os.makedirs(self.directory, exist_ok=True)
+        lockFd = os.open(os.path.join(self.directory, 'replay.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+
+        # Wait to be elected.
+        while True:
+            try:
+                fcntl.flock(lockFd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(self.pollSeconds * 10)
+
+        log.info('replaying spool', extra={'fields': {'directory': self.directory}})
+
+        backoff = 1
+        while True:
+            try:
+                replayed = self.replayBatch(getDb(), oneByOne=self.failures >= self.maxAttempts)
+                backoff = 1
+                self.failures = 0
+            except psycopg2.Error as e:
+                # Database unavailable. Readings stay in the spool until it's back.
+                log.warning('spool replay failed, retrying in %ss: %s', backoff, e)
+                metrics.increment('spool_replay_failures')
+                self.recover(getDb)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            except Exception:
+                log.exception('spool replay failed', extra={'fields': {'attempt': self.failures + 1}})
+                metrics.increment('spool_replay_failures')
+                self.failures += 1
+                self.recover(getDb)
+                time.sleep(self.pollSeconds)
+                continue
+
+            if not replayed:
+                wake.wait(self.pollSeconds)
+                wake.clear()
+
+    def recover(self, getDb):
+        try:
+            db = getDb()
+        except psycopg2.Error:
+            # Not connected yet. Connecting is retried with the next batch.
+            return
+
+        if not db.conn.closed:
+            try:
+                db.conn.rollback()
+            except psycopg2.Error:
+                pass
+
+        if db.conn.closed:
+            try:
+                db.reconnect(psycopg2.connect(us.databaseUrl))
+            except psycopg2.Error as e:
+                log.warning('reconnecting failed: %s', e)
+
+    def loadOffsets(self):
+        try:
+            with open(self.offsetsPath) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+
+    def saveOffsets(self, offsets):
+        # Write and rename, so a crash leaves either the old or the new offsets.
+        temporaryPath = self.offsetsPath + '.tmp'
+        with open(temporaryPath, 'w') as f:
+            json.dump(offsets, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaryPath, self.offsetsPath)
+
+        syncDirectory(self.directory)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(segmentSuffix))
+
+    def readSegment(self, name, offset, limit):
+        """
+        Read complete records from a segment.
+
+        Returns:
+            (list of (record, offset after it) tuples, offset after the last line read, whether the segment is finished: no longer written and fully read)
+        """
+        path = os.path.join(self.directory, name)
+
+        with open(path, 'rb') as f:
+            try:
+                # A writer holds the lock until it moves to a new segment or exits.
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+                closed = True
+            except BlockingIOError:
+                closed = False
+
+            f.seek(offset)
+            records = []
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Partly written. Finished later, or cut short by a crash if the segment is closed.
+                    break
+                offset += len(line)
+                try:
+                    records.append((json.loads(line), offset))
+                except ValueError:
+                    log.error('skipped unreadable spool record', extra={'fields': {'segment': name}})
+                if len(records) >= limit:
+                    return records, offset, False
+
+        return records, offset, closed
+
+    def replayBatch(self, db, oneByOne=False):
+        """
+        Insert the next batch of spooled readings and advance the offsets.
+
+        Segments of different processes interleave in time, so the batch is the oldest readings across all segments, merged in arrival order. Otherwise one process's later readings could be stored before another's earlier ones, which ingest would take as late readings.
+
+        Args:
+            oneByOne: bool; insert readings one at a time, setting aside those that fail
+
+        Returns:
+            number of readings replayed
+        """
+        offsets = self.loadOffsets()
+
+        # (segment name, list of (record, offset after it), offset after the last line read, whether finished)
+        reads = [(name,) + self.readSegment(name, offsets.get(name, 0), self.batchRows)
+                 for name in self.segments()]
+
+        taken = list(itertools.islice(heapq.merge(*[
+            [(receivedAt(record), index, position) for position, (record, end) in enumerate(segmentRecords)]
+            for index, (name, segmentRecords, offset, done) in enumerate(reads)]), self.batchRows))
+        records = [reads[index][1][position][0] for received, index, position in taken]
+
+        # Each segment advances past the records taken from it.
+        counts = [0] * len(reads)
+        for received, index, position in taken:
+            counts[index] += 1
+
+        newOffsets = dict()
+        finished = []
+        for (name, segmentRecords, offset, done), count in zip(reads, counts):
+            if count == len(segmentRecords):
+                newOffsets[name] = offset
+                if done:
+                    finished.append(name)
+            elif count:
+                newOffsets[name] = segmentRecords[count - 1][1]
+
+        if records:
+            if oneByOne:
+                self.insertEach(db, records)
+            else:
+                db.insert_sensor_rows([record['payload'] for record in records])
+            metrics.increment('spool_rows_replayed', len(records))
+
+        if not records and not finished:
+            return 0
+
+        offsets.update(newOffsets)
+        for name in finished:
+            offsets.pop(name, None)
+        self.saveOffsets(offsets)
+
+        for name in finished:
+            os.remove(os.path.join(self.directory, name))
+
+        for callback in self.callbacks:
+            try:
+                callback([record['payload'] for record in records if isinstance(record, dict) and 'payload' in record])
+            except Exception:
+                log.exception('spool callback failed')
+
+        return len(records)
+
+    def insertEach(self, db, records):
+        """
+        Insert readings of a batch that failed repeatedly one at a time, moving those that fail on their own to the dead-letter file.
+
+        Raises:
+            psycopg2.Error if the database is unavailable
+        """
+        for record in records:
+            try:
+                db.insert_sensor_rows([record['payload']])
+            except psycopg2.Error:
+                raise
+            except Exception as e:
+                db.conn.rollback()
+                self.deadLetter(record, e)
+
+    def deadLetter(self, record, error):
+        with open(self.deadLetterPath, 'a') as f:
+            f.write(json.dumps({'failed': time.time(), 'error': repr(error), 'record': record}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        log.error('moved unreplayable spool record to dead letters: %s', error, extra={'fields': {
+            'file': self.deadLetterPath}})
+        metrics.increment('spool_rows_dead_lettered')
+
+
+writer = SpoolWriter(us.spoolDir, us.spoolSegmentMb * 1024 * 1024) if us.spoolDir else None
+replayer = Replayer(us.spoolDir, batchRows=500, pollSeconds=0.5) if us.spoolDir else None
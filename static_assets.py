@@ -0,0 +1,336 @@
+
+"""
+Serving the page's static files and responses compressed, with far-future caching where URLs change with contents.
+
+Files in vendor/ (the page stylesheet) are fingerprinted with a hash of their contents and compressed with Brotli and gzip once, at startup. Fingerprinted URLs never serve different contents, so they're cached as immutable for a year, as are Dash's fingerprinted component bundles, assets/ files (fingerprinted by modification time) and forecast icons, which are fetched from OpenWeather once and kept in WEATHER_ICON_DIR so the page loads without outside network access. Dash responses are compressed here rather than by Flask-Compress: each distinct body is compressed once and shared by all processes through the shared cache, so a cached figure served to many sessions isn't compressed again for each. Dash's component bundles are compressed as much as possible in the background at startup; until then, and for every other response, a fast level is used so no request waits on slow compression.
+"""
+
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import threading
+import time
+
+import brotli
+from dash.development.base_component import ComponentRegistry
+from flask import abort
+from flask import request
+from flask import Response
+from requests import get  # Fetching forecast icons
+from requests import RequestException
+
+import metrics  # Compression timings.
+import shared_cache as sc  # Compressed bodies shared across worker processes
+import structured_logging as slog
+import user_settings as us
+
+
+log = slog.getLogger(__name__)
+
+vendorDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vendor')
+
+# Cache-Control for URLs whose contents never change.
+immutable = 'public, max-age=31536000, immutable'
+
+# Supported content encodings, preferred first.
+encodings = ['br', 'gzip']
+
+compressibleTypes = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+# Responses compressed by compressResponse: the page, Dash's routes and assets/ files.
+compressedPaths = re.compile(r'^/($|_dash-|assets/)')
+
+# Smaller responses aren't worth compressing.
+minimumBytes = 500
+
+# OpenWeather icon codes, like '10d'.
+iconPattern = re.compile(r'^[0-9]{2}[dn]$')
+
+
+def compress(data, encoding, static=False):
+    """
+    Args:
+        data: bytes
+        encoding: 'br' or 'gzip'
+        static: bool; compress as much as possible, for bodies that are compressed once and served many times
+
+    Returns:
+        compressed bytes
+    """
+    start = time.perf_counter()
+
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=11 if static else 5)
+    else:
+        compressed = gzip.compress(data, compresslevel=9 if static else 6)
+
+    metrics.observe('compression_ms', (time.perf_counter() - start) * 1000)
+    return compressed
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def acceptedEncoding(available):
+    """
+    Best encoding of those available that the request accepts, or None to send the body as is.
+    """
+    for encoding in encodings:
+        if encoding in available and request.accept_encodings.quality(encoding) > 0:
+            return encoding
+
+    return None
+
+
+def immutableResponse(bodies, mimetype, etag):
+    """
+    Response for a fingerprinted URL, in the best encoding the request accepts.
+
+    Args:
+        bodies: dict of encoding (None for uncompressed) -> bytes
+        mimetype: str
+        etag: str; changes with the contents
+    """
+    encoding = acceptedEncoding(bodies)
+
+    response = Response(bodies[encoding], mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if len(bodies) > 1:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = immutable
+    response.set_etag('{}-{}'.format(etag, encoding or 'identity'))
+
+    return response.make_conditional(request)
+
+
+class StaticFiles(object):
+    """
+    Files in a directory, fingerprinted and precompressed in memory.
+    """
+
+    def __init__(self, directory, urlPrefix):
+        self.directory = directory
+        self.urlPrefix = urlPrefix
+        self.names = dict()  # File name -> fingerprinted name
+        self.files = dict()  # Fingerprinted name -> (mimetype, fingerprint, bodies by encoding)
+
+    def load(self):
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not os.path.isfile(path):
+                continue
+
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            digest = fingerprint(data)
+            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+            bodies = {None: data}
+            if mimetype.startswith(compressibleTypes):
+                for encoding in encodings:
+                    bodies[encoding] = compress(data, encoding, static=True)
+
+            base, extension = os.path.splitext(name)
+            fingerprintedName = '{}.{}{}'.format(base, digest, extension)
+            self.names[name] = fingerprintedName
+            self.files[fingerprintedName] = (mimetype, digest, bodies)
+
+            log.info('loaded static file', extra={'fields': {
+                'file': fingerprintedName, 'bytes': len(data),
+                'br_bytes': len(bodies.get('br', data)), 'gzip_bytes': len(bodies.get('gzip', data))}})
+
+    def url(self, name):
+        """
+        Fingerprinted URL of a file, which changes whenever the file does.
+        """
+        return self.urlPrefix + self.names[name]
+
+    def response(self, fingerprintedName):
+        if fingerprintedName not in self.files:
+            abort(404)
+
+        mimetype, digest, bodies = self.files[fingerprintedName]
+        return immutableResponse(bodies, mimetype, digest)
+
+
+class WeatherIcons(object):
+    """
+    OpenWeather forecast icons, fetched once and served from disk.
+    """
+
+    sourceUrl = 'https://openweathermap.org/img/wn/{}@2x.png'
+
+    def __init__(self, directory, urlPrefix):
+        self.directory = directory
+        self.urlPrefix = urlPrefix
+        self.lock = threading.Lock()
+        self.icons = dict()  # Icon code -> PNG bytes
+
+    def url(self, icon):
+        return self.urlPrefix + icon + '.png'
+
+    def image(self, icon):
+        """
+        PNG of an icon code, fetched from OpenWeather the first time any process needs it.
+        """
+        if icon in self.icons:
+            return self.icons[icon]
+
+        path = os.path.join(self.directory, icon + '.png')
+
+        with self.lock:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                response = get(self.sourceUrl.format(icon), timeout=10)
+                response.raise_for_status()
+                data = response.content
+
+                # Write and rename, so other processes never read a partial icon.
+                os.makedirs(self.directory, exist_ok=True)
+                temporaryPath = '{}.{}.tmp'.format(path, os.getpid())
+                with open(temporaryPath, 'wb') as f:
+                    f.write(data)
+                os.replace(temporaryPath, path)
+
+                log.info('fetched weather icon', extra={'fields': {'icon': icon}})
+
+            self.icons[icon] = data
+
+        return data
+
+    def response(self, icon):
+        if not iconPattern.match(icon):
+            abort(404)
+
+        try:
+            data = self.image(icon)
+        except (RequestException, OSError) as e:
+            log.warning('weather icon unavailable: %s', e, extra={'fields': {'icon': icon}})
+            abort(502)
+
+        # Icon codes always show the same picture. PNGs are already compressed.
+        return immutableResponse({None: data}, 'image/png', fingerprint(data))
+
+
+class Bundles(object):
+    """
+    Dash's component bundles, compressed as much as possible once, by one process for all through the shared cache.
+    """
+
+    def __init__(self):
+        self.bodies = dict()  # (sha1 of contents, encoding) -> compressed bytes
+        self.thread = None
+
+    def paths(self):
+        """
+        Files of the scripts and stylesheets Dash serves from component packages. Source maps are left out.
+        """
+        paths = []
+        for moduleName in sorted(ComponentRegistry.registry | {'dash_renderer'}):
+            module = sys.modules.get(moduleName)
+            if module is None:
+                continue
+
+            for attribute in ('_js_dist_dependencies', '_js_dist', '_css_dist'):
+                for resource in getattr(module, attribute, []):
+                    relativePaths = resource.get('relative_package_path') or []
+                    if isinstance(relativePaths, dict):
+                        relativePaths = relativePaths.get('prod', [])
+                    if isinstance(relativePaths, str):
+                        relativePaths = [relativePaths]
+
+                    paths += [os.path.join(os.path.dirname(module.__file__), relativePath)
+                              for relativePath in relativePaths if not relativePath.endswith('.map')]
+
+        return paths
+
+    def load(self):
+        start = time.perf_counter()
+
+        for path in self.paths():
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError as e:
+                log.warning('bundle unreadable: %s', e)
+                continue
+
+            digest = hashlib.sha1(data).hexdigest()
+            for encoding in encodings:
+                self.bodies[(digest, encoding)] = sc.getOrCompute(
+                    [], ('compressed', digest, encoding, 'static'),
+                    lambda data=data, encoding=encoding: compress(data, encoding, static=True))
+
+        log.info('compressed bundles', extra={'fields': {
+            'files': len(self.bodies) // len(encodings),
+            'duration_ms': round((time.perf_counter() - start) * 1000)}})
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.load, daemon=True)
+            self.thread.start()
+
+
+def compressResponse(response):
+    """
+    after_request hook compressing the page, Dash's responses and assets/ files in the best encoding the request accepts. URLs fingerprinted by Dash are marked immutable.
+
+    Each distinct body is compressed once across processes, through the shared cache. Dash's bundles are served as compressed at startup by `bundles` once it has them.
+    """
+    if not compressedPaths.match(request.path):
+        return response
+
+    # Dash fingerprints component bundles in the path and assets/ files with their modification time.
+    if response.status_code == 200 and (
+            (request.path.startswith('/_dash-component-suites/') and response.cache_control.max_age) or
+            (request.path.startswith('/assets/') and 'm' in request.args)):
+        response.headers['Cache-Control'] = immutable
+
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers or
+            not response.mimetype.startswith(compressibleTypes)):
+        return response
+
+    # Files are sent in passthrough mode. They're small enough to read in here.
+    response.direct_passthrough = False
+    data = response.get_data()
+    if len(data) < minimumBytes:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = acceptedEncoding(encodings)
+    if encoding is None:
+        return response
+
+    digest = hashlib.sha1(data).hexdigest()
+    body = bundles.bodies.get((digest, encoding))
+    if body is None:
+        body = sc.getOrCompute([], ('compressed', digest, encoding),
+                               lambda: compress(data, encoding))
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+
+    # The uncompressed body's ETag still names this response's contents.
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+
+vendor = StaticFiles(vendorDir, '/vendor/')
+vendor.load()
+
+# Started by the app once its component packages are imported.
+bundles = Bundles()
+
+weatherIcons = WeatherIcons(us.weatherIconDir, '/weather-icons/')
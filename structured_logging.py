@@ -0,0 +1,170 @@
+
+"""
+Structured, non-blocking logging.
+
+Records are put on a queue by the calling thread and formatted and written as one JSON object per line by a background thread, so request threads never wait on log output. Each record carries the id of the request it was logged in and any extra fields passed with it:
+
+    log = slog.getLogger(__name__)
+    log.info('inserted reading', extra={'fields': {'sensor_id': sensorId}, 'sample': 100})
+
+`sample` keeps one in that many records of a message, for messages logged on every reading or query. Set the level with LOG_LEVEL (default INFO).
+"""
+
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+# Id of the request being handled, added to every record logged while handling it.
+requestId = contextvars.ContextVar('requestId', default=None)
+
+
+def newRequestId(incoming=None):
+    """
+    Set the request id for the current context, reusing an incoming one (e.g. from a proxy's X-Request-Id) if given.
+
+    Returns:
+        str
+    """
+    value = incoming or uuid.uuid4().hex[:16]
+    requestId.set(value)
+    return value
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds the current request id to records. Attached to the queue handler, so it runs in the thread that logged the record.
+    """
+
+    def filter(self, record):
+        record.request_id = requestId.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one of every `sample` records of a message. Records without a `sample` attribute are always kept.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.counts = dict()
+
+    def filter(self, record):
+        rate = getattr(record, 'sample', None)
+        if not rate or rate <= 1:
+            return True
+
+        key = (record.name, record.msg)
+        with self.lock:
+            count = self.counts.get(key, 0)
+            self.counts[key] = count + 1
+
+        return count % rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as single-line JSON objects.
+    """
+
+    def format(self, record):
+        entry = {'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) +
+                 '.{:03d}Z'.format(int(record.msecs)),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'msg': record.getMessage()}
+
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        if getattr(record, 'sample', None):
+            entry['sampled'] = record.sample
+        entry.update(getattr(record, 'fields', None) or {})
+
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that keeps extra fields for the JSON formatter instead of flattening records into text.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure(level=None, stream=sys.stdout):
+    """
+    Route all logging through a queue to a background writer. Safe to call more than once.
+
+    Returns:
+        QueueListener
+    """
+    if getattr(configure, 'listener', None) is not None:
+        return configure.listener
+
+    root = logging.getLogger()
+
+    logQueue = queue.SimpleQueue()
+
+    handler = StructuredQueueHandler(logQueue)
+    handler.addFilter(SamplingFilter())
+    handler.addFilter(ContextFilter())
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter())
+
+    root.handlers = [handler]
+    root.setLevel(level or os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+    configure.listener = logging.handlers.QueueListener(logQueue, output)
+    configure.listener.start()
+    atexit.register(configure.listener.stop)
+
+    return configure.listener
+
+
+def getLogger(name):
+    return logging.getLogger(name)
+
+
+@contextmanager
+def timed(log, message, level=logging.INFO, sample=None, **fields):
+    """
+    Log a message with the time spent in the block, in milliseconds.
+
+    Args:
+        log: logging.Logger
+        message: str
+        fields: extra fields logged with the message. Values added to the yielded dict inside the block are logged too.
+    """
+    start = time.perf_counter()
+    fields = dict(fields)
+    try:
+        yield fields
+    finally:
+        fields['duration_ms'] = round(
+            (time.perf_counter() - start) * 1000, 1)
+        log.log(level, message, extra={'fields': fields, 'sample': sample})
+
+
+configure()
@@ -0,0 +1,148 @@
+
+"""
+Hourly and daily summaries of sensor readings, for long-range views.
+
+Each summary row holds the count, sum, minimum and maximum of a few metrics over one hour (UTC) or one local calendar day, per sensor. Rows are updated as readings are inserted, so a year of history is a few hundred daily rows no matter how many readings it has. Rebuild them from sensor_data after stored values are recomputed:
+
+    python summaries.py
+"""
+
+
+import pandas as pd
+import psycopg2
+from psycopg2 import extras
+
+import structured_logging as slog
+import user_settings as us
+
+
+log = slog.getLogger(__name__)
+
+# Summarized sensor_data columns.
+summaryMetrics = ['pm_2_5_aqi', 'pm_2_5_epa_aqi', 'temp_f_corrected']
+
+# Table -> bucket column and its PostgreSQL type.
+summaryTables = {'hourly_summary': ('hour', 'timestamptz'),
+                 'daily_summary': ('day', 'date')}
+
+statistics = ['count', 'sum', 'min', 'max']
+
+
+def statisticColumns():
+    return ['{}_{}'.format(metric, statistic) for metric in summaryMetrics for statistic in statistics]
+
+
+def statisticColumnTypes():
+    return {column: 'integer NOT NULL DEFAULT 0' if column.endswith('_count') else
+            'numeric NOT NULL DEFAULT 0' if column.endswith('_sum') else 'numeric'
+            for column in statisticColumns()}
+
+
+def bucketExpression(tableName, timezone=us.timezone):
+    """
+    SQL expression putting sensor_data.measurement_ts in a table's buckets. Takes the timezone as a parameter for daily buckets.
+    """
+    if tableName == 'daily_summary':
+        return "(measurement_ts AT TIME ZONE %s)::date", [timezone]
+
+    return "date_trunc('hour', measurement_ts AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'", []
+
+
+def bucketOf(tableName, ts, timezone=us.timezone):
+    ts = pd.Timestamp(ts).tz_convert('UTC')
+
+    if tableName == 'daily_summary':
+        return ts.tz_convert(timezone).date()
+
+    return ts.floor('h').to_pydatetime()
+
+
+def aggregate(rows, tableName, timezone=us.timezone):
+    """
+    Summarize rows per sensor and bucket.
+
+    Args:
+        rows: list of dicts of sensor_data column -> value
+
+    Returns:
+        list of tuples of (sensor ID, bucket, statistics in statisticColumns() order)
+    """
+    summaries = dict()
+
+    for row in rows:
+        key = (row.get('sensor_id') or '', bucketOf(tableName, row['measurement_ts'], timezone))
+        summary = summaries.setdefault(key, {metric: [0, 0.0, None, None] for metric in summaryMetrics})
+
+        for metric in summaryMetrics:
+            value = row.get(metric)
+            if value is None or value != value:  # Missing or NaN
+                continue
+            value = float(value)
+
+            stats = summary[metric]
+            stats[0] += 1
+            stats[1] += value
+            stats[2] = value if stats[2] is None else min(stats[2], value)
+            stats[3] = value if stats[3] is None else max(stats[3], value)
+
+    return [key + tuple(value for metric in summaryMetrics for value in summary[metric])
+            for key, summary in summaries.items()]
+
+
+def add(cur, rows, timezone=us.timezone):
+    """
+    Add newly inserted readings to the summaries. Runs in the inserting transaction, so summaries commit with the readings.
+
+    Args:
+        cur: psycopg2 cursor
+        rows: list of dicts of sensor_data column -> value
+    """
+    if not rows:
+        return
+
+    columns = statisticColumns()
+    updates = []
+    for column in columns:
+        if column.endswith('_min'):
+            updates.append('{0} = LEAST({{0}}.{0}, EXCLUDED.{0})'.format(column))
+        elif column.endswith('_max'):
+            updates.append('{0} = GREATEST({{0}}.{0}, EXCLUDED.{0})'.format(column))
+        else:
+            updates.append('{0} = {{0}}.{0} + EXCLUDED.{0}'.format(column))
+
+    for tableName, (bucketColumn, bucketType) in summaryTables.items():
+        extras.execute_values(
+            cur,
+            "INSERT INTO {0} (sensor_id, {1}, {2}) VALUES %s "
+            "ON CONFLICT (sensor_id, {1}) DO UPDATE SET {3} ".format(
+                tableName, bucketColumn, ', '.join(columns), ', '.join(updates).format(tableName)),
+            aggregate(rows, tableName, timezone))
+
+
+def rebuild(cur, timezone=us.timezone):
+    """
+    Recompute all summaries from sensor_data.
+    """
+    selectList = []
+    for metric in summaryMetrics:
+        selectList += ['COUNT({})'.format(metric), 'COALESCE(SUM({}), 0)'.format(metric),
+                       'MIN({})'.format(metric), 'MAX({})'.format(metric)]
+
+    for tableName, (bucketColumn, bucketType) in summaryTables.items():
+        bucket, params = bucketExpression(tableName, timezone)
+
+        cur.execute("DELETE FROM {} ".format(tableName))
+        cur.execute("INSERT INTO {0} (sensor_id, {1}, {2}) "
+                    "SELECT COALESCE(sensor_id, ''), {3}, {4} FROM sensor_data GROUP BY 1, 2 ".format(
+                        tableName, bucketColumn, ', '.join(statisticColumns()), bucket, ', '.join(selectList)),
+                    params)
+
+        log.info('rebuilt summary', extra={'fields': {'table': tableName, 'rows': cur.rowcount}})
+
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(us.databaseUrl)
+    cur = conn.cursor()
+    rebuild(cur)
+    conn.commit()
+    conn.close()
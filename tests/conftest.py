@@ -0,0 +1,53 @@
+import copy
+import os
+import sys
+
+import pytest
+
+# Modules live at the top level of the repository.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# user_settings requires the sensor's location and timezone.
+os.environ.setdefault('APP_TIMEZONE', 'UTC')
+os.environ.setdefault('LAT', '0')
+os.environ.setdefault('LONG', '0')
+
+
+# Reading as posted by a PurpleAir PA-II, trimmed of the B channel and status fields.
+purpleAirPayload = {
+    "SensorId": "84:f3:eb:7b:c8:a1", "DateTime": "2020/08/20T18:26:42z", "Geo": "PurpleAir-c8a1",
+    "Mem": 19448, "Id": 1534, "lat": 37.7, "lon": -122.4, "Adc": 0.05, "loggingrate": 15,
+    "place": "outside", "version": "6.01", "uptime": 21601, "rssi": -63, "period": 120,
+    "hardwareversion": "2.0", "hardwarediscovered": "2.0+BME280+PMSX003-B+PMSX003-A",
+    "current_temp_f": 84, "current_humidity": 36, "current_dewpoint_f": 54, "pressure": 1010.47,
+    "p25aqic": "rgb(255,240,0)", "pm2.5_aqi": 55, "pm1_0_cf_1": 9.9, "p_0_3_um": 2176.22,
+    "pm2_5_cf_1": 14.13, "p_0_5_um": 626.32, "pm10_0_cf_1": 16.09, "p_1_0_um": 102.16,
+    "pm1_0_atm": 9.9, "p_2_5_um": 11.4, "pm2_5_atm": 14.13, "p_5_0_um": 2.78,
+    "pm10_0_atm": 16.09, "p_10_0_um": 0.91, "pa_latency": 327, "response": 201,
+    "wlstate": "Connected", "ssid": "home"}
+
+
+@pytest.fixture
+def payload():
+    return copy.deepcopy(purpleAirPayload)
+
+
+@pytest.fixture
+def databaseCursor():
+    """
+    Cursor on a migrated database at TEST_DATABASE_URL, in a transaction rolled back after the test. Tests using it are skipped without one.
+    """
+    url = os.environ.get('TEST_DATABASE_URL')
+    if not url:
+        pytest.skip('TEST_DATABASE_URL not set')
+
+    import psycopg2
+    import migrations
+
+    conn = psycopg2.connect(url)
+    migrations.migrate(conn)
+    cur = conn.cursor()
+    yield cur
+
+    conn.rollback()
+    conn.close()
@@ -0,0 +1,72 @@
+import alerts
+
+
+class FakeCursor(object):
+    """
+    Cursor with no stored alert state, recording statements.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement, params=None):
+        self.statements.append((statement, params))
+
+    def fetchall(self):
+        return []
+
+
+def rules(*specs):
+    return [alerts.Rule(dict({'id': str(index)}, **spec)) for index, spec in enumerate(specs)]
+
+
+def reading(minute, value, sensorId='s1'):
+    return {'sensor_id': sensorId, 'measurement_ts': '2020-08-20T18:{:02d}:00+00:00'.format(minute),
+            'pm_2_5_aqi': value}
+
+
+def breachedIds(engine, sensorId='s1'):
+    return set(engine.sensors[sensorId]['breaches'])
+
+
+def test_changed_returns_rules_crossed_between_values():
+    index = alerts.ThresholdIndex(rules({'metric': 'm', 'above': 50},
+                                        {'metric': 'm', 'above': 100},
+                                        {'metric': 'm', 'below': 20}))
+
+    assert [rule.id for rule in index.changed(40, 60)] == ['0']
+    assert [rule.id for rule in index.changed(120, 40)] == ['0', '1']
+    assert [rule.id for rule in index.changed(30, 10)] == ['2']
+    assert index.changed(60, 60) == []
+    assert index.changed(60, 90) == []
+
+
+def test_sensor_rule_fires_alongside_global_rule_on_same_metric():
+    engine = alerts.AlertEngine(rules({'metric': 'pm_2_5_aqi', 'above': 150},
+                                      {'metric': 'pm_2_5_aqi', 'above': 50, 'sensor_id': 's1'}))
+    cur = FakeCursor()
+
+    engine.update(reading(0, 30), cur)
+    assert breachedIds(engine) == set()
+
+    engine.update(reading(2, 80), cur)
+    assert breachedIds(engine) == {'1'}
+
+    engine.update(reading(4, 160), cur)
+    assert breachedIds(engine) == {'0', '1'}
+
+    engine.update(reading(6, 40), cur)
+    assert breachedIds(engine) == set()
+
+
+def test_sensor_rule_ignores_other_sensors():
+    engine = alerts.AlertEngine(rules({'metric': 'pm_2_5_aqi', 'above': 150},
+                                      {'metric': 'pm_2_5_aqi', 'above': 50, 'sensor_id': 's1'}))
+    cur = FakeCursor()
+
+    engine.update(reading(0, 30, 's2'), cur)
+    engine.update(reading(2, 80, 's2'), cur)
+    assert breachedIds(engine, 's2') == set()
+
+    engine.update(reading(4, 160, 's2'), cur)
+    assert breachedIds(engine, 's2') == {'0'}
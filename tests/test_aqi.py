@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import aqi
+
+
+def readings(*spans):
+    """
+    Readings every 20 minutes over (start hour, end hour) spans, with varying concentrations.
+
+    Returns:
+        (numpy int64 array of reading times in ns since epoch, numpy array of concentrations)
+    """
+    day = pd.Timestamp('2020-08-20', tz='UTC').value
+    ts = np.concatenate([np.arange(day + start * aqi.nsPerHour, day + end * aqi.nsPerHour, aqi.nsPerHour // 3)
+                         for start, end in spans])
+    concentrations = 10 + 8 * np.sin(np.arange(len(ts)) / 3.0) + np.arange(len(ts)) % 5
+    return ts, concentrations
+
+
+def streamed(ts, concentrations):
+    calculator = aqi.NowCastCalculator()
+    return calculator, np.array([calculator.update('s1', pd.Timestamp(t, tz='UTC'), value)
+                                 for t, value in zip(ts, concentrations)])
+
+
+def test_streaming_matches_nowcast_array():
+    ts, concentrations = readings((0, 6))
+    concentrations[4] = np.nan
+
+    calculator, values = streamed(ts, concentrations)
+
+    np.testing.assert_allclose(values, aqi.nowCastArray(ts, concentrations))
+
+
+def test_streaming_matches_nowcast_array_across_slot_wraparound():
+    # Over 12 hours of readings, then a 5 hour gap, so hour % 12 slots are reused and some go stale.
+    ts, concentrations = readings((0, 15), (20, 27))
+
+    calculator, values = streamed(ts, concentrations)
+
+    np.testing.assert_allclose(values, aqi.nowCastArray(ts, concentrations))
+
+
+def test_late_reading_gets_the_nowcast_of_its_own_hour():
+    ts, concentrations = readings((0, 6))
+    # The last reading of hour 3 arrives after hour 5's readings.
+    late = list(ts).index(pd.Timestamp('2020-08-20 03:40', tz='UTC').value)
+    order = [index for index in range(len(ts)) if index != late] + [late]
+
+    calculator, values = streamed(ts[order], concentrations[order])
+
+    expected = aqi.nowCastArray(ts, concentrations)
+    assert values[-1] == pytest.approx(expected[late])
+    assert values[-1] != pytest.approx(expected[-1])
+    # Later readings still see the late one in hour 3's average.
+    assert calculator.current('s1') == pytest.approx(expected[-1])
+
+
+def test_reading_older_than_the_held_hours_has_no_nowcast():
+    ts, concentrations = readings((0, 14))
+    calculator, values = streamed(ts, concentrations)
+
+    assert np.isnan(calculator.update('s1', pd.Timestamp(ts[0], tz='UTC'), concentrations[0]))
+    assert calculator.current('s1') == values[-1]
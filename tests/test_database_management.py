@@ -0,0 +1,207 @@
+import threading
+import time
+
+import psycopg2
+import pytest
+
+import database_management as dm
+
+
+class FakeCursor(object):
+    """
+    Cursor over an empty sensor_data table. INSERTs affect `insertCount` rows, or raise `insertError`.
+    """
+
+    def __init__(self, insertCount=1, insertError=None):
+        self.insertCount = insertCount
+        self.insertError = insertError
+        self.rowcount = 0
+
+    def execute(self, statement, params=None):
+        self.rowcount = 0
+        if statement.startswith('INSERT INTO sensor_data'):
+            if self.insertError is not None:
+                raise self.insertError
+            self.rowcount = self.insertCount
+
+    def fetchall(self):
+        return []
+
+
+class FakeConnection(object):
+    def __init__(self, cur):
+        self.cur = cur
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class PooledConnection(object):
+    """
+    Connection opened by a pool, recording statements, cancels and transaction state.
+    """
+
+    def __init__(self):
+        self.closed = 0
+        self.statements = []
+        self.cancels = 0
+        self.inTransaction = False
+
+    def set_session(self, **characteristics):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement, params=None):
+        self.statements.append(statement)
+        self.inTransaction = True
+
+    def close(self):
+        self.closed = 1
+
+    def commit(self):
+        self.inTransaction = False
+
+    def rollback(self):
+        self.inTransaction = False
+
+    def cancel(self):
+        self.cancels += 1
+
+    def get_transaction_status(self):
+        return (psycopg2.extensions.TRANSACTION_STATUS_INTRANS if self.inTransaction
+                else psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    connections = []
+
+    def connect(*args, **kwargs):
+        connections.append(PooledConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(dm.psycopg2, 'connect', connect)
+    return connections
+
+
+def database(**cursorOptions):
+    return dm.AirDatabase(FakeConnection(FakeCursor(**cursorOptions)))
+
+
+def test_duplicate_reading_resets_derived_state(payload):
+    db = database(insertCount=0)
+
+    db.insert_sensor_row(payload)
+
+    assert db.conn.commits == 1
+    assert payload['SensorId'] not in db.nowCast.lastSeen
+    assert payload['SensorId'] not in db.windowStats.sensors
+
+
+def test_failed_insert_resets_sensor_state(payload):
+    db = database(insertError=psycopg2.DataError('value out of range'))
+    db.gaps.sensors[payload['SensorId']] = 'held'
+
+    db.insert_sensor_row(payload)
+
+    assert db.conn.rollbacks == 1
+    assert payload['SensorId'] not in db.nowCast.lastSeen
+    assert payload['SensorId'] not in db.windowStats.sensors
+    assert payload['SensorId'] not in db.gaps.sensors
+
+
+
+def test_checkout_waits_for_a_returned_connection(opened):
+    pool = dm.BlockingConnectionPool(1, 'dsn', waitSeconds=5)
+    conn = pool.getconn()
+    threading.Timer(0.1, pool.putconn, args=(conn,)).start()
+
+    start = time.monotonic()
+    assert pool.getconn() is conn
+    assert time.monotonic() - start >= 0.1
+    assert len(opened) == 1
+
+
+def test_checkout_times_out_when_the_pool_is_exhausted(opened):
+    pool = dm.BlockingConnectionPool(1, 'dsn', waitSeconds=0.2, maxWaiting=1)
+    pool.getconn()
+
+    start = time.monotonic()
+    with pytest.raises(dm.PoolTimeout):
+        pool.getconn()
+    assert time.monotonic() - start >= 0.2
+
+    # Checkouts beyond maxWaiting fail without waiting.
+    timeouts = []
+
+    def wait():
+        try:
+            pool.getconn()
+        except dm.PoolTimeout as e:
+            timeouts.append(e)
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    while not pool.waiting:
+        time.sleep(0.01)
+    start = time.monotonic()
+    with pytest.raises(dm.PoolTimeout):
+        pool.getconn()
+    assert time.monotonic() - start < 0.1
+    waiter.join()
+    assert len(timeouts) == 1
+
+
+def test_cancelled_query_returns_its_connection_clean(opened):
+    pool = dm.BlockingConnectionPool(1, 'dsn')
+
+    with pytest.raises(psycopg2.extensions.QueryCanceledError):
+        with pool.connection() as conn:
+            conn.cursor().execute("SELECT pg_sleep(60) ")
+            raise psycopg2.extensions.QueryCanceledError('canceling statement due to user request')
+
+    assert not conn.inTransaction
+    assert pool.getconn() is conn
+    assert not conn.closed
+
+
+def test_superseded_scope_cancels_its_running_query(opened):
+    scopes = dm.QueryScopes()
+    pool = dm.ReplicaRoutingPool(dm.BlockingConnectionPool(2, 'dsn'), scopes=scopes)
+    checkedOut = threading.Event()
+    superseded = threading.Event()
+    older = {}
+
+    def olderRequest():
+        with scopes.scope('session-output', timeoutSeconds=5) as scope:
+            with pool.connection() as conn:
+                older.update(scope=scope, conn=conn)
+                checkedOut.set()
+                superseded.wait(5)
+
+    thread = threading.Thread(target=olderRequest)
+    thread.start()
+    checkedOut.wait(5)
+    assert "SET statement_timeout = %s " in older['conn'].statements
+
+    with scopes.scope('session-output', timeoutSeconds=5):
+        assert older['conn'].cancels == 1
+        assert older['scope'].superseded
+        superseded.set()
+        thread.join()
+
+        # A cancel request may still reach it, so it's closed rather than reused.
+        assert older['conn'].closed
+        with pool.connection() as conn:
+            assert conn is not older['conn']
+            assert conn.cancels == 0
@@ -0,0 +1,72 @@
+import pandas as pd
+
+import gaps
+
+
+sensorId = 'test-gaps'
+
+
+def minute(value):
+    return pd.Timestamp('2020-08-20 18:00', tz='UTC') + pd.Timedelta(minutes=value)
+
+
+def store(cur, minutes, detector=None):
+    """
+    Insert readings at the given minutes in order, passing each to a detector as ingest does.
+    """
+    for value in minutes:
+        cur.execute("INSERT INTO sensor_data (sensor_id, measurement_ts) VALUES (%s, %s) ",
+                    (sensorId, minute(value).to_pydatetime()))
+        if detector is not None:
+            detector.update({'sensor_id': sensorId, 'measurement_ts': minute(value)}, cur)
+
+
+def storedGaps(cur):
+    return [(pd.Timestamp(start), pd.Timestamp(end)) for sensor, start, end in gaps.fetchGaps(cur, sensorIds=[sensorId])]
+
+
+def sweptGaps(cur):
+    gaps.sweep(cur, [sensorId], factor=3)
+    return storedGaps(cur)
+
+
+def test_late_readings_split_the_gap_they_fall_in(databaseCursor):
+    cur = databaseCursor
+    detector = gaps.GapDetector(factor=3)
+
+    store(cur, list(range(0, 22, 2)) + [50], detector)
+    assert storedGaps(cur) == [(minute(20), minute(50))]
+
+    # Replayed out of order, after newer readings.
+    store(cur, [40, 26, 30], detector)
+
+    detected = storedGaps(cur)
+    assert detected == sweptGaps(cur)
+    assert detected == [(minute(30), minute(40)), (minute(40), minute(50))]
+
+
+def test_first_reading_seen_may_fall_in_a_stored_gap(databaseCursor):
+    cur = databaseCursor
+    store(cur, list(range(0, 22, 2)) + [50])
+    gaps.sweep(cur, [sensorId], factor=3)
+
+    # A process that hasn't seen the sensor yet gets readings older than the newest stored one.
+    store(cur, [40, 22], gaps.GapDetector(factor=3))
+
+    detected = storedGaps(cur)
+    assert detected == sweptGaps(cur)
+    assert detected == [(minute(22), minute(40)), (minute(40), minute(50))]
+
+
+def test_gap_recorded_by_another_process_is_split(databaseCursor):
+    cur = databaseCursor
+    detector = gaps.GapDetector(factor=3)
+    store(cur, range(0, 22, 2), detector)
+
+    # Another process stores a newer reading, recording the gap before it.
+    store(cur, [50], gaps.GapDetector(factor=3))
+    store(cur, [40], detector)
+
+    detected = storedGaps(cur)
+    assert detected == sweptGaps(cur)
+    assert detected == [(minute(20), minute(40)), (minute(40), minute(50))]
@@ -0,0 +1,98 @@
+import contextlib
+
+import pandas as pd
+
+import hot_tier as ht
+
+
+class FakePool(object):
+    """
+    Pool whose cursors answer the tier's query from a list of (ts, value, sensor ID) rows.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement, params):
+        self.since = params[0]
+
+    def fetchall(self):
+        return sorted(row for row in self.rows if row[0] > self.since)
+
+    def close(self):
+        pass
+
+
+def minute(value):
+    return pd.Timestamp.now(tz='UTC').floor('D') - pd.Timedelta(hours=1) + pd.Timedelta(minutes=value)
+
+
+def sensorTier(rows, days=1):
+    tier = ht.HotTier('sensor_data', 'measurement_ts', ['pm_2_5_aqi'], days=days, keyColumn='sensor_id')
+    pool = FakePool(rows)
+    tier.warm(pool)
+    return tier, pool
+
+
+def heldValues(tier, sensorId='a'):
+    ts, values = tier.buffers[sensorId].slice()
+    return list(values[0])
+
+
+def test_catch_up_finds_rows_committed_after_newer_ones():
+    tier, pool = sensorTier([(minute(0), 10, 'a'), (minute(2), 12, 'a')])
+
+    # Another process commits a row at minute 6, then one at minute 4.
+    pool.rows.append((minute(6), 16, 'a'))
+    tier.expire()
+    tier.catchUp(pool)
+
+    pool.rows.append((minute(4), 14, 'a'))
+    tier.expire()
+    tier.catchUp(pool)
+
+    assert heldValues(tier) == [10, 12, 14, 16]
+
+
+def test_sensors_reporting_at_the_same_time_are_all_kept():
+    tier, pool = sensorTier([(minute(0), 10, 'a'), (minute(4), 14, 'a')])
+
+    tier.add({'measurement_ts': minute(2), 'sensor_id': 'a', 'pm_2_5_aqi': 12})
+    tier.add({'measurement_ts': minute(2), 'sensor_id': 'b', 'pm_2_5_aqi': 22})
+    tier.add({'measurement_ts': minute(2), 'sensor_id': 'b', 'pm_2_5_aqi': 22})
+
+    assert heldValues(tier, 'a') == [10, 12, 14]
+    assert heldValues(tier, 'b') == [22]
+
+
+def test_select_merges_sensors_newest_first_and_filters_by_sensor():
+    tier, pool = sensorTier([(minute(0), 10, 'a'), (minute(1), 21, 'b'), (minute(2), 12, 'a')])
+    names = ['measurement_ts', 'sensor_id', 'pm_2_5_aqi']
+
+    records = tier.select(names, minute(0))
+    assert list(records.columns) == names
+    assert list(records.sensor_id) == ['a', 'b', 'a']
+    assert list(records.pm_2_5_aqi) == [12, 21, 10]
+
+    records = tier.select(names, minute(0), equals={'sensor_id': 'b'})
+    assert list(records.pm_2_5_aqi) == [21]
+
+
+def test_each_sensor_keeps_the_configured_days():
+    tier, pool = sensorTier([], days=1)
+    capacity = int(tier.capacity)
+
+    for index in range(capacity):
+        for sensorId in ('a', 'b'):
+            tier.add({'measurement_ts': minute(0) + pd.Timedelta(seconds=index), 'sensor_id': sensorId,
+                      'pm_2_5_aqi': index})
+
+    assert len(heldValues(tier, 'a')) == len(heldValues(tier, 'b')) == capacity
+    assert tier.select(['measurement_ts', 'pm_2_5_aqi'], minute(0)) is not None
@@ -0,0 +1,88 @@
+from datetime import datetime as dt
+from datetime import timedelta, timezone
+
+import pytest
+
+import payload_schema as ps
+
+
+# Marks a key removed from the payload.
+missing = object()
+
+
+def changed(payload, changes):
+    for key, value in changes.items():
+        if value is missing:
+            del payload[key]
+        else:
+            payload[key] = value
+    return payload
+
+
+def test_sample_payload_is_accepted(payload):
+    row = ps.transformer.row(ps.transformer(payload))
+
+    assert row['sensor_id'] == '84:f3:eb:7b:c8:a1'
+    assert row['measurement_ts'] == dt(2020, 8, 20, 18, 26, 42, tzinfo=timezone.utc)
+    assert row['temp_f'] == 84
+    assert row['pressure_mbar'] == 1010.47
+    assert row['pm_2_5_um_m3'] == 14.13
+    assert list(row) == [field['column'] for field in ps.fields]
+
+
+@pytest.mark.parametrize('changes, column, value', [
+    # Numbers sent as strings.
+    ({'current_temp_f': '84.5'}, 'temp_f', 84.5),
+    ({'rssi': '-63'}, 'rssi_dbm', -63),
+    # Null values are stored as NULL, or as the field's default.
+    ({'current_humidity': None}, 'humidity', None),
+    ({'SensorId': None}, 'sensor_id', ''),
+    # Limits are inclusive.
+    ({'current_humidity': 100}, 'humidity', 100),
+    ({'current_temp_f': -40}, 'temp_f', -40),
+    # ISO times with an offset.
+    ({'DateTime': '2020-08-20T11:26:42-07:00'}, 'measurement_ts',
+     dt(2020, 8, 20, 11, 26, 42, tzinfo=timezone(timedelta(hours=-7)))),
+])
+def test_accepted_values(payload, changes, column, value):
+    values = ps.transformer(changed(payload, changes))
+
+    assert ps.transformer.value(values, column) == value
+
+
+@pytest.mark.parametrize('changes, problems', [
+    ({'current_temp_f': missing}, ['missing current_temp_f']),
+    ({'DateTime': None}, ['invalid DateTime: must not be null']),
+    ({'DateTime': '2020-08-20T18:26:42'}, ["invalid DateTime: expected a time with a timezone, got '2020-08-20T18:26:42'"]),
+    ({'DateTime': 1597948002}, ['invalid DateTime: expected a string, got 1597948002']),
+    ({'current_humidity': 'humid'}, ["invalid current_humidity: could not convert string to float: 'humid'"]),
+    ({'current_humidity': 'NaN'}, ['invalid current_humidity: expected a finite number, got nan']),
+    ({'pressure': float('inf')}, ['invalid pressure: expected a finite number, got inf']),
+    ({'uptime': True}, ['invalid uptime: expected a number, got True']),
+    ({'SensorId': 7}, ['invalid SensorId: expected a string, got 7']),
+    ({'current_humidity': 100.5}, ['invalid current_humidity: 100.5 is above 100']),
+    ({'pm2.5_aqi': -1}, ['invalid pm2.5_aqi: -1 is below 0']),
+    # Every problem is listed, in field order.
+    ({'pressure': 5, 'place': missing, 'current_temp_f': 'hot'},
+     ['missing place', "invalid current_temp_f: could not convert string to float: 'hot'",
+      'invalid pressure: 5 is below 300']),
+])
+def test_rejected_values(payload, changes, problems):
+    with pytest.raises(ps.PayloadError) as error:
+        ps.transformer(changed(payload, changes))
+
+    assert error.value.problems == problems
+    assert str(error.value) == '; '.join(problems)
+
+
+@pytest.mark.parametrize('body', [None, [], 'reading', 42])
+def test_non_object_payloads_are_rejected(body):
+    with pytest.raises(ps.PayloadError) as error:
+        ps.transformer(body)
+
+    assert error.value.problems == ['expected a JSON object']
+
+
+def test_payload_error_is_a_value_error(payload):
+    with pytest.raises(ValueError):
+        ps.transformer(changed(payload, {'Id': missing}))
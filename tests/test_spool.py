@@ -0,0 +1,127 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import spool
+
+
+class FakeConnection(object):
+    closed = False
+
+    def rollback(self):
+        pass
+
+
+class FakeDb(object):
+    """
+    Database storing the payloads of each insert, failing for readings with a 'bad' key.
+    """
+
+    def __init__(self):
+        self.conn = FakeConnection()
+        self.batches = []
+
+    def insert_sensor_rows(self, payloads):
+        if any('bad' in payload for payload in payloads):
+            raise ValueError('malformed reading')
+        self.batches.append([payload['n'] for payload in payloads])
+
+    @property
+    def stored(self):
+        return [n for batch in self.batches for n in batch]
+
+
+def writeSegment(directory, name, records):
+    with open(os.path.join(directory, name + spool.segmentSuffix), 'w') as f:
+        for received, payload in records:
+            f.write(json.dumps({'received': received, 'payload': payload}) + '\n')
+
+
+def replayAll(replayer, db):
+    while replayer.replayBatch(db):
+        pass
+
+
+def test_writer_rotates_segments_and_replay_drains_them(tmp_path):
+    writer = spool.SpoolWriter(str(tmp_path), segmentBytes=200)
+    for n in range(10):
+        writer.append({'n': n})
+
+    replayer = spool.Replayer(str(tmp_path), batchRows=4, pollSeconds=0.01)
+    assert len(replayer.segments()) > 1
+
+    db = FakeDb()
+    replayAll(replayer, db)
+
+    assert db.stored == list(range(10))
+    assert max(len(batch) for batch in db.batches) == 4
+    # Finished segments are removed. The one still being written stays.
+    assert len(replayer.segments()) == 1
+
+
+def test_offsets_survive_a_restart(tmp_path):
+    writeSegment(str(tmp_path), 'a', [(n, {'n': n}) for n in range(5)])
+
+    db = FakeDb()
+    assert spool.Replayer(str(tmp_path), batchRows=2, pollSeconds=0.01).replayBatch(db) == 2
+
+    # A new process picks up after the saved offsets.
+    replayAll(spool.Replayer(str(tmp_path), batchRows=2, pollSeconds=0.01), db)
+
+    assert db.stored == list(range(5))
+    assert os.listdir(str(tmp_path)) == ['offsets.json']
+
+
+def test_segments_are_merged_in_arrival_order(tmp_path):
+    writeSegment(str(tmp_path), 'a', [(1, {'n': 1}), (4, {'n': 4}), (5, {'n': 5})])
+    writeSegment(str(tmp_path), 'b', [(2, {'n': 2}), (3, {'n': 3}), (6, {'n': 6})])
+
+    db = FakeDb()
+    replayAll(spool.Replayer(str(tmp_path), batchRows=4, pollSeconds=0.01), db)
+
+    assert db.batches == [[1, 2, 3, 4], [5, 6]]
+
+
+def test_readings_failing_on_their_own_are_dead_lettered(tmp_path):
+    writeSegment(str(tmp_path), 'a', [(1, {'n': 1}), (2, {'n': 2, 'bad': True}), (3, {'n': 3})])
+    replayer = spool.Replayer(str(tmp_path), batchRows=10, pollSeconds=0.01)
+    db = FakeDb()
+
+    with pytest.raises(ValueError):
+        replayer.replayBatch(db)
+    assert replayer.loadOffsets() == {}
+
+    assert replayer.replayBatch(db, oneByOne=True) == 3
+    assert db.stored == [1, 3]
+
+    with open(replayer.deadLetterPath) as f:
+        deadLetters = [json.loads(line) for line in f]
+    assert [letter['record']['payload']['n'] for letter in deadLetters] == [2]
+    assert 'malformed reading' in deadLetters[0]['error']
+    assert replayer.replayBatch(db) == 0
+
+
+def test_only_the_process_holding_the_lock_replays(tmp_path):
+    writeSegment(str(tmp_path), 'a', [(1, {'n': 1})])
+
+    # Another process holds the replay lock.
+    lockFd = os.open(os.path.join(str(tmp_path), 'replay.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(lockFd, fcntl.LOCK_EX)
+
+    db = FakeDb()
+    replayer = spool.Replayer(str(tmp_path), batchRows=10, pollSeconds=0.01)
+    replayer.start(lambda: db, threading.Event())
+
+    time.sleep(0.3)
+    assert db.stored == []
+
+    # Its readings are replayed once it exits.
+    os.close(lockFd)
+    deadline = time.time() + 5
+    while not db.stored and time.time() < deadline:
+        time.sleep(0.01)
+    assert db.stored == [1]
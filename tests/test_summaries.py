@@ -0,0 +1,61 @@
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import summaries
+
+
+sensorIds = ['test-summaries-a', 'test-summaries-b']
+timezone = 'America/Los_Angeles'
+
+
+def readings():
+    """
+    Readings of two sensors every 10 minutes over two days, with missing values.
+    """
+    rows = []
+    for index, ts in enumerate(pd.date_range('2020-08-20 05:00', '2020-08-22 09:00', freq='10min', tz='UTC')):
+        for offset, sensorId in enumerate(sensorIds):
+            rows.append({'sensor_id': sensorId, 'measurement_ts': ts.to_pydatetime(),
+                         'pm_2_5_aqi': None if index % 7 == 0 else float(40 + index % 23 + offset),
+                         'pm_2_5_epa_aqi': float(30 + np.sin(index / 5.0) * 10),
+                         'temp_f_corrected': None if index % 11 == 3 else round(65 + index % 17 * 0.7, 2)})
+    return rows
+
+
+def snapshot(cur):
+    tables = dict()
+    for tableName, (bucketColumn, bucketType) in summaries.summaryTables.items():
+        cur.execute("SELECT sensor_id, {0}, {1} FROM {2} WHERE sensor_id = ANY(%s) ORDER BY sensor_id, {0} ".format(
+            bucketColumn, ', '.join(summaries.statisticColumns()), tableName), (sensorIds,))
+        tables[tableName] = [tuple(float(value) if isinstance(value, Decimal) else value for value in row)
+                             for row in cur.fetchall()]
+    return tables
+
+
+def test_adding_batches_matches_rebuilding(databaseCursor):
+    cur = databaseCursor
+    rows = readings()
+    columns = list(rows[0])
+
+    # Inserted in uneven batches, as ingest does.
+    for start, end in zip([0, 1, 40, 41, 300], [1, 40, 41, 300, len(rows)]):
+        batch = rows[start:end]
+        for row in batch:
+            cur.execute("INSERT INTO sensor_data ({}) VALUES ({}) ".format(
+                ', '.join(columns), ', '.join(['%s'] * len(columns))), [row[column] for column in columns])
+        summaries.add(cur, batch, timezone)
+    added = snapshot(cur)
+
+    summaries.rebuild(cur, timezone)
+    rebuilt = snapshot(cur)
+
+    # Parts of four local days, for each of two sensors.
+    assert len(added['daily_summary']) == 8
+    for tableName in summaries.summaryTables:
+        assert len(added[tableName]) == len(rebuilt[tableName])
+        for addedRow, rebuiltRow in zip(added[tableName], rebuilt[tableName]):
+            assert addedRow[:2] == rebuiltRow[:2]
+            assert addedRow[2:] == pytest.approx(rebuiltRow[2:])
@@ -0,0 +1,62 @@
+import pytest
+import requests
+
+import weather_fetch as wf
+
+
+class FakeDb(object):
+    """
+    Database granting every weather fetch claim, recording inserted weather.
+    """
+
+    def __init__(self):
+        self.inserted = []
+
+    def update_sensor_location(self, sensorId, latitude, longitude, key):
+        pass
+
+    def claim_weather_fetch(self, key, intervalSeconds):
+        return True
+
+    def insert_weather_row_and_forecasts(self, weatherData, key):
+        self.inserted.append((weatherData, key))
+
+
+class FakeResponse(object):
+
+    def __init__(self, status, content):
+        self.status_code = status
+        self.content = content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{} error'.format(self.status_code))
+
+
+def fetchWith(monkeypatch, payload, result):
+    def get(url, timeout=None):
+        assert timeout == wf.requestTimeoutSeconds
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(wf, 'get', get)
+    db = FakeDb()
+    wf.WeatherFetcher().fetchForSensor(db, payload)
+    return db.inserted
+
+
+def test_weather_is_inserted_for_the_sensor_grid_cell(monkeypatch, payload):
+    inserted = fetchWith(monkeypatch, payload, FakeResponse(200, b'{"current": {}}'))
+
+    assert inserted == [({'current': {}}, wf.gridCell(payload['lat'], payload['lon'])[0])]
+
+
+@pytest.mark.parametrize('result', [
+    FakeResponse(401, b'{"cod": 401, "message": "Invalid API key"}'),
+    FakeResponse(200, b'<html>Bad gateway</html>'),
+    requests.Timeout('read timed out'),
+    requests.ConnectionError('connection refused'),
+])
+def test_failed_fetches_are_skipped(monkeypatch, payload, result):
+    assert fetchWith(monkeypatch, payload, result) == []
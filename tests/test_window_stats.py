@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+import window_stats as ws
+
+
+class FakeCursor(object):
+    """
+    Cursor answering window reloads from a dataframe of stored readings.
+    """
+
+    def __init__(self, stored):
+        self.stored = stored
+        self.loads = []
+
+    def execute(self, statement, params):
+        sensorId, start, end = params
+        self.loads.append(end)
+        self.rows = self.stored[(self.stored.sensor_id == sensorId) & (self.stored.measurement_ts >= start) &
+                                (self.stored.measurement_ts < end)]
+
+    def fetchall(self):
+        return list(self.rows[['measurement_ts', 'pm_2_5_um_m3', 'pm_2_5_aqi', 'temp_f_corrected']].itertuples(
+            index=False))
+
+
+def storedReadings():
+    """
+    Two minutes apart over 20 hours that cross midnight, with a few longer gaps and missing values.
+    """
+    ts = pd.date_range('2020-08-20 14:00', '2020-08-21 10:00', freq='2min', tz='UTC')
+    ts = ts.delete([100, 101, 102, 103, 104, 105, 400, 401, 402])
+    count = len(ts)
+    records = pd.DataFrame({
+        'measurement_ts': ts,
+        'sensor_id': 's1',
+        'pm_2_5_um_m3': 20 + 15 * np.sin(np.arange(count) / 40.0),
+        'pm_2_5_aqi': 60 + 45 * np.sin(np.arange(count) / 40.0),
+        'temp_f_corrected': 70 + 10 * np.cos(np.arange(count) / 90.0)})
+    records.loc[[5, 6, 300], 'pm_2_5_um_m3'] = np.nan
+    records.loc[[7, 301, 302], 'temp_f_corrected'] = np.nan
+    return records
+
+
+def streamed(stats, records, cur):
+    return pd.DataFrame([stats.update(row, cur) for row in records.to_dict('records')], index=records.index)
+
+
+def assertSameStatistics(values, expected):
+    for column in ws.windowColumnTypes:
+        np.testing.assert_allclose(values[column].to_numpy(dtype='float64'),
+                                   expected[column].to_numpy(dtype='float64'), err_msg=column)
+
+
+def history(records):
+    return ws.windowHistory(records.copy(), threshold=100, timezone='UTC')
+
+
+def test_streaming_matches_window_history():
+    records = storedReadings()
+    cur = FakeCursor(records)
+
+    values = streamed(ws.WindowStatistics(threshold=100, timezone='UTC'), records, cur)
+
+    assertSameStatistics(values, history(records))
+    # Loaded when the sensor was first seen and after each gap longer than reloadGap.
+    assert len(cur.loads) == 3
+
+
+def test_windows_reload_readings_ingested_elsewhere_after_a_gap():
+    records = storedReadings()
+    cur = FakeCursor(records)
+    stats = ws.WindowStatistics(threshold=100, timezone='UTC')
+
+    # Readings 200 to 299 are ingested by another process.
+    seen = streamed(stats, records.iloc[:200], cur)
+    resumed = streamed(stats, records.iloc[300:], cur)
+
+    assert records.measurement_ts[300] in cur.loads
+    assertSameStatistics(pd.concat([seen, resumed]), history(records).drop(index=range(200, 300)))
@@ -3,6 +3,8 @@ import os
 
 # Get user settings set as environment variables. All read in as str. Set environment variables in dokku according to http://dokku.viewdocs.io/dokku/configuration/environment-variables/
 databaseUrl = os.environ.get('DATABASE_URL')
+# Optional read replica for dashboard queries.
+readDatabaseUrl = os.environ.get('READ_DATABASE_URL')
 
 # Keys. If named item doesn't exist, var = None.
 header_key = os.environ.get('HEADER_KEY')
@@ -21,11 +23,33 @@ showHourlyForecast = os.environ.get('SHOW_HOURLY_FORECAST')
 
 # Other
 loadHistoricalData = os.environ.get('LOAD_HISTORICAL_DATA')
+archiveDir = os.environ.get('ARCHIVE_DIR')
+hotTierDays = os.environ.get('HOT_TIER_DAYS')
+aqiThreshold = os.environ.get('AQI_THRESHOLD')
+sharedCacheDir = os.environ.get('SHARED_CACHE_DIR')
+sharedCacheMb = os.environ.get('SHARED_CACHE_MB')
+weatherGridDegrees = os.environ.get('WEATHER_GRID_DEGREES')
+weatherIntervalSeconds = os.environ.get('WEATHER_INTERVAL_SECONDS')
+alertRulesFile = os.environ.get('ALERT_RULES_FILE')
+alertLogFile = os.environ.get('ALERT_LOG_FILE')
+alertWebhookUrl = os.environ.get('ALERT_WEBHOOK_URL')
+spoolDir = os.environ.get('SPOOL_DIR')
+spoolSegmentMb = os.environ.get('SPOOL_SEGMENT_MB')
+readMaxLagSeconds = os.environ.get('READ_MAX_LAG_SECONDS')
+weatherIconDir = os.environ.get('WEATHER_ICON_DIR')
+gapFactor = os.environ.get('GAP_FACTOR')
+poolWaitSeconds = os.environ.get('POOL_WAIT_SECONDS')
+poolMaxWaiting = os.environ.get('POOL_MAX_WAITING')
+poolMaxAgeSeconds = os.environ.get('POOL_MAX_AGE_SECONDS')
 
 
 # Validate settings.
 if not openWeatherApiKey:
     print('no OpenWeather API key provided. Official outside weather info will not be displayed')
+if not archiveDir:
+    print('no archive directory provided. Long-range history will be read from the database only')
+if alertRulesFile and not (alertLogFile or alertWebhookUrl):
+    print('no alert log file or webhook URL provided. Alerts will only be logged')
 if not header_key:
     print("no PurpleAir POST header key provided. Database will have increased vulnerability to insertion attacks from unverified POST sources. Add header key on the PurpleAir 'Modify registration' form at https://www.purpleair.com/register according to https://www.keycdn.com/support/custom-http-headers")
 
@@ -45,6 +69,12 @@ if not defaultTimeRange:
     print('defaulting to showing 3 days of data')
     defaultTimeRange = '3 days'
 
+if not aqiThreshold:
+    print('defaulting to counting time above AQI 100')
+    aqiThreshold = 100
+else:
+    aqiThreshold = float(aqiThreshold)
+
 if showDailyForecast == 'True':
     showDailyForecast = True
 elif showDailyForecast == 'False':
@@ -66,3 +96,75 @@ if loadHistoricalData == 'True':
     loadHistoricalData = True
 else:
     loadHistoricalData = False
+
+if not hotTierDays:
+    hotTierDays = 14
+else:
+    # 0 turns off the in-memory hot tier.
+    hotTierDays = int(hotTierDays)
+
+if not sharedCacheDir:
+    # Shared memory, so worker processes can share cached results.
+    sharedCacheDir = '/dev/shm/airdash' if os.path.isdir('/dev/shm') else None
+elif sharedCacheDir == 'None':
+    sharedCacheDir = None
+
+if not sharedCacheMb:
+    sharedCacheMb = 256
+else:
+    sharedCacheMb = int(sharedCacheMb)
+
+if not weatherGridDegrees:
+    # About 11 km north-south.
+    weatherGridDegrees = 0.1
+else:
+    weatherGridDegrees = float(weatherGridDegrees)
+
+if not weatherIntervalSeconds:
+    # OpenWeather updates current weather about every 10 minutes.
+    weatherIntervalSeconds = 10 * 60
+else:
+    weatherIntervalSeconds = int(weatherIntervalSeconds)
+
+if not spoolDir:
+    # Incoming readings are written here before they're stored in the database.
+    spoolDir = 'spool'
+elif spoolDir == 'None':
+    # Store readings in the database as they arrive.
+    spoolDir = None
+
+if not spoolSegmentMb:
+    spoolSegmentMb = 16
+else:
+    spoolSegmentMb = int(spoolSegmentMb)
+
+if not readMaxLagSeconds:
+    readMaxLagSeconds = 30
+else:
+    readMaxLagSeconds = float(readMaxLagSeconds)
+
+if not weatherIconDir:
+    # Forecast icons are fetched from OpenWeather once and kept here.
+    weatherIconDir = 'weather_icons'
+
+if not gapFactor:
+    # Three missed readings in a row.
+    gapFactor = 3
+else:
+    gapFactor = float(gapFactor)
+
+if not poolWaitSeconds:
+    poolWaitSeconds = 10
+else:
+    poolWaitSeconds = float(poolWaitSeconds)
+
+if not poolMaxWaiting:
+    poolMaxWaiting = 50
+else:
+    poolMaxWaiting = int(poolMaxWaiting)
+
+if not poolMaxAgeSeconds:
+    # Reopen connections hourly, so server processes don't grow indefinitely.
+    poolMaxAgeSeconds = 60 * 60
+else:
+    poolMaxAgeSeconds = float(poolMaxAgeSeconds)
@@ -0,0 +1,107 @@
+
+"""
+Fetching weather for the location of each sensor, shared by all sensors nearby.
+
+Locations are snapped to a grid (WEATHER_GRID_DEGREES, 0.1° by default) and weather is fetched for the center of each grid cell at most once per upstream update interval (WEATHER_INTERVAL_SECONDS, 10 minutes by default), no matter how many sensors in the cell report or how many processes receive their readings.
+"""
+
+
+import json
+import math
+import time
+
+from requests import RequestException, get  # Make get requests
+
+import metrics
+import user_settings as us
+import structured_logging as slog
+
+
+log = slog.getLogger(__name__)
+
+# Seconds to wait for the OpenWeather API to connect and to send each part of its response.
+requestTimeoutSeconds = 10
+
+
+def gridCell(latitude, longitude, gridDegrees=us.weatherGridDegrees):
+    """
+    Snap a location to the center of its grid cell.
+
+    Returns:
+        (location key str, cell center latitude, cell center longitude)
+    """
+    cellLatitude = (math.floor(float(latitude) / gridDegrees) + 0.5) * gridDegrees
+    cellLongitude = (math.floor(float(longitude) / gridDegrees) + 0.5) * gridDegrees
+
+    return '{:.4f},{:.4f}'.format(cellLatitude, cellLongitude), cellLatitude, cellLongitude
+
+
+# Location shown on the dashboard.
+primaryLocationKey = gridCell(us.latitude, us.longitude)[0]
+
+
+def sensorLocation(data):
+    """
+    Location reported in a sensor payload, falling back to the configured location.
+
+    Returns:
+        (latitude, longitude) tuple of float
+    """
+    try:
+        return float(data['lat']), float(data['lon'])
+    except (KeyError, TypeError, ValueError):
+        return float(us.latitude), float(us.longitude)
+
+
+class WeatherFetcher(object):
+    """
+    Fetches weather per grid cell, claiming each fetch in the database so only one process makes it.
+    """
+
+    def __init__(self, intervalSeconds=us.weatherIntervalSeconds):
+        self.intervalSeconds = intervalSeconds
+        # Location key -> time this process last fetched or saw a claimed fetch.
+        self.lastFetched = dict()
+
+    def fetchForSensor(self, db, data):
+        """
+        Record a sensor's location and fetch weather for it if no recent fetch covers its grid cell.
+
+        Args:
+            db: AirDatabase
+            data: sensor payload; dict
+
+        Returns:
+            NULL
+        """
+        latitude, longitude = sensorLocation(data)
+        key, cellLatitude, cellLongitude = gridCell(latitude, longitude)
+
+        db.update_sensor_location(data.get('SensorId'), latitude, longitude, key)
+
+        if time.time() - self.lastFetched.get(key, 0) < self.intervalSeconds:
+            return
+        self.lastFetched[key] = time.time()
+
+        if not db.claim_weather_fetch(key, self.intervalSeconds):
+            # Another process fetched this cell recently.
+            return
+
+        # Make get request to OpenWeather API.
+        try:
+            with slog.timed(log, 'queried weather API', location_key=key) as fields:
+                weatherResponse = get("https://api.openweathermap.org/data/2.5/onecall?lat={}&lon={}&appid={}&units=imperial&lang={}".format(
+                    cellLatitude, cellLongitude, us.openWeatherApiKey, us.lang), timeout=requestTimeoutSeconds)
+                fields['status'] = weatherResponse.status_code
+            weatherResponse.raise_for_status()
+            weatherData = json.loads(weatherResponse.content.decode('utf-8'))
+        except (RequestException, ValueError) as e:
+            # The claim stands, so the cell is tried again after the interval rather than by every process now.
+            log.warning('weather fetch failed: %s', e, extra={'fields': {'location_key': key}})
+            metrics.increment('weather_fetch_failures')
+            return
+
+        db.insert_weather_row_and_forecasts(weatherData, key)
+
+
+fetcher = WeatherFetcher()
@@ -0,0 +1,227 @@
+
+"""
+Sliding-window statistics over incoming readings: 24-hour average PM 2.5, hours above an AQI threshold in the last 24 hours, and the day's temperature extremes so far.
+
+Values are computed per reading as it arrives and stored in sensor_data, so the dashboard can plot and summarize them without re-scanning raw data.
+"""
+
+
+import threading
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+import aqi  # Calculating AQI.
+import user_settings as us
+
+
+window = pd.Timedelta(hours=24)
+rollingWindow = '24h'
+
+# Longest time one reading is taken to represent when adding up time above the AQI threshold.
+maxReadingDuration = pd.Timedelta(minutes=10)
+
+pm25Breakpoints = aqi.loadAqiBreakpoints(pollutant='PM2.5 - Local Conditions')
+
+# Stored columns and their PostgreSQL types.
+windowColumnTypes = {'pm_2_5_24h_avg_um_m3': 'numeric',
+                     'pm_2_5_24h_aqi': 'numeric',
+                     'hours_above_aqi_threshold_24h': 'numeric',
+                     'temp_f_day_high': 'numeric',
+                     'temp_f_day_low': 'numeric'}
+
+
+def toFloat(value):
+    return np.nan if value is None else float(value)
+
+
+class SlidingWindow(object):
+    """
+    Running sum and mean of values in a trailing time window. Updates are amortized O(1).
+    """
+
+    def __init__(self, span):
+        self.span = span
+        self.readings = deque()
+        self.total = 0.0
+
+    def add(self, ts, value):
+        """
+        Add a value. Readings must be added in time order.
+
+        Args:
+            ts: pandas Timestamp
+            value: float; NaN values are skipped
+        """
+        if not np.isnan(value):
+            self.readings.append((ts, value))
+            self.total += value
+
+        self.expire(ts)
+
+    def expire(self, now):
+        cutoff = now - self.span
+
+        while self.readings and self.readings[0][0] <= cutoff:
+            self.total -= self.readings.popleft()[1]
+
+        if not self.readings:
+            # Drop accumulated floating point error.
+            self.total = 0.0
+
+    def sum(self):
+        return self.total
+
+    def mean(self):
+        return self.total / len(self.readings) if self.readings else np.nan
+
+
+class WindowStatistics(object):
+    """
+    Per-sensor sliding-window statistics for incoming readings.
+
+    A sensor's windows are loaded from the last 24 hours of stored readings the first time it's seen, and again whenever readings seem to have been missed (e.g. ingested by another process).
+    """
+
+    # Time between readings beyond which a sensor's windows are reloaded.
+    reloadGap = pd.Timedelta(minutes=5)
+
+    def __init__(self, threshold=us.aqiThreshold, timezone=us.timezone):
+        self.threshold = threshold
+        self.timezone = timezone
+        self.sensors = dict()
+        self.lock = threading.Lock()
+
+    def newState(self):
+        return {'pm25': SlidingWindow(window),
+                'secondsAbove': SlidingWindow(window),
+                'lastTs': None, 'day': None,
+                'dayLow': np.nan, 'dayHigh': np.nan}
+
+    def add(self, state, ts, pm25, aqiValue, tempF):
+        """
+        Add a reading to a sensor's windows.
+
+        Returns:
+            dict of stored column -> value
+        """
+        duration = 0.0
+        if state['lastTs'] is not None:
+            duration = min(ts - state['lastTs'],
+                           maxReadingDuration).total_seconds()
+        state['lastTs'] = ts
+
+        state['pm25'].add(ts, pm25)
+        state['secondsAbove'].add(
+            ts, duration if aqiValue > self.threshold else 0.0)
+
+        day = ts.tz_convert(self.timezone).date()
+        if day != state['day']:
+            state['day'] = day
+            state['dayLow'] = state['dayHigh'] = np.nan
+        if not np.isnan(tempF):
+            state['dayLow'] = np.nanmin([state['dayLow'], tempF])
+            state['dayHigh'] = np.nanmax([state['dayHigh'], tempF])
+
+        average = state['pm25'].mean()
+
+        return {'pm_2_5_24h_avg_um_m3': average,
+                'pm_2_5_24h_aqi': aqi.getAqiArray([average], pm25Breakpoints, 1)[0],
+                'hours_above_aqi_threshold_24h': state['secondsAbove'].sum() / 3600,
+                'temp_f_day_high': state['dayHigh'],
+                'temp_f_day_low': state['dayLow']}
+
+    def load(self, cur, sensorId, before):
+        """
+        Rebuild a sensor's windows from readings in the 24 hours before a time.
+        """
+        state = self.newState()
+        self.sensors[sensorId] = state
+
+        cur.execute("SELECT measurement_ts, pm_2_5_um_m3, pm_2_5_aqi, temp_f_corrected FROM sensor_data "
+                    "WHERE sensor_id IS NOT DISTINCT FROM %s AND measurement_ts >= %s AND measurement_ts < %s "
+                    "ORDER BY measurement_ts ASC ",
+                    (sensorId, before - window, before))
+
+        for row in cur.fetchall():
+            self.add(state, pd.Timestamp(row[0]).tz_convert('UTC'),
+                     toFloat(row[1]), toFloat(row[2]), toFloat(row[3]))
+
+    def forget(self, sensorId):
+        """
+        Drop a sensor's windows, so they're reloaded with its next reading, e.g. after its readings were rolled back.
+        """
+        with self.lock:
+            self.sensors.pop(sensorId, None)
+
+    def update(self, row, cur):
+        """
+        Add a reading and get its window statistics.
+
+        Args:
+            row: dict of sensor_data column -> value, including derived columns
+            cur: psycopg2 cursor, used to reload windows
+
+        Returns:
+            dict of stored column -> value (NaN where there's no data)
+        """
+        sensorId = row.get('sensor_id')
+        ts = pd.Timestamp(row['measurement_ts']).tz_convert('UTC')
+
+        with self.lock:
+            state = self.sensors.get(sensorId)
+            lastTs = None if state is None else state['lastTs']
+
+            if state is None or (lastTs is not None and ts - lastTs > self.reloadGap):
+                self.load(cur, sensorId, ts.to_pydatetime())
+                state = self.sensors[sensorId]
+
+            if state['lastTs'] is not None and ts <= state['lastTs']:
+                # Late reading. Windows only move forward.
+                return {column: np.nan for column in windowColumnTypes}
+
+            return self.add(state, ts, toFloat(row.get('pm_2_5_um_m3')),
+                            toFloat(row.get('pm_2_5_aqi')),
+                            toFloat(row.get('temp_f_corrected')))
+
+
+def windowHistory(records, threshold=us.aqiThreshold, timezone=us.timezone, breakpoints=pm25Breakpoints):
+    """
+    Add window statistics columns to a dataframe of stored readings, computed per sensor with vectorized rolling windows.
+
+    Args:
+        records: pandas dataframe with measurement_ts, sensor_id, pm_2_5_um_m3, pm_2_5_aqi and temp_f_corrected, sorted by time
+        breakpoints: PM 2.5 AQI breakpoints for the 24-hour average AQI
+
+    Returns:
+        the same dataframe with window statistics columns added
+    """
+    for column in windowColumnTypes:
+        records[column] = np.nan
+
+    for rowIndex in records.groupby(records['sensor_id'].fillna(''), sort=False).indices.values():
+        sensor = records.iloc[rowIndex]
+        ts = pd.DatetimeIndex(pd.to_datetime(sensor['measurement_ts'], utc=True))
+
+        pm25 = pd.Series(pd.to_numeric(sensor['pm_2_5_um_m3'], errors='coerce').to_numpy(dtype='float64'), index=ts)
+        average = pm25.rolling(rollingWindow).mean().to_numpy()
+
+        durations = np.minimum(pd.Series(ts).diff().dt.total_seconds().fillna(0.0).to_numpy(),
+                               maxReadingDuration.total_seconds())
+        above = pd.to_numeric(sensor['pm_2_5_aqi'], errors='coerce').to_numpy(dtype='float64') > threshold
+        hoursAbove = pd.Series(np.where(above, durations, 0.0), index=ts).rolling(
+            rollingWindow).sum().to_numpy() / 3600
+
+        # Running extremes within each local calendar day, carried past readings without a temperature.
+        tempF = pd.Series(pd.to_numeric(sensor['temp_f_corrected'], errors='coerce').to_numpy(dtype='float64'))
+        day = pd.Series(ts.tz_convert(timezone).date)
+        dayHigh = tempF.groupby(day).cummax().groupby(day).ffill()
+        dayLow = tempF.groupby(day).cummin().groupby(day).ffill()
+
+        positions = [records.columns.get_loc(column) for column in windowColumnTypes]
+        records.iloc[rowIndex, positions] = np.column_stack([
+            average, aqi.getAqiArray(average, breakpoints, 1), hoursAbove,
+            dayHigh.to_numpy(), dayLow.to_numpy()])
+
+    return records